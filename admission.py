@@ -0,0 +1,40 @@
+import math
+import threading
+import time
+
+# Buckets idle long enough to be full again are forgotten past this many keys
+MAX_BUCKETS = 10000
+
+
+class AdmissionError(Exception):
+    """Raised when a submission is refused because the server is saturated"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after  # Seconds the client should wait before trying again
+
+
+class RateLimiter:
+    """Token bucket per key (user): rate submissions per second with bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # key -> (tokens, last refill time)
+        self.lock = threading.Lock()
+
+    def acquire(self, key, cost=1):
+        """Take cost tokens; raises AdmissionError with the wait until they are available"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < cost:
+                self.buckets[key] = (tokens, now)
+                retry_after = math.ceil((cost - tokens) / self.rate) if self.rate > 0 else 60
+                raise AdmissionError("Submission rate limit exceeded", retry_after=retry_after)
+            self.buckets[key] = (tokens - cost, now)
+
+            if len(self.buckets) > MAX_BUCKETS:
+                refill = self.burst / self.rate if self.rate > 0 else float('inf')
+                self.buckets = {k: v for k, v in self.buckets.items() if now - v[1] < refill}
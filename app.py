@@ -1,47 +1,388 @@
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from flask import Flask, Response, g, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from jinja2 import ChoiceLoader, DictLoader
 import os
+import gzip
 import json
 import time
 import uuid
+import hashlib
 import logging
-from urllib.parse import urlparse  # Using Python's built-in URL parser instead of werkzeug
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, quote  # Using Python's built-in URL parser instead of werkzeug
 from download_manager import DownloadManager
+from metalink import MetalinkError, is_metalink, fetch_metalink
+from hls import is_hls
+from archive import stream_zip, stream_tar
+from retention import RetentionIndex
+from cluster import ClusterNode
+from http2 import HTTP2_AVAILABLE, Http2Pool
+from url_cache import DnsCache, MetadataCache
+from admission import AdmissionError, RateLimiter
+from crawler import Crawler, split_patterns
+from postprocess import PostProcessError, PostProcessor, parse_stages
+from webhooks import WebhookDispatcher
+from fairshare import parse_weights
+from windows import WindowError, parse_windows
+from file_index import MAX_PAGE, SORT_KEYS
+from diagnostics import Profiler, ProfilerBusy, allocation_report, start_tracing, stop_tracing, thread_stacks
+from logs import AccessLogFilter, get_stats as get_log_stats, setup_logging
 from templates import TEMPLATES
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+try:
+    import brotli
+except ImportError:  # Optional; gzip is used when it is not installed
+    brotli = None
+
 logger = logging.getLogger('fdl_server')
+access_logger = logging.getLogger('fdl_server.access')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or 'fdl-server-secret-key'
 app.config['DOWNLOAD_DIR'] = os.environ.get('DOWNLOAD_DIR') or 'downloads'
 app.config['TEMP_DIR'] = os.environ.get('TEMP_DIR') or 'downloads/temp'
+app.config['STATE_DIR'] = os.environ.get('STATE_DIR') or 'state'
+
+# Logging: records are handed to one writer thread through a queue, so
+# request and download threads never wait on log I/O. Stderr gets LOG_FORMAT
+# ('text' or 'json'); LOG_DIR, unless empty, gets rotating JSON log files.
+# Each request is logged to fdl_server.access: successful ones for a sampled
+# ACCESS_LOG_SAMPLE fraction and at most ACCESS_LOG_RATE per second (0 for no
+# limit), errors always.
+app.config['LOG_LEVEL'] = (os.environ.get('LOG_LEVEL') or 'INFO').upper()
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT') or 'text'
+app.config['LOG_DIR'] = os.environ.get('LOG_DIR', 'logs')
+app.config['LOG_MAX_BYTES'] = int(os.environ.get('LOG_MAX_BYTES') or 50 * 1024 * 1024)
+app.config['LOG_BACKUPS'] = int(os.environ.get('LOG_BACKUPS') or 5)
+app.config['ACCESS_LOG_SAMPLE'] = float(os.environ.get('ACCESS_LOG_SAMPLE') or 1.0)
+app.config['ACCESS_LOG_RATE'] = float(os.environ.get('ACCESS_LOG_RATE') or 50)
+
+log_listener = setup_logging(
+    level=app.config['LOG_LEVEL'],
+    json_console=app.config['LOG_FORMAT'] == 'json',
+    log_dir=app.config['LOG_DIR'],
+    max_bytes=app.config['LOG_MAX_BYTES'],
+    backups=app.config['LOG_BACKUPS']
+)
+logging.getLogger('httpx').setLevel(logging.WARNING)  # One INFO line per request otherwise
+logging.getLogger('werkzeug').setLevel(logging.WARNING)  # The access log below replaces its request lines
+access_logger.addFilter(AccessLogFilter(sample=app.config['ACCESS_LOG_SAMPLE'], rate=app.config['ACCESS_LOG_RATE']))
+
+# How completed files are placed in DOWNLOAD_DIR: 'flat', or sharded into
+# ab/cd/ subdirectories by a hash of the file's path ('hash') or by job id
+# ('id') to keep directories small with hundreds of thousands of files. URLs
+# are the same in every layout. In cluster mode use 'hash', whose paths any
+# node can work out. Move existing files with: python storage.py --to <layout>
+app.config['STORAGE_LAYOUT'] = os.environ.get('STORAGE_LAYOUT') or 'flat'
+
+# File browser (/api/files): seconds between incremental rescans of
+# DOWNLOAD_DIR, which back up inotify where the kernel offers it. 0 turns
+# the index and the endpoint off.
+app.config['FILE_INDEX_RESCAN'] = int(os.environ.get('FILE_INDEX_RESCAN') or 60)
+
+# Users who may reach /api/admin/ (thread stacks, profiles, memory)
+app.config['ADMIN_USERS'] = {user.strip() for user in (os.environ.get('ADMIN_USERS') or 'admin').split(',') if user.strip()}
+
+# Retention: run DOWNLOAD_DIR as a bounded cache. 0 disables a limit.
+app.config['RETENTION_MAX_BYTES'] = int(os.environ.get('RETENTION_MAX_BYTES') or 0)
+app.config['RETENTION_MAX_FILES'] = int(os.environ.get('RETENTION_MAX_FILES') or 0)
+app.config['RETENTION_TTL'] = int(os.environ.get('RETENTION_TTL') or 0)  # Seconds since last served
+
+# HTTP/2 engine: connections kept per origin, and whether http:// origins are
+# spoken to with HTTP/2 prior knowledge (h2c) instead of HTTP/1.1
+app.config['HTTP2_CONNECTIONS_PER_ORIGIN'] = int(os.environ.get('HTTP2_CONNECTIONS_PER_ORIGIN') or 2)
+app.config['HTTP2_CLEARTEXT'] = (os.environ.get('HTTP2_CLEARTEXT') or 'false').lower() == 'true'
+
+# Caches of HEAD probe results and DNS lookups; a TTL of 0 disables a cache
+app.config['URL_CACHE_TTL'] = int(os.environ.get('URL_CACHE_TTL') or 300)
+app.config['URL_CACHE_SIZE'] = int(os.environ.get('URL_CACHE_SIZE') or 4096)
+app.config['DNS_CACHE_TTL'] = int(os.environ.get('DNS_CACHE_TTL') or 60)
+
+# Admission control: submissions beyond these limits get 429 with Retry-After
+# instead of piling up threads and probes. 0 disables a limit.
+app.config['MAX_ACTIVE_DOWNLOADS'] = int(os.environ.get('MAX_ACTIVE_DOWNLOADS') or 8)  # Others wait as queued
+app.config['MAX_QUEUE_DEPTH'] = int(os.environ.get('MAX_QUEUE_DEPTH') or 500)  # Running plus queued jobs
+app.config['MAX_INFLIGHT_PROBES'] = int(os.environ.get('MAX_INFLIGHT_PROBES') or 16)  # Concurrent HEAD probes
+app.config['SUBMIT_RATE'] = float(os.environ.get('SUBMIT_RATE') or 2)  # Submissions per second per user
+app.config['SUBMIT_BURST'] = int(os.environ.get('SUBMIT_BURST') or 30)
+
+# Stall watchdogs: connections that receive nothing for STALL_TIMEOUT seconds,
+# or average LOW_SPEED_LIMIT bytes per second or less over LOW_SPEED_TIME
+# seconds, are dropped and resumed on a new connection. 0 disables a check.
+app.config['STALL_TIMEOUT'] = int(os.environ.get('STALL_TIMEOUT') or 30)
+app.config['LOW_SPEED_LIMIT'] = int(os.environ.get('LOW_SPEED_LIMIT') or 1024)
+app.config['LOW_SPEED_TIME'] = int(os.environ.get('LOW_SPEED_TIME') or 60)
+
+# Directory crawls: index pages fetched at once per crawl, and the deepest
+# level and most files a crawl may reach
+app.config['CRAWL_PAGE_WORKERS'] = int(os.environ.get('CRAWL_PAGE_WORKERS') or 4)
+app.config['CRAWL_MAX_DEPTH'] = int(os.environ.get('CRAWL_MAX_DEPTH') or 5)
+app.config['CRAWL_MAX_FILES'] = int(os.environ.get('CRAWL_MAX_FILES') or 10000)
+
+# HLS streams: the best variant at or below this many bits per second, 0 for the best
+app.config['HLS_MAX_BANDWIDTH'] = int(os.environ.get('HLS_MAX_BANDWIDTH') or 0)
+
+# Post-processing (checksums, unpacking, recompression) runs in this many
+# worker processes shared by all jobs; 0 disables it
+app.config['POSTPROCESS_WORKERS'] = int(os.environ.get('POSTPROCESS_WORKERS') or 2)
+# Of those, how many may run stages that stream alongside a download, each
+# for as long as it lasts; by default all but one, which is kept for stages
+# on finished files. Other streamable stages wait for the file instead.
+app.config['POSTPROCESS_STREAMS'] = int(os.environ.get('POSTPROCESS_STREAMS') or max(0, app.config['POSTPROCESS_WORKERS'] - 1))
+
+# Fair share between users: waiting jobs start in weighted fair order, so one
+# user's large batch does not hold up another user's download. USER_WEIGHTS
+# gives some users a bigger share ("alice=3, bob=1"; others weigh 1). Per
+# user, at most USER_MAX_ACTIVE jobs run at once and USER_QUOTA_BYTES may be
+# downloaded per QUOTA_PERIOD seconds. 0 disables a limit.
+app.config['USER_WEIGHTS'] = parse_weights(os.environ.get('USER_WEIGHTS'))
+app.config['USER_MAX_ACTIVE'] = int(os.environ.get('USER_MAX_ACTIVE') or 0)
+app.config['USER_QUOTA_BYTES'] = int(os.environ.get('USER_QUOTA_BYTES') or 0)
+app.config['QUOTA_PERIOD'] = int(os.environ.get('QUOTA_PERIOD') or 24 * 3600)
+
+# Download windows: jobs submitted to a window only run while it is open, and
+# are paused when it closes. Each window is name=[days ]HH:MM-HH:MM[@rate] in
+# server local time, ';' separated, with an optional cap on the combined speed
+# of its jobs, e.g. "night=22:00-06:00@10M; weekend=sat,sun 00:00-24:00"
+app.config['DOWNLOAD_WINDOWS'] = parse_windows(os.environ.get('DOWNLOAD_WINDOWS'))
+
+# Webhooks: a job submitted with a callback_url gets a POST on each status
+# change. Delivery threads (0 disables webhooks), events held for delivery,
+# attempts per event, and an optional secret the bodies are signed with.
+app.config['WEBHOOK_WORKERS'] = int(os.environ.get('WEBHOOK_WORKERS') or 2)
+app.config['WEBHOOK_QUEUE_SIZE'] = int(os.environ.get('WEBHOOK_QUEUE_SIZE') or 1000)
+app.config['WEBHOOK_MAX_ATTEMPTS'] = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS') or 5)
+app.config['WEBHOOK_SECRET'] = os.environ.get('WEBHOOK_SECRET') or ''
+
+# Long-poll waits on a job: the longest wait a client may ask for, and how
+# many requests may be blocked waiting at once
+app.config['WAIT_MAX_TIMEOUT'] = int(os.environ.get('WAIT_MAX_TIMEOUT') or 60)
+app.config['MAX_WAITERS'] = int(os.environ.get('MAX_WAITERS') or 64)
+
+# Download engines a job can ask for
+ENGINES = ('aria2', 'requests', 'http2', 'auto', 'hls')
+
+# Cluster mode: nodes sharing CLUSTER_DB (SQLite on shared storage) pull jobs
+# from one queue. DOWNLOAD_DIR and TEMP_DIR should be shared too, so any node
+# can serve a finished file and take over a dead node's partial downloads.
+app.config['CLUSTER_DB'] = os.environ.get('CLUSTER_DB') or ''
+app.config['CLUSTER_SLOTS'] = int(os.environ.get('CLUSTER_SLOTS') or 4)  # Jobs this node runs at once
+app.config['NODE_ID'] = os.environ.get('NODE_ID') or None
+
+# Serve the inline templates through the regular loader so Jinja compiles
+# them once and caches them, instead of recompiling on every request. The
+# .html names keep Flask's autoescaping on.
+app.jinja_env.loader = ChoiceLoader([
+    DictLoader({f'{name}.html': source for name, source in TEMPLATES.items()}),
+    app.jinja_env.loader
+])
+
+# Responses worth compressing, and the size below which it does not pay off
+COMPRESSIBLE_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_SIZE = 500
+
+# Largest page of the download history one /api/downloads request may ask for
+MAX_HISTORY_PAGE = 1000
+
+# Static asset URLs carry a content hash, so they can be cached for a year
+STATIC_MAX_AGE = 365 * 24 * 3600
+ASSET_VERSIONS = {}
 
 # In-memory user storage
 USERS = {
     'admin': 'password'  # Default user/pass - change this in production!
 }
 
-# Ensure directories exist with proper permissions
-for directory in [app.config['DOWNLOAD_DIR'], app.config['TEMP_DIR']]:
-    os.makedirs(directory, exist_ok=True)
-    try:
-        # Set full permissions for container environment
-        os.system(f'chmod -R 777 {directory}')
-    except Exception as e:
-        logger.error(f"Failed to set permissions on {directory}: {str(e)}")
+# The post-processing workers are forked first, while this process has no other threads
+postprocessor = None
+if app.config['POSTPROCESS_WORKERS'] > 0:
+    postprocessor = PostProcessor(
+        os.path.join(app.config['TEMP_DIR'], 'postprocess'),
+        workers=app.config['POSTPROCESS_WORKERS'],
+        max_streams=app.config['POSTPROCESS_STREAMS']
+    )
+
+# The log writer is the first thread; records logged so far waited in its queue
+log_listener.start()
+
+# Create download manager; it prepares its directories and restores the
+# download history in the background
+retention = None
+if app.config['RETENTION_MAX_BYTES'] or app.config['RETENTION_MAX_FILES'] or app.config['RETENTION_TTL']:
+    retention = RetentionIndex(
+        max_bytes=app.config['RETENTION_MAX_BYTES'],
+        max_files=app.config['RETENTION_MAX_FILES'],
+        ttl=app.config['RETENTION_TTL']
+    )
+
+url_cache = None
+if app.config['URL_CACHE_TTL'] > 0:
+    url_cache = MetadataCache(max_entries=app.config['URL_CACHE_SIZE'], ttl=app.config['URL_CACHE_TTL'])
+
+dns_cache = None
+if app.config['DNS_CACHE_TTL'] > 0:
+    dns_cache = DnsCache(ttl=app.config['DNS_CACHE_TTL'])
+    dns_cache.install()
+
+http2_pool = None
+if HTTP2_AVAILABLE:
+    http2_pool = Http2Pool(
+        connections_per_origin=app.config['HTTP2_CONNECTIONS_PER_ORIGIN'],
+        cleartext=app.config['HTTP2_CLEARTEXT']
+    )
+
+webhooks = None
+if app.config['WEBHOOK_WORKERS'] > 0:
+    webhooks = WebhookDispatcher(
+        workers=app.config['WEBHOOK_WORKERS'],
+        max_queue=app.config['WEBHOOK_QUEUE_SIZE'],
+        max_attempts=app.config['WEBHOOK_MAX_ATTEMPTS'],
+        secret=app.config['WEBHOOK_SECRET']
+    )
+
+# Each long-poll holds a request thread while it waits
+wait_slots = threading.BoundedSemaphore(app.config['MAX_WAITERS'])
+
+profiler = Profiler()
 
-# Create download manager
 download_manager = DownloadManager(
     download_dir=app.config['DOWNLOAD_DIR'],
-    temp_dir=app.config['TEMP_DIR']
+    temp_dir=app.config['TEMP_DIR'],
+    state_dir=app.config['STATE_DIR'],
+    retention=retention,
+    http2=http2_pool,
+    url_cache=url_cache,
+    max_active=app.config['MAX_ACTIVE_DOWNLOADS'],
+    max_queue_depth=app.config['MAX_QUEUE_DEPTH'],
+    max_probes=app.config['MAX_INFLIGHT_PROBES'],
+    stall_timeout=app.config['STALL_TIMEOUT'],
+    low_speed_limit=app.config['LOW_SPEED_LIMIT'],
+    low_speed_time=app.config['LOW_SPEED_TIME'],
+    hls_max_bandwidth=app.config['HLS_MAX_BANDWIDTH'],
+    postprocessor=postprocessor,
+    webhooks=webhooks,
+    user_weights=app.config['USER_WEIGHTS'],
+    user_max_active=app.config['USER_MAX_ACTIVE'],
+    user_quota_bytes=app.config['USER_QUOTA_BYTES'],
+    quota_period=app.config['QUOTA_PERIOD'],
+    windows=app.config['DOWNLOAD_WINDOWS'],
+    storage_layout=app.config['STORAGE_LAYOUT'],
+    file_index_rescan=app.config['FILE_INDEX_RESCAN']
 )
+file_index = download_manager.file_index
+
+submit_limiter = None
+if app.config['SUBMIT_RATE'] > 0:
+    submit_limiter = RateLimiter(app.config['SUBMIT_RATE'], app.config['SUBMIT_BURST'])
+
+cluster = None
+if app.config['CLUSTER_DB']:
+    cluster = ClusterNode(
+        app.config['CLUSTER_DB'],
+        download_manager,
+        node_id=app.config['NODE_ID'],
+        slots=app.config['CLUSTER_SLOTS'],
+        max_queue_depth=app.config['MAX_QUEUE_DEPTH'],
+        user_weights=app.config['USER_WEIGHTS']
+    )
+    logger.info("Cluster mode: node %s using %s", cluster.node_id, app.config['CLUSTER_DB'])
+
+# Job listing and control go through the shared queue in cluster mode
+jobs = cluster or download_manager
+
+crawler = Crawler(
+    page_workers=app.config['CRAWL_PAGE_WORKERS'],
+    max_depth=app.config['CRAWL_MAX_DEPTH'],
+    max_files=app.config['CRAWL_MAX_FILES']
+)
+
+@app.template_global()
+def asset_url(filename):
+    """URL of a static asset, versioned by its content"""
+    version = ASSET_VERSIONS.get(filename)
+    if version is None:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = ASSET_VERSIONS[filename] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=version)
+
+@app.before_request
+def start_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def log_request(response):
+    # Registered first so it runs last, after compression has set the final body
+    started = g.get('request_started')
+    access_logger.info(
+        '%s %s %s', request.method, request.path, response.status_code,
+        extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round((time.monotonic() - started) * 1000, 1) if started else None,
+            'bytes': response.content_length,
+            'user': session.get('username'),
+            'ip': request.remote_addr
+        }
+    )
+    return response
+
+@app.after_request
+def cache_static_assets(response):
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code != 200
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    accept_encodings = request.accept_encodings
+    if brotli and accept_encodings['br']:
+        data, encoding = brotli.compress(data, quality=5), 'br'
+    elif accept_encodings['gzip']:
+        data, encoding = gzip.compress(data, compresslevel=6), 'gzip'
+    else:
+        return response
+    
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    
+    # The compressed bytes differ from what the ETag was computed over
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/healthz')
+def healthz():
+    # Liveness: the process is up and serving requests
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: the download history has been restored
+    health = download_manager.get_health()
+    return jsonify(health), 200 if health['ready'] else 503
 
 @app.route('/')
 def index():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
-    return render_template_string(TEMPLATES['index'])
+    return render_template('index.html', windows=sorted(app.config['DOWNLOAD_WINDOWS']))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -52,21 +393,55 @@ def login():
         if username in USERS and USERS[username] == password:
             session['logged_in'] = True
             session['username'] = username
-            logger.info(f"User '{username}' logged in successfully")
+            logger.info("User '%s' logged in", username, extra={'user': username, 'ip': request.remote_addr})
             return redirect(url_for('index'))
         else:
-            logger.warning(f"Failed login attempt for user '{username}'")
+            logger.warning("Failed login attempt for user '%s'", username, extra={'user': username, 'ip': request.remote_addr})
             flash('Invalid username or password')
     
-    return render_template_string(TEMPLATES['login'])
+    return render_template('login.html')
 
 @app.route('/logout')
 def logout():
     username = session.get('username', 'Unknown')
-    logger.info(f"User '{username}' logged out")
+    logger.info("User '%s' logged out", username, extra={'user': username})
     session.clear()
     return redirect(url_for('login'))
 
+def _is_valid_url(url):
+    """Check that a URL has at least a scheme and a host"""
+    try:
+        parsed_url = urlparse(url)
+        return all([parsed_url.scheme, parsed_url.netloc])
+    except Exception:
+        return False
+
+def _parse_start_time(value):
+    """Timestamp from epoch seconds or an ISO 8601 date and time (server local time without an offset)"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def _too_many_requests(error):
+    """429 response for a refused submission, telling the client when to come back"""
+    logger.warning("Submission refused for %s: %s", session.get('username', 'Unknown'), error, extra={'user': session.get('username')})
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def _parse_retry_policy(form):
+    """Build per-job retry policy overrides from the submitted form"""
+    policy = {}
+    if form.get('max_attempts'):
+        policy['max_attempts'] = max(1, int(form['max_attempts']))
+    if form.get('backoff'):
+        policy['backoff_base'] = max(0.0, float(form['backoff']))
+    if form.get('retry_statuses'):
+        policy['retry_statuses'] = [int(code) for code in form['retry_statuses'].split(',') if code.strip()]
+    return policy
+
 @app.route('/api/download', methods=['POST'])
 def add_download():
     if not session.get('logged_in'):
@@ -74,44 +449,315 @@ def add_download():
     
     url = request.form.get('url')
     use_aria2 = request.form.get('use_aria2', 'true').lower() == 'true'
+    # An explicit engine takes precedence over use_aria2
+    engine = request.form.get('engine') or None
+    # Optional mirrors of the same file, whitespace or newline separated
+    mirrors = request.form.get('mirrors', '').split()
+    metalink_file = request.files.get('metalink')
     
-    if not url:
+    if not url and not metalink_file:
         return jsonify({'error': 'URL is required'}), 400
     
-    # Validate URL
+    # Shed load before doing any work for the request
+    if submit_limiter:
+        try:
+            submit_limiter.acquire(session.get('username'))
+        except AdmissionError as e:
+            return _too_many_requests(e)
+    
     try:
-        parsed_url = urlparse(url)
-        if not all([parsed_url.scheme, parsed_url.netloc]):
-            raise ValueError("Invalid URL format")
-    except Exception:
-        logger.warning(f"Invalid URL attempted: {url}")
-        return jsonify({'error': 'Invalid URL format'}), 400
+        retry = _parse_retry_policy(request.form)
+        split = int(request.form['split']) if request.form.get('split') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid retry or split settings'}), 400
+    
+    # Post-download stages, e.g. "checksum:sha256, unpack"
+    try:
+        postprocess = parse_stages(request.form.get('postprocess'))
+    except PostProcessError as e:
+        return jsonify({'error': str(e)}), 400
+    if postprocess and not postprocessor:
+        return jsonify({'error': 'Post-processing is disabled (POSTPROCESS_WORKERS=0)'}), 400
+    
+    # Status changes are POSTed here, so clients need not poll the job
+    callback_url = request.form.get('callback_url') or None
+    if callback_url and not _is_valid_url(callback_url):
+        return jsonify({'error': 'Invalid callback URL'}), 400
+    if callback_url and not webhooks:
+        return jsonify({'error': 'Webhooks are disabled (WEBHOOK_WORKERS=0)'}), 400
     
+    # Deferred start: not before a given time, and/or only inside a download window
     try:
-        download_id = download_manager.add_download(url, use_aria2=use_aria2)
-        logger.info(f"Download added: {url} (ID: {download_id})")
+        not_before = _parse_start_time(request.form['not_before']) if request.form.get('not_before') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid not_before time'}), 400
+    window = request.form.get('window') or None
+    if window and window not in app.config['DOWNLOAD_WINDOWS']:
+        return jsonify({'error': f"Unknown download window {window}"}), 400
+    
+    if engine in (None, 'auto') and url and is_hls(url):
+        # A playlist is downloaded as the stream it describes
+        engine = 'hls'
+    
+    error = _check_engine(engine)
+    if error:
+        return jsonify({'error': error}), 400
+    if engine is not None:
+        use_aria2 = engine == 'aria2'
+    
+    if metalink_file or is_metalink(url):
+        return _add_metalink_download(url, metalink_file, use_aria2, retry, split, engine, not_before, window, callback_url,
+                                      postprocess)
+    
+    # Validate URL
+    for candidate in [url] + mirrors:
+        if not _is_valid_url(candidate):
+            logger.warning("Invalid URL attempted: %s", candidate, extra={'url': candidate})
+            return jsonify({'error': 'Invalid URL format'}), 400
+    
+    try:
+        if cluster:
+            download_id = cluster.submit(url, use_aria2=use_aria2, mirrors=mirrors, retry=retry, split=split, engine=engine,
+                                         postprocess=postprocess, callback_url=callback_url, user=session.get('username'),
+                                         not_before=not_before, window=window)
+        else:
+            download_id = download_manager.add_download(
+                url, use_aria2=use_aria2, mirrors=mirrors, retry=retry, split=split, engine=engine,
+                postprocess=postprocess, callback_url=callback_url, user=session.get('username'),
+                not_before=not_before, window=window
+            )
+        logger.info(
+            "Download added: %s (ID: %s, mirrors: %d, engine: %s)", url, download_id, len(mirrors), engine or 'default',
+            extra={'job_id': download_id, 'url': url, 'user': session.get('username')}
+        )
         return jsonify({
             'success': True,
             'download_id': download_id
         })
+    except AdmissionError as e:
+        return _too_many_requests(e)
+    except (PostProcessError, WindowError) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Error adding download {url}: {str(e)}")
+        logger.error("Error adding download %s: %s", url, e, extra={'url': url})
         return jsonify({'error': str(e)}), 500
 
+def _check_engine(engine):
+    """Error message if the requested engine cannot be used, else None"""
+    if engine is None:
+        return None
+    if engine not in ENGINES:
+        return f"Engine must be one of {', '.join(ENGINES)}"
+    if engine == 'http2' and not HTTP2_AVAILABLE:
+        return 'The http2 engine requires httpx[http2] to be installed'
+    return None
+
+def _add_metalink_download(url, metalink_file, use_aria2, retry, split, engine=None, not_before=None, window=None,
+                           callback_url=None, postprocess=None):
+    """Queue every file of an uploaded or linked Metalink document"""
+    try:
+        if metalink_file:
+            data = metalink_file.read()
+        else:
+            if not _is_valid_url(url):
+                logger.warning("Invalid URL attempted: %s", url, extra={'url': url})
+                return jsonify({'error': 'Invalid URL format'}), 400
+            data = fetch_metalink(url)
+        
+        if cluster:
+            download_ids = cluster.submit_metalink(data, use_aria2=use_aria2, retry=retry, split=split, engine=engine,
+                                                   user=session.get('username'), not_before=not_before, window=window,
+                                                   callback_url=callback_url, postprocess=postprocess)
+        else:
+            download_ids = download_manager.add_metalink(data, use_aria2=use_aria2, retry=retry, split=split, engine=engine,
+                                                         user=session.get('username'), not_before=not_before, window=window,
+                                                         callback_url=callback_url, postprocess=postprocess)
+    except (MetalinkError, PostProcessError, WindowError) as e:
+        return jsonify({'error': str(e)}), 400
+    except AdmissionError as e:
+        return _too_many_requests(e)
+    except Exception as e:
+        logger.error("Error adding metalink download %s: %s", url, e, extra={'url': url})
+        return jsonify({'error': str(e)}), 500
+    
+    if not download_ids:
+        return jsonify({'error': 'No usable sources in Metalink document'}), 400
+    
+    logger.info("Metalink download added: %s (%d files)", url or metalink_file.filename, len(download_ids), extra={'user': session.get('username')})
+    return jsonify({
+        'success': True,
+        'download_id': download_ids[0],
+        'download_ids': download_ids
+    })
+
+@app.route('/api/crawl', methods=['POST'])
+def add_crawl():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    url = request.form.get('url')
+    if not url or not _is_valid_url(url):
+        logger.warning("Invalid URL attempted: %s", url, extra={'url': url})
+        return jsonify({'error': 'A valid directory URL is required'}), 400
+    
+    # A whole crawl counts as one submission; the files it finds wait for queue space instead
+    if submit_limiter:
+        try:
+            submit_limiter.acquire(session.get('username'))
+        except AdmissionError as e:
+            return _too_many_requests(e)
+    
+    engine = request.form.get('engine') or None
+    use_aria2 = request.form.get('use_aria2', 'true').lower() == 'true'
+    try:
+        retry = _parse_retry_policy(request.form)
+        split = int(request.form['split']) if request.form.get('split') else None
+        max_depth = int(request.form['depth']) if request.form.get('depth') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid retry, split or depth settings'}), 400
+    
+    error = _check_engine(engine)
+    if error:
+        return jsonify({'error': error}), 400
+    if engine is not None:
+        use_aria2 = engine == 'aria2'
+    
+    # Crawled files are queued from the crawl's thread, outside this request
+    user = session.get('username')
+    
+    def submit(file_url, subdir, filename):
+        if cluster:
+            return cluster.submit(file_url, use_aria2=use_aria2, retry=retry, split=split, engine=engine,
+                                  subdir=subdir, filename=filename, user=user)
+        return download_manager.add_download(file_url, use_aria2=use_aria2, retry=retry, split=split, engine=engine,
+                                             subdir=subdir, filename=filename, user=user)
+    
+    crawl_id = crawler.start(
+        url,
+        submit,
+        include=split_patterns(request.form.get('include')),
+        exclude=split_patterns(request.form.get('exclude')),
+        max_depth=max_depth
+    )
+    logger.info(
+        "Crawl started: %s (ID: %s) by %s", url, crawl_id, session.get('username', 'Unknown'),
+        extra={'crawl_id': crawl_id, 'url': url, 'user': session.get('username')}
+    )
+    return jsonify({
+        'success': True,
+        'crawl_id': crawl_id
+    })
+
+@app.route('/api/crawls')
+def get_crawls():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    return jsonify({'crawls': crawler.list()})
+
+@app.route('/api/crawl/<crawl_id>')
+def get_crawl(crawl_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    crawl = crawler.get(crawl_id)
+    if crawl:
+        return jsonify(crawl)
+    return jsonify({'error': 'Crawl not found'}), 404
+
+@app.route('/api/crawl/<crawl_id>/cancel', methods=['POST'])
+def cancel_crawl(crawl_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    result = crawler.cancel(crawl_id)
+    logger.info("Crawl cancelled: %s, result: %s", crawl_id, result, extra={'crawl_id': crawl_id})
+    return jsonify({'success': result})
+
 @app.route('/api/downloads')
 def get_downloads():
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
     
-    downloads = download_manager.get_all_downloads()
-    return jsonify(downloads)
+    # The web UI asks for the page of the history in view rather than all of it
+    try:
+        history_offset = max(0, int(request.args.get('history_offset', 0)))
+        history_limit = request.args.get('history_limit')
+        history_limit = min(MAX_HISTORY_PAGE, max(1, int(history_limit))) if history_limit else None
+    except ValueError:
+        return jsonify({'error': 'history_offset and history_limit must be integers'}), 400
+    
+    downloads = jobs.get_all_downloads(history_offset=history_offset, history_limit=history_limit)
+    downloads['crawls'] = crawler.list()
+    
+    # Polls that find nothing changed get a bodyless 304; no-cache makes the
+    # browser revalidate with If-None-Match instead of reusing a stale copy
+    response = jsonify(downloads)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/api/downloads/export', methods=['GET', 'POST'])
+def export_downloads():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    # Job ids may be repeated or comma separated; without ids, filter the history
+    values = request.values
+    download_ids = [i for value in values.getlist('ids') for i in value.split(',') if i]
+    archive_format = values.get('format', 'zip').lower()
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'Format must be zip or tar'}), 400
+    try:
+        since = float(values['since']) if values.get('since') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid since timestamp'}), 400
+    
+    entries = download_manager.get_export_entries(download_ids, values.get('q'), since)
+    if not entries:
+        return jsonify({'error': 'No completed downloads match'}), 404
+    
+    if archive_format == 'zip':
+        body = stream_zip(entries, compress=values.get('compress', 'false').lower() == 'true')
+        mimetype = 'application/zip'
+    else:
+        body = stream_tar(entries)
+        mimetype = 'application/x-tar'
+    
+    logger.info("Exporting %d files as %s for %s", len(entries), archive_format, session.get('username', 'Unknown'), extra={'user': session.get('username')})
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.headers['Content-Disposition'] = f'attachment; filename="downloads-{time.strftime("%Y%m%d-%H%M%S")}.{archive_format}"'
+    response.cache_control.no_store = True
+    return response
 
 @app.route('/api/download/<download_id>')
 def get_download(download_id):
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
     
-    download = download_manager.get_download_status(download_id)
+    download = jobs.get_download_status(download_id)
+    if download:
+        return jsonify(download)
+    return jsonify({'error': 'Download not found'}), 404
+
+@app.route('/api/download/<download_id>/wait')
+def wait_download(download_id):
+    """Long-poll: answer once the job leaves ?status= (by default its current status) or after ?timeout= seconds"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        timeout = max(0.0, min(float(request.args.get('timeout', 30)), app.config['WAIT_MAX_TIMEOUT']))
+    except ValueError:
+        return jsonify({'error': 'Invalid timeout'}), 400
+    
+    if not wait_slots.acquire(blocking=False):
+        return _too_many_requests(AdmissionError("Too many requests are waiting on downloads", retry_after=1))
+    try:
+        download = jobs.wait_for_change(download_id, status=request.args.get('status') or None, timeout=timeout)
+    finally:
+        wait_slots.release()
+    
     if download:
         return jsonify(download)
     return jsonify({'error': 'Download not found'}), 404
@@ -121,17 +767,162 @@ def cancel_download(download_id):
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
     
-    result = download_manager.cancel_download(download_id)
-    logger.info(f"Download cancelled: {download_id}, result: {result}")
+    result = jobs.cancel_download(download_id)
+    logger.info("Download cancelled: %s, result: %s", download_id, result, extra={'job_id': download_id})
+    return jsonify({'success': result})
+
+@app.route('/api/download/<download_id>/retry', methods=['POST'])
+def retry_download(download_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        result = jobs.retry_download(download_id)
+    except AdmissionError as e:
+        return _too_many_requests(e)
+    logger.info("Download retried: %s, result: %s", download_id, result, extra={'job_id': download_id})
+    return jsonify({'success': result})
+
+@app.route('/api/download/<download_id>/pin', methods=['POST'])
+def pin_download(download_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    pinned = request.form.get('pinned', 'true').lower() == 'true'
+    result = download_manager.pin_download(download_id, pinned)
+    logger.info("Download %s: %s, result: %s", 'pinned' if pinned else 'unpinned', download_id, result, extra={'job_id': download_id})
     return jsonify({'success': result})
 
+@app.route('/api/stats')
+def get_stats():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    return jsonify({
+        'retention': retention.stats() if retention else None,
+        'cluster': cluster.get_stats() if cluster else None,
+        'http2': http2_pool.stats() if http2_pool else None,
+        'url_cache': url_cache.stats() if url_cache else None,
+        'dns_cache': dns_cache.stats() if dns_cache else None,
+        'hosts': download_manager.host_profiles.stats(),
+        'admission': download_manager.get_admission_stats(),
+        'watchdog': download_manager.get_watchdog_stats(),
+        'webhooks': webhooks.get_stats() if webhooks else None,
+        'users': download_manager.get_user_stats(),
+        'windows': download_manager.get_window_stats(),
+        'files': file_index.get_stats() if file_index else None,
+        'logging': get_log_stats(log_listener)
+    })
+
+@app.route('/api/files')
+def list_files():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    if not file_index:
+        return jsonify({'error': 'The file index is disabled'}), 404
+    
+    sort = request.args.get('sort', 'name')
+    if sort not in SORT_KEYS:
+        return jsonify({'error': f"sort must be one of {', '.join(SORT_KEYS)}"}), 400
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = max(1, min(int(request.args.get('limit', 100)), MAX_PAGE))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    
+    total, files = file_index.query(
+        search=request.args.get('q'),
+        prefix=request.args.get('dir'),
+        sort=sort,
+        descending=request.args.get('order', 'asc').lower() == 'desc',
+        offset=offset,
+        limit=limit
+    )
+    for entry in files:
+        entry['url'] = '/downloads/' + quote(entry['name'])
+    return jsonify({
+        'files': files,
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'complete': file_index.ready  # False while the first walk of DOWNLOAD_DIR is still running
+    })
+
+def _admin_error():
+    """Error response unless the session belongs to an admin"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not logged in'}), 401
+    if session.get('username') not in app.config['ADMIN_USERS']:
+        return jsonify({'error': 'Admin only'}), 403
+    return None
+
+@app.route('/api/admin/threads')
+def admin_threads():
+    error = _admin_error()
+    if error:
+        return error
+    
+    stacks = thread_stacks()
+    return jsonify({'threads': stacks, 'count': len(stacks)})
+
+@app.route('/api/admin/profile')
+def admin_profile():
+    """Sample every thread for a while; the body is collapsed stacks for flamegraph.pl or speedscope"""
+    error = _admin_error()
+    if error:
+        return error
+    
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = max(0.001, float(request.args.get('interval', 10)) / 1000)
+    except ValueError:
+        return jsonify({'error': 'seconds and interval must be numbers'}), 400
+    
+    logger.info("Profiling all threads for %ss for %s", seconds, session['username'], extra={'user': session['username']})
+    try:
+        body = profiler.profile(max(0.0, seconds), interval)
+    except ProfilerBusy as e:
+        return jsonify({'error': str(e)}), 409
+    response = Response(body, mimetype='text/plain')
+    response.headers['Content-Disposition'] = f'attachment; filename="profile-{time.strftime("%Y%m%d-%H%M%S")}.folded"'
+    return response
+
+@app.route('/api/admin/memory')
+def admin_memory():
+    error = _admin_error()
+    if error:
+        return error
+    
+    return jsonify({
+        'allocations': allocation_report(),
+        'registries': download_manager.get_memory_stats()
+    })
+
+@app.route('/api/admin/memory/tracing', methods=['POST'])
+def admin_memory_tracing():
+    """Turn allocation tracing on or off; it slows every allocation while on"""
+    error = _admin_error()
+    if error:
+        return error
+    
+    enabled = request.form.get('enabled', 'true').lower() == 'true'
+    if enabled:
+        try:
+            start_tracing(max(1, int(request.form.get('frames', 1))))
+        except ValueError:
+            return jsonify({'error': 'frames must be an integer'}), 400
+    else:
+        stop_tracing()
+    logger.info("Allocation tracing %s by %s", 'started' if enabled else 'stopped', session['username'], extra={'user': session['username']})
+    return jsonify({'success': True})
+
 @app.route('/api/downloads/clear_history', methods=['POST'])
 def clear_history():
     if not session.get('logged_in'):
         return jsonify({'error': 'Not logged in'}), 401
     
-    result = download_manager.clear_download_history()
-    logger.info(f"Download history cleared by {session.get('username', 'Unknown')}")
+    result = jobs.clear_download_history()
+    logger.info("Download history cleared by %s", session.get('username', 'Unknown'), extra={'user': session.get('username')})
     return jsonify({'success': result})
 
 @app.route('/downloads/<path:filename>')
@@ -140,25 +931,50 @@ def download_file(filename):
     
     # Secure against path traversal attacks
     if '..' in filename or filename.startswith('/'):
-        logger.warning(f"Possible path traversal attempt: {filename}")
+        logger.warning("Possible path traversal attempt: %s", filename, extra={'ip': request.remote_addr})
         return "Invalid filename", 400
-        
-    download_dir = app.config['DOWNLOAD_DIR']
-    logger.info(f"File download requested: {filename}")
     
-    # Check if file exists
-    file_path = os.path.join(download_dir, filename)
-    if not os.path.isfile(file_path):
-        logger.warning(f"File not found: {filename}")
+    # Check if file exists; sharded layouts find it through the storage index
+    file_path = download_manager.resolve_file(filename)
+    if not file_path or not os.path.isfile(file_path):
+        # Still downloading: stream what is on disk and follow the download
+        download_id = download_manager.find_active_download(filename)
+        if download_id:
+            return _stream_active_download(download_id, filename)
+        
         return "File not found", 404
     
-    # Log the download
-    user = session.get('username', 'Anonymous')
-    ip = request.remote_addr
-    logger.info(f"File download: {filename} by {user} from {ip}")
+    download_manager.touch_file(file_path)
     
     # Send the file as attachment
-    return send_from_directory(download_dir, filename, as_attachment=True)
+    return send_from_directory(os.path.dirname(file_path), os.path.basename(file_path), as_attachment=True)
+
+def _stream_active_download(download_id, filename):
+    """Stream-through response for a file that is still being downloaded"""
+    logger.info(
+        "Streaming in-progress download: %s (ID: %s) to %s", filename, download_id, request.remote_addr,
+        extra={'job_id': download_id, 'ip': request.remote_addr}
+    )
+    
+    basename = os.path.basename(filename)
+    try:
+        basename.encode('ascii')
+        disposition = f'attachment; filename="{basename}"'
+    except UnicodeEncodeError:
+        disposition = f"attachment; filename*=UTF-8''{quote(basename)}"
+    
+    response = Response(
+        download_manager.stream_download(download_id),
+        mimetype='application/octet-stream',
+        direct_passthrough=True
+    )
+    response.headers['Content-Disposition'] = disposition
+    response.cache_control.no_store = True
+    
+    status = download_manager.get_download_status(download_id)
+    if status and status['size']:
+        response.content_length = status['size']
+    return response
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -166,8 +982,9 @@ def not_found_error(error):
 
 @app.errorhandler(500)
 def internal_error(error):
-    logger.error(f"Internal error: {str(error)}")
+    logger.error("Internal error: %s", error)
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
+    logger.info("Listening on port %d", 5000)
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,99 @@
+import os
+import tarfile
+import zipfile
+
+# Bytes read from a source file at a time; bounds the memory of an export
+READ_SIZE = 1024 * 1024
+
+
+class _StreamBuffer:
+    """Write-only file object that holds what was written until it is drained.
+
+    It has tell() but no seek(), so zipfile treats it as unseekable and
+    writes data descriptors instead of going back to patch local headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries, compress=False):
+    """Yield a ZIP archive of (path, arcname) entries, built on the fly.
+
+    Entries are stored uncompressed unless compress is set. Files that
+    disappear before their turn are skipped.
+    """
+    buffer = _StreamBuffer()
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+    with zipfile.ZipFile(buffer, 'w', compression=compression, allowZip64=True) as archive:
+        for path, arcname in entries:
+            try:
+                source = open(path, 'rb')
+                info = zipfile.ZipInfo.from_file(path, arcname)
+            except OSError:
+                continue
+            info.compress_type = compression
+
+            with source, archive.open(info, 'w') as dest:
+                for block in iter(lambda: source.read(READ_SIZE), b''):
+                    dest.write(block)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+
+    # Central directory
+    yield buffer.drain()
+
+
+def stream_tar(entries):
+    """Yield an uncompressed TAR archive of (path, arcname) entries, built on the fly"""
+    for path, arcname in entries:
+        try:
+            source = open(path, 'rb')
+        except OSError:
+            continue
+
+        with source:
+            stat = os.fstat(source.fileno())
+            info = tarfile.TarInfo(arcname)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            yield info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+            remaining = info.size
+            while remaining:
+                block = source.read(min(READ_SIZE, remaining))
+                if not block:
+                    # The file shrank after its header went out; pad to keep the archive valid
+                    block = b'\0' * min(READ_SIZE, remaining)
+                remaining -= len(block)
+                yield block
+
+            padding = -info.size % tarfile.BLOCKSIZE
+            if padding:
+                yield b'\0' * padding
+
+    # End-of-archive marker
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
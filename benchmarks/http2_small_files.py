@@ -0,0 +1,185 @@
+"""Compare the requests and http2 engines on many small files from one origin.
+
+Starts a local server that speaks HTTP/1.1 and cleartext HTTP/2 (h2c with
+prior knowledge) on the same port, queues the same set of small objects
+through DownloadManager once per engine, and reports wall time, throughput
+and how many TCP connections each engine opened.
+
+    python benchmarks/http2_small_files.py --files 500 --size 16384 --connect-latency 0.02
+
+--connect-latency delays every new connection to stand in for the TCP and
+TLS handshake round trips to a remote CDN, which is the cost multiplexing
+saves; on loopback without it the two engines are close.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from download_manager import DownloadManager  # noqa: E402
+from http2 import Http2Pool  # noqa: E402
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+class BenchmarkServer:
+    """HTTP/1.1 and h2c server returning size bytes for every GET"""
+
+    def __init__(self, size, connect_latency):
+        self.body = os.urandom(size)
+        self.connect_latency = connect_latency
+        self.connections = {'HTTP/1.1': 0, 'HTTP/2': 0}
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, '127.0.0.1', 0))
+            self.port = server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+    async def handle(self, reader, writer):
+        await asyncio.sleep(self.connect_latency)
+        try:
+            head = await reader.readexactly(len(PREFACE))
+        except asyncio.IncompleteReadError:
+            writer.close()
+            return
+        try:
+            if head == PREFACE:
+                self.connections['HTTP/2'] += 1
+                await self.serve_h2(head, reader, writer)
+            else:
+                self.connections['HTTP/1.1'] += 1
+                await self.serve_h1(head, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_h1(self, data, reader, writer):
+        while True:
+            while b'\r\n\r\n' not in data:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                data += chunk
+            request, data = data.split(b'\r\n\r\n', 1)
+            method = request.split(b' ', 1)[0]
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n'
+                + f'Content-Length: {len(self.body)}\r\n\r\n'.encode()
+                + (self.body if method == b'GET' else b'')
+            )
+            await writer.drain()
+
+    async def serve_h2(self, data, reader, writer):
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        pending = []
+
+        while True:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    method = dict(event.headers).get(b':method', b'GET')
+                    conn.send_headers(event.stream_id, [
+                        (':status', '200'),
+                        ('content-type', 'application/octet-stream'),
+                        ('content-length', str(len(self.body)))
+                    ], end_stream=method == b'HEAD')
+                    if method != b'HEAD':
+                        pending.append([event.stream_id, 0])
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    return
+
+            # Send as much of each pending body as flow control allows
+            for item in list(pending):
+                stream_id, offset = item
+                while offset < len(self.body):
+                    try:
+                        window = min(conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+                    except h2.exceptions.StreamClosedError:
+                        offset = len(self.body)
+                        break
+                    if window <= 0:
+                        break
+                    chunk = self.body[offset:offset + window]
+                    offset += len(chunk)
+                    conn.send_data(stream_id, chunk, end_stream=offset == len(self.body))
+                item[1] = offset
+                if offset == len(self.body):
+                    pending.remove(item)
+
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            data = await reader.read(65536)
+            if not data:
+                return
+
+
+def run_engine(engine, port, files, http2_pool):
+    """Download every file with one engine; returns the elapsed seconds and failures"""
+    root = tempfile.mkdtemp(prefix=f'fdl-bench-{engine}-')
+    try:
+        manager = DownloadManager(os.path.join(root, 'downloads'), os.path.join(root, 'temp'),
+                                  os.path.join(root, 'state'), http2=http2_pool)
+        start = time.time()
+        ids = [
+            manager.add_download(f'http://127.0.0.1:{port}/{engine}/file{i}.bin', engine=engine, split=1)
+            for i in range(files)
+        ]
+        while True:
+            statuses = [manager.get_download_status(i)['status'] for i in ids]
+            if all(status in ('completed', 'error', 'cancelled') for status in statuses):
+                break
+            time.sleep(0.05)
+        return time.time() - start, sum(1 for status in statuses if status != 'completed')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--size', type=int, default=16 * 1024, help='bytes per file')
+    parser.add_argument('--connect-latency', type=float, default=0.02, help='seconds added to every new connection')
+    parser.add_argument('--connections-per-origin', type=int, default=2)
+    args = parser.parse_args()
+
+    server = BenchmarkServer(args.size, args.connect_latency)
+    server.start()
+    pool = Http2Pool(connections_per_origin=args.connections_per_origin, cleartext=True)
+
+    print(f"{args.files} files of {args.size} bytes, {args.connect_latency * 1000:.0f} ms per new connection")
+    for engine in ('requests', 'http2'):
+        before = dict(server.connections)
+        elapsed, failed = run_engine(engine, server.port, args.files, pool)
+        opened = {proto: server.connections[proto] - before[proto] for proto in before}
+        print(
+            f"{engine:>8}: {elapsed:6.2f}s  {args.files / elapsed:7.1f} files/s  "
+            f"{args.files * args.size / elapsed / 1024 / 1024:6.1f} MiB/s  "
+            f"connections h1={opened['HTTP/1.1']} h2={opened['HTTP/2']}  failed={failed}"
+        )
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import closing, contextmanager
+from urllib.parse import urlparse, unquote
+
+from metalink import parse_metalink, file_basename
+from admission import AdmissionError
+from fairshare import DEFAULT_WEIGHT
+
+logger = logging.getLogger('fdl_server.cluster')
+
+# Seconds a node may go without renewing its claim before other nodes take the job over
+LEASE_SECONDS = 30
+
+# Seconds between a node's heartbeat, progress publication and queue polls
+SYNC_INTERVAL = 1.0
+
+# Job states in the shared queue
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED_STATES = ('completed', 'error', 'cancelled')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    request TEXT NOT NULL,
+    state TEXT NOT NULL,
+    node TEXT,
+    lease_expires REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    not_before REAL,
+    snapshot TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, created);
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    slots INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+'''
+
+
+class ClusterNode:
+    """One member of a cluster of FDL-Server nodes sharing a job queue.
+
+    The queue is a SQLite database on storage every node can reach. Jobs are
+    submitted to the database rather than started locally; each node claims
+    queued jobs up to its slot count with a lease, runs them through its own
+    DownloadManager and publishes their progress back to the database, so
+    any node can list the whole cluster. Free slots go to the user running
+    the fewest jobs for their weight, so USER_WEIGHTS shares out the cluster
+    as it does a single node. A node that stops renewing its leases has its
+    jobs claimed by the others, which resume them from the last published
+    segments when TEMP_DIR is shared as well.
+    """
+
+    def __init__(self, db_path, download_manager, node_id=None, slots=4, lease_seconds=LEASE_SECONDS,
+                 max_queue_depth=0, user_weights=None):
+        self.db_path = os.path.abspath(db_path)
+        self.manager = download_manager
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.slots = slots
+        self.lease_seconds = lease_seconds
+        self.max_queue_depth = max_queue_depth  # Unfinished jobs across the cluster; 0 is unlimited
+        self.user_weights = dict(user_weights or {})  # User -> share of the cluster's slots
+        self.running = set()  # Ids of the jobs this node has claimed
+        self.published = {}  # Last snapshot written per running job, to skip unchanged updates
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        with closing(self._connect()) as db:
+            db.executescript(SCHEMA)
+        with self._transaction() as db:
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            if 'not_before' not in columns:
+                # Databases created before jobs could be held back
+                db.execute('ALTER TABLE jobs ADD COLUMN not_before REAL')
+
+        thread = threading.Thread(target=self._run, name='cluster-sync')
+        thread.daemon = True
+        thread.start()
+
+    def _connect(self):
+        """Open a connection; each caller uses its own so threads never share one"""
+        # Rollback journal rather than WAL: WAL needs shared memory, which network filesystems lack
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction that takes the database lock up front, so claims cannot race"""
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def submit(self, url, use_aria2=True, mirrors=None, retry=None, split=None, engine=None, subdir=None, filename=None,
+               postprocess=None, callback_url=None, user=None, not_before=None, window=None):
+        """Queue a download for whichever node has a free slot"""
+        request = {
+            'url': url,
+            'mirrors': mirrors or [],
+            'use_aria2': use_aria2,
+            'retry': retry,
+            'split': split,
+            'engine': engine,
+            'subdir': subdir,
+            'filename': filename,
+            'postprocess': postprocess,
+            'callback_url': callback_url,
+            'user': user,
+            'not_before': not_before,
+            'window': window
+        }
+        name = filename or os.path.basename(unquote(urlparse(url).path))
+        if subdir:
+            name = f"{subdir}/{name}"
+        with self._transaction() as db:
+            self._admit(db)
+            return self._insert_job(db, request, name, [url] + list(mirrors or []), use_aria2, engine=engine)
+
+    def submit_metalink(self, data, use_aria2=True, retry=None, split=None, engine=None, user=None, not_before=None,
+                        window=None, callback_url=None, postprocess=None):
+        """Queue one job per file of a Metalink document; the document is stored once"""
+        files = parse_metalink(data)
+        digest = hashlib.sha256(data).hexdigest()
+
+        download_ids = []
+        with self._transaction() as db:
+            self._admit(db, len(files))
+            db.execute('INSERT OR IGNORE INTO documents (digest, data) VALUES (?, ?)', (digest, data))
+            for index, entry in enumerate(files, start=1):
+                urls = entry['urls']
+                if not use_aria2 or engine not in (None, 'aria2'):
+                    # Same filter as DownloadManager.add_metalink, so the claiming node finds a job to create
+                    urls = [url for url in urls if urlparse(url).scheme in ('http', 'https')]
+                    if not urls:
+                        continue
+                request = {
+                    'metalink': digest,
+                    'metalink_index': index,
+                    'use_aria2': use_aria2,
+                    'retry': retry,
+                    'split': split,
+                    'engine': engine,
+                    'user': user,
+                    'not_before': not_before,
+                    'window': window,
+                    'callback_url': callback_url,
+                    'postprocess': postprocess
+                }
+                download_ids.append(
+                    self._insert_job(db, request, file_basename(entry['name']), urls, use_aria2, entry['size'], engine)
+                )
+        return download_ids
+
+    def _admit(self, db, count=1):
+        """Refuse new work once the cluster queue is full"""
+        if not self.max_queue_depth:
+            return
+        (depth,) = db.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)', (QUEUED, RUNNING)).fetchone()
+        if depth + count > self.max_queue_depth:
+            raise AdmissionError(f"Cluster download queue is full ({self.max_queue_depth} jobs)", retry_after=10)
+
+    def _insert_job(self, db, request, filename, urls, use_aria2, size=0, engine=None):
+        """Add a queued job with a placeholder snapshot for listings until a node claims it"""
+        download_id = str(uuid.uuid4())
+        now = time.time()
+        snapshot = {
+            'id': download_id,
+            'url': urls[0],
+            'urls': urls,
+            'filename': filename or f"download_{download_id[:8]}",
+            'start_time': now,
+            'end_time': None,
+            'progress': 0,
+            'status': QUEUED,
+            'error': None,
+            'size': size,
+            'downloaded': 0,
+            'speed': '0 B/s',
+            'engine': engine or ('aria2' if use_aria2 else 'requests'),
+            'retries': 0,
+            'node': None
+        }
+        db.execute(
+            'INSERT INTO jobs (id, request, state, not_before, snapshot, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (download_id, json.dumps(request), QUEUED, request.get('not_before'), json.dumps(snapshot), now, now)
+        )
+        return download_id
+
+    def _run(self):
+        """Heartbeat, publish local progress and claim work until stopped"""
+        while not self.stopped.is_set():
+            try:
+                self._sync_running()
+                self._claim_jobs()
+                self._heartbeat()
+            except sqlite3.Error as e:
+                logger.error("Cluster sync failed: %s", e)
+            self.stopped.wait(SYNC_INTERVAL)
+
+    def _heartbeat(self):
+        """Record that this node is alive and how busy it is"""
+        with self.lock:
+            running = len(self.running)
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO nodes (id, host, slots, running, heartbeat) VALUES (?, ?, ?, ?, ?)',
+                (self.node_id, socket.gethostname(), self.slots, running, time.time())
+            )
+
+    def _sync_running(self):
+        """Renew leases, publish progress and act on cancel requests for the jobs run here"""
+        with self.lock:
+            download_ids = list(self.running)
+
+        for download_id in download_ids:
+            status = self.manager.get_download_status(download_id)
+            if status is None:
+                with self.lock:
+                    self.running.discard(download_id)
+                continue
+
+            status['node'] = self.node_id
+            finished = status['status'] in FINISHED_STATES
+            snapshot = json.dumps(status)
+            now = time.time()
+
+            with self._transaction() as db:
+                row = db.execute('SELECT node, cancel_requested FROM jobs WHERE id = ?', (download_id,)).fetchone()
+                if row is None or row['node'] != self.node_id:
+                    # Deleted, or taken over after this node missed its lease; stop the duplicate
+                    lost = True
+                else:
+                    lost = False
+                    if snapshot == self.published.get(download_id):
+                        db.execute('UPDATE jobs SET lease_expires = ? WHERE id = ?', (now + self.lease_seconds, download_id))
+                    else:
+                        db.execute(
+                            'UPDATE jobs SET state = ?, snapshot = ?, lease_expires = ?, updated = ? WHERE id = ?',
+                            (status['status'] if finished else RUNNING, snapshot, now + self.lease_seconds, now, download_id)
+                        )
+                        self.published[download_id] = snapshot
+
+            if lost:
+                self.manager.release_download(download_id, "Claimed by another cluster node")
+            elif row['cancel_requested'] and not finished:
+                self.manager.cancel_download(download_id)
+                continue  # Publish the cancelled state on the next pass
+            elif status['status'] == 'scheduled' and self.manager.release_scheduled(download_id):
+                # Deferred to a window or start time; back to the queue so it holds no slot while it waits
+                status['node'] = None
+                self._requeue(download_id, status['starts_at'], status)
+                self.published.pop(download_id, None)
+                continue
+
+            if lost or finished:
+                with self.lock:
+                    self.running.discard(download_id)
+                self.published.pop(download_id, None)
+
+    def _claim_jobs(self):
+        """Claim queued jobs, and jobs whose node stopped renewing its lease, while slots are free"""
+        while True:
+            with self.lock:
+                if len(self.running) >= self.slots:
+                    return
+
+            now = time.time()
+            with self._transaction() as db:
+                # Oldest claimable job of each user; SQLite fills the bare columns from the row with MIN(created)
+                candidates = db.execute(
+                    "SELECT id, request, snapshot, node, json_extract(request, '$.user') AS user, MIN(created) AS created "
+                    'FROM jobs WHERE (state = ? AND (not_before IS NULL OR not_before <= ?)) OR (state = ? AND lease_expires < ?) '
+                    'GROUP BY user',
+                    (QUEUED, now, RUNNING, now)
+                ).fetchall()
+                if not candidates:
+                    return
+                running = dict(db.execute(
+                    "SELECT json_extract(request, '$.user'), COUNT(*) FROM jobs WHERE state = ? AND lease_expires >= ? GROUP BY 1",
+                    (RUNNING, now)
+                ).fetchall())
+                # Weighted fair share across the cluster: the user running the fewest jobs for their weight goes next
+                row = min(candidates, key=lambda row: (running.get(row['user'], 0) / self._weight(row['user']), row['created']))
+                db.execute(
+                    'UPDATE jobs SET state = ?, node = ?, lease_expires = ?, cancel_requested = 0, updated = ? WHERE id = ?',
+                    (RUNNING, self.node_id, now + self.lease_seconds, now, row['id'])
+                )
+
+            if row['node'] and row['node'] != self.node_id:
+                logger.info("Taking over download %s from node %s", row['id'], row['node'], extra={'job_id': row['id'], 'node': row['node']})
+
+            with self.lock:
+                self.running.add(row['id'])
+            try:
+                self._start_local(row['id'], json.loads(row['request']), json.loads(row['snapshot']))
+            except AdmissionError as e:
+                # This node is saturated or the user's quota is used up; hold the job back rather than reclaim it every pass
+                logger.info("Requeueing download %s for %ss: %s", row['id'], e.retry_after, e, extra={'job_id': row['id']})
+                self._requeue(row['id'], time.time() + e.retry_after)
+                return
+            except Exception as e:
+                logger.error("Failed to start download %s: %s", row['id'], e, extra={'job_id': row['id']})
+                self._publish_failure(row['id'], json.loads(row['snapshot']), e)
+
+    def _weight(self, user):
+        return self.user_weights.get(user, DEFAULT_WEIGHT)
+
+    def _start_local(self, download_id, request, resume):
+        """Run a claimed job on this node's DownloadManager"""
+        local = self.manager.get_download_status(download_id)
+        if local is not None:
+            # Retried after failing here; the partial file is already on this node
+            if local['status'] in ('error', 'cancelled') and not self.manager.retry_download(download_id):
+                raise RuntimeError("The previous run has not stopped yet")
+            return
+
+        if 'metalink' in request:
+            with closing(self._connect()) as db:
+                row = db.execute('SELECT data FROM documents WHERE digest = ?', (request['metalink'],)).fetchone()
+            if row is None:
+                raise RuntimeError("Metalink document is missing from the cluster database")
+            created = self.manager.add_metalink(
+                row['data'],
+                use_aria2=request['use_aria2'],
+                retry=request['retry'],
+                split=request['split'],
+                select=request['metalink_index'],
+                download_id=download_id,
+                resume=resume,
+                engine=request.get('engine'),
+                user=request.get('user'),
+                not_before=request.get('not_before'),
+                window=request.get('window'),
+                callback_url=request.get('callback_url'),
+                postprocess=request.get('postprocess')
+            )
+            if not created:
+                raise RuntimeError("Metalink file has no usable sources")
+        else:
+            self.manager.add_download(
+                request['url'],
+                use_aria2=request['use_aria2'],
+                mirrors=request['mirrors'],
+                retry=request['retry'],
+                split=request['split'],
+                download_id=download_id,
+                resume=resume,
+                engine=request.get('engine'),
+                subdir=request.get('subdir'),
+                filename=request.get('filename'),
+                postprocess=request.get('postprocess'),
+                callback_url=request.get('callback_url'),
+                user=request.get('user'),
+                not_before=request.get('not_before'),
+                window=request.get('window')
+            )
+
+    def _requeue(self, download_id, not_before=None, snapshot=None):
+        """Give a claimed job back to the queue, for no node to claim before not_before"""
+        with self.lock:
+            self.running.discard(download_id)
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, node = NULL, lease_expires = NULL, not_before = ?, '
+                'snapshot = COALESCE(?, snapshot), updated = ? WHERE id = ? AND node = ?',
+                (QUEUED, not_before, json.dumps(snapshot) if snapshot else None, time.time(), download_id, self.node_id)
+            )
+
+    def _publish_failure(self, download_id, snapshot, error):
+        """Record a job that could not be started on this node"""
+        snapshot.update({'status': 'error', 'error': str(error), 'end_time': time.time(), 'node': self.node_id})
+        with self.lock:
+            self.running.discard(download_id)
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, snapshot = ?, updated = ? WHERE id = ? AND node = ?',
+                ('error', json.dumps(snapshot), time.time(), download_id, self.node_id)
+            )
+
+    def get_download_status(self, download_id):
+        """Latest published status of a job, wherever it runs"""
+        local = self.manager.get_download_status(download_id)
+        if local is not None:
+            # Fresher than the database for jobs running here
+            local['node'] = self.node_id
+            return local
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT snapshot FROM jobs WHERE id = ?', (download_id,)).fetchone()
+        return json.loads(row['snapshot']) if row else None
+
+    def wait_for_change(self, download_id, status=None, timeout=30):
+        """Like DownloadManager.wait_for_change, following the published status of a job on any node"""
+        deadline = time.monotonic() + timeout
+        snapshot = self.get_download_status(download_id)
+        if snapshot is None:
+            return None
+        if status is None:
+            if snapshot['status'] in FINISHED_STATES:
+                return snapshot
+            status = snapshot['status']
+        while snapshot['status'] == status and time.monotonic() < deadline:
+            time.sleep(min(SYNC_INTERVAL, max(0, deadline - time.monotonic())))
+            snapshot = self.get_download_status(download_id) or snapshot
+        return snapshot
+
+    def get_all_downloads(self, history_offset=0, history_limit=None):
+        """Every job in the cluster, in the same shape as DownloadManager.get_all_downloads"""
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT snapshot FROM jobs ORDER BY created DESC').fetchall()
+
+        active = [json.loads(row['snapshot']) for row in rows]
+        history = [job for job in active if job['status'] == 'completed']
+        end = None if history_limit is None else history_offset + history_limit
+        return {
+            'active': active,
+            'history': history[history_offset:end],
+            'history_total': len(history),
+            'history_offset': history_offset
+        }
+
+    def cancel_download(self, download_id):
+        """Cancel a job; queued jobs are cancelled at once, running ones by their node"""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT state, snapshot FROM jobs WHERE id = ?', (download_id,)).fetchone()
+            if row is None or row['state'] in FINISHED_STATES:
+                return False
+            if row['state'] == QUEUED:
+                snapshot = json.loads(row['snapshot'])
+                snapshot.update({'status': 'cancelled', 'end_time': now})
+                db.execute(
+                    'UPDATE jobs SET state = ?, snapshot = ?, updated = ? WHERE id = ?',
+                    ('cancelled', json.dumps(snapshot), now, download_id)
+                )
+            else:
+                db.execute('UPDATE jobs SET cancel_requested = 1, updated = ? WHERE id = ?', (now, download_id))
+        return True
+
+    def retry_download(self, download_id):
+        """Put a failed or cancelled job back on the queue; the next node to claim it resumes it"""
+        with self._transaction() as db:
+            row = db.execute('SELECT state, snapshot FROM jobs WHERE id = ?', (download_id,)).fetchone()
+            if row is None or row['state'] not in ('error', 'cancelled'):
+                return False
+            self._admit(db)
+            snapshot = json.loads(row['snapshot'])
+            snapshot.update({'status': QUEUED, 'error': None, 'end_time': None})
+            db.execute(
+                'UPDATE jobs SET state = ?, snapshot = ?, cancel_requested = 0, updated = ? WHERE id = ?',
+                (QUEUED, json.dumps(snapshot), time.time(), download_id)
+            )
+        return True
+
+    def clear_download_history(self):
+        """Drop completed jobs from the shared queue"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM jobs WHERE state = ?', ('completed',))
+            # Documents no remaining job refers to
+            db.execute(
+                "DELETE FROM documents WHERE digest NOT IN "
+                "(SELECT json_extract(request, '$.metalink') FROM jobs WHERE json_extract(request, '$.metalink') IS NOT NULL)"
+            )
+        return True
+
+    def get_stats(self):
+        """Nodes and queue depth of the cluster"""
+        now = time.time()
+        with closing(self._connect()) as db:
+            nodes = [dict(row) for row in db.execute('SELECT * FROM nodes ORDER BY id')]
+            states = dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        for node in nodes:
+            node['alive'] = now - node['heartbeat'] < self.lease_seconds
+        return {
+            'node_id': self.node_id,
+            'nodes': nodes,
+            'jobs': states
+        }
@@ -0,0 +1,286 @@
+import codecs
+import logging
+import posixpath
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+from html.parser import HTMLParser
+from urllib.parse import unquote, urldefrag, urljoin, urlsplit
+
+import requests
+
+from admission import AdmissionError
+
+logger = logging.getLogger('fdl_server.crawler')
+
+# Index pages fetched at once per crawl
+PAGE_WORKERS = 4
+
+# Directory levels below the starting URL that are followed, and files queued per crawl
+MAX_DEPTH = 5
+MAX_FILES = 10000
+
+# Index pages are parsed as they stream in; anything bigger is not an autoindex
+MAX_PAGE_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+INDEX_CONTENT_TYPES = {'text/html', 'application/xhtml+xml'}
+
+# Finished crawls kept for listing
+MAX_FINISHED = 50
+
+# Page errors kept per crawl
+MAX_ERRORS = 20
+
+
+class CrawlError(Exception):
+    """Raised when a URL is not a directory index that can be crawled"""
+
+
+class LinkParser(HTMLParser):
+    """Collects the href of every <a> tag of a page that is fed in chunks"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+
+
+def split_patterns(value):
+    """Glob patterns from a comma or whitespace separated form field"""
+    return [pattern for pattern in (value or '').replace(',', ' ').split() if pattern]
+
+
+def matches(patterns, relative):
+    """Whether a path relative to the crawl root, or its basename, matches any pattern"""
+    name = posixpath.basename(relative)
+    return any(fnmatch(relative, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+
+class Crawler:
+    """Mirrors Apache/nginx-style directory listings into the download queue.
+
+    Each crawl walks the index pages below a directory URL breadth-first,
+    fetching up to PAGE_WORKERS pages at once and parsing them as they
+    stream in. Links that leave the starting directory (parent links,
+    sort-order queries, other hosts) are ignored. Every file that passes the
+    include/exclude patterns is handed to the crawl's submit callable with
+    its directory relative to the root, so the remote tree is recreated under
+    DOWNLOAD_DIR. When the queue is full the crawl waits as long as the
+    AdmissionError asks before submitting again.
+    """
+
+    def __init__(self, page_workers=PAGE_WORKERS, max_depth=MAX_DEPTH, max_files=MAX_FILES):
+        self.page_workers = page_workers
+        self.max_depth = max_depth
+        self.max_files = max_files
+        self.crawls = {}
+        self.stop_events = {}
+        self.lock = threading.Lock()
+
+    def start(self, url, submit, include=None, exclude=None, max_depth=None):
+        """Start crawling the directory at url; submit(url, subdir, filename) queues one file"""
+        # The root is a directory, so relative links resolve below it
+        if not urlsplit(url).path.endswith('/'):
+            url += '/'
+        depth = self.max_depth if max_depth is None else max(0, min(max_depth, self.max_depth))
+
+        crawl_id = str(uuid.uuid4())
+        crawl = {
+            'id': crawl_id,
+            'url': url,
+            'include': list(include or []),
+            'exclude': list(exclude or []),
+            'max_depth': depth,
+            'status': 'crawling',
+            'start_time': time.time(),
+            'end_time': None,
+            'pages': 0,  # Index pages parsed
+            'files': 0,  # Files queued for download
+            'skipped': 0,  # Files filtered out by the patterns
+            'waits': 0,  # Times the crawl backed off a full queue
+            'truncated': False,  # Stopped at the file limit
+            'errors': [],
+            'error': None
+        }
+        with self.lock:
+            self.crawls[crawl_id] = crawl
+            self.stop_events[crawl_id] = threading.Event()
+            self._prune()
+
+        thread = threading.Thread(target=self._run, args=(crawl_id, submit), name=f"crawl-{crawl_id[:8]}")
+        thread.daemon = True
+        thread.start()
+        return crawl_id
+
+    def _prune(self):
+        """Forget the oldest finished crawls. Caller must hold self.lock."""
+        finished = [crawl for crawl in self.crawls.values() if crawl['end_time']]
+        finished.sort(key=lambda crawl: crawl['end_time'])
+        for crawl in finished[:max(0, len(finished) - MAX_FINISHED)]:
+            del self.crawls[crawl['id']]
+            self.stop_events.pop(crawl['id'], None)
+
+    def _run(self, crawl_id, submit):
+        crawl = self.crawls[crawl_id]
+        stop = self.stop_events[crawl_id]
+        root = crawl['url']
+        seen = {root}
+        pool = ThreadPoolExecutor(max_workers=self.page_workers, thread_name_prefix=f"crawl-{crawl_id[:8]}")
+        try:
+            futures = {pool.submit(self._read_index, root, stop): 0}
+            while futures and not stop.is_set():
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth = futures.pop(future)
+                    try:
+                        page_url, links = future.result()
+                    except (requests.RequestException, CrawlError) as e:
+                        if depth == 0:
+                            raise
+                        self._record_error(crawl, e)
+                        continue
+
+                    directories, files = self._classify(crawl, page_url, links)
+                    with self.lock:
+                        crawl['pages'] += 1
+
+                    for file_url, relative in files:
+                        if not self._submit(crawl, stop, submit, file_url, relative):
+                            break
+                    if depth < crawl['max_depth']:
+                        for directory in directories:
+                            if directory not in seen:
+                                seen.add(directory)
+                                futures[pool.submit(self._read_index, directory, stop)] = depth + 1
+            status, error = ('cancelled' if stop.is_set() and not crawl['truncated'] else 'completed'), None
+        except Exception as e:
+            status, error = 'error', str(e)
+            logger.error("Crawl of %s failed: %s", root, e, extra={'crawl_id': crawl_id})
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        with self.lock:
+            crawl['status'] = status
+            crawl['error'] = error
+            crawl['end_time'] = time.time()
+        logger.info(
+            "Crawl of %s %s: %d pages, %d files queued", root, status, crawl['pages'], crawl['files'],
+            extra={
+                'crawl_id': crawl_id,
+                'pages': crawl['pages'],
+                'files': crawl['files'],
+                'duration': round(crawl['end_time'] - crawl['start_time'], 3)
+            }
+        )
+
+    def _read_index(self, url, stop):
+        """Fetch an index page and return its final URL and the links found in it"""
+        with requests.get(url, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            if content_type.split(';')[0].strip().lower() not in INDEX_CONTENT_TYPES:
+                raise CrawlError(f"{url} is not a directory index ({content_type or 'no content type'})")
+
+            # Without a declared charset, hrefs are far more likely UTF-8 than requests' Latin-1 default
+            encoding = response.encoding if 'charset' in content_type.lower() else 'utf-8'
+            try:
+                decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+            parser = LinkParser()
+            received = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if stop.is_set():
+                    break
+                parser.feed(decoder.decode(chunk))
+                received += len(chunk)
+                if received > MAX_PAGE_SIZE:
+                    raise CrawlError(f"{url} is larger than {MAX_PAGE_SIZE} bytes")
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+            return response.url, parser.links
+
+    def _classify(self, crawl, page_url, links):
+        """Split a page's links into subdirectory URLs and (file URL, relative path) pairs below the root"""
+        root = urlsplit(crawl['url'])
+        # Links resolve against the page's own directory, even if the server redirected to it
+        base = page_url if urlsplit(page_url).path.endswith('/') else page_url + '/'
+
+        directories, files = [], []
+        for href in links:
+            url = urldefrag(urljoin(base, href))[0]
+            parts = urlsplit(url)
+            # Sort links (?C=N;O=D), parent directories and other hosts are not part of the tree
+            if (parts.query or parts.scheme != root.scheme or parts.netloc != root.netloc
+                    or not parts.path.startswith(root.path) or parts.path == root.path):
+                continue
+
+            relative = unquote(parts.path[len(root.path):])
+            if not relative.strip('/') or any(part in ('.', '..') for part in relative.split('/')):
+                continue
+            if parts.path.endswith('/'):
+                if not matches(crawl['exclude'], relative.rstrip('/')):
+                    directories.append(url)
+            elif matches(crawl['exclude'], relative) or (crawl['include'] and not matches(crawl['include'], relative)):
+                with self.lock:
+                    crawl['skipped'] += 1
+            else:
+                files.append((url, relative))
+        return directories, files
+
+    def _submit(self, crawl, stop, submit, url, relative):
+        """Queue one file, waiting out a full queue; returns False once the crawl should stop"""
+        if crawl['files'] >= self.max_files:
+            with self.lock:
+                crawl['truncated'] = True
+            stop.set()
+            return False
+
+        while not stop.is_set():
+            try:
+                submit(url, posixpath.dirname(relative), posixpath.basename(relative))
+            except AdmissionError as e:
+                with self.lock:
+                    crawl['waits'] += 1
+                stop.wait(e.retry_after)
+                continue
+            except Exception as e:
+                self._record_error(crawl, f"{url}: {e}")
+                return True
+            with self.lock:
+                crawl['files'] += 1
+            return True
+        return False
+
+    def _record_error(self, crawl, error):
+        with self.lock:
+            crawl['errors'] = (crawl['errors'] + [str(error)])[-MAX_ERRORS:]
+
+    def cancel(self, crawl_id):
+        """Stop discovering files; downloads already queued keep running"""
+        with self.lock:
+            crawl = self.crawls.get(crawl_id)
+            if not crawl or crawl['end_time']:
+                return False
+            self.stop_events[crawl_id].set()
+            return True
+
+    def get(self, crawl_id):
+        with self.lock:
+            crawl = self.crawls.get(crawl_id)
+            return dict(crawl, errors=list(crawl['errors'])) if crawl else None
+
+    def list(self):
+        """Every known crawl, newest first"""
+        with self.lock:
+            crawls = [dict(crawl, errors=list(crawl['errors'])) for crawl in self.crawls.values()]
+        return sorted(crawls, key=lambda crawl: crawl['start_time'], reverse=True)
@@ -0,0 +1,150 @@
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+
+# Longest profile one request may ask for, and the default time between samples
+MAX_PROFILE_SECONDS = 60
+SAMPLE_INTERVAL = 0.01
+
+# Allocation sites reported, and stack frames tracemalloc keeps per allocation
+TOP_ALLOCATIONS = 25
+TRACE_FRAMES = 1
+
+# Threads serving a job are named job-<id>[-role]
+JOB_THREAD = re.compile(r'^job-([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def job_of(thread_name):
+    """The id of the job a thread works for, from its name, or None"""
+    match = JOB_THREAD.match(thread_name or '')
+    return match.group(1) if match else None
+
+
+def _frame_label(code, lineno):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+def thread_stacks():
+    """Every thread's current stack, innermost frame last, with the job it serves"""
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        thread = threads.get(ident)
+        name = thread.name if thread else f"thread-{ident}"
+        stacks.append({
+            'name': name,
+            'ident': ident,
+            'daemon': thread.daemon if thread else None,
+            'job_id': job_of(name),
+            'stack': [
+                f"{os.path.basename(summary.filename)}:{summary.lineno} in {summary.name}"
+                for summary in traceback.extract_stack(frame)
+            ]
+        })
+    return sorted(stacks, key=lambda stack: stack['name'])
+
+
+class Profiler:
+    """On-demand sampling profiler of all threads.
+
+    Nothing is hooked into the interpreter: while a profile runs, the
+    requesting thread reads every thread's frame once per interval, and
+    between profiles it costs nothing. The result is in the collapsed-stack
+    format of flamegraph.pl and speedscope, one 'thread;outer;...;inner
+    count' line per distinct stack.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, interval=SAMPLE_INTERVAL):
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            return self._sample(min(seconds, MAX_PROFILE_SECONDS), interval)
+        finally:
+            self.lock.release()
+
+    def _sample(self, seconds, interval):
+        me = threading.get_ident()
+        names = {}
+        counts = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(names) != len(frames) or any(ident not in names for ident in frames):
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[';'.join(reversed(stack))] += 1
+            del frames, frame  # Frames keep their locals alive
+            time.sleep(interval)
+        return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def deep_size(obj, seen=None):
+    """Approximate bytes held by obj and the containers and strings inside it.
+
+    Containers are copied before they are walked, so other threads may keep
+    changing them meanwhile; the total is then only as of some moment.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in list(obj.items()))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in list(obj))
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+
+def start_tracing(frames=TRACE_FRAMES):
+    """Start tracing allocations; every allocation costs more until stop_tracing"""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+def stop_tracing():
+    tracemalloc.stop()
+
+
+def allocation_report(limit=TOP_ALLOCATIONS):
+    """Traced memory and the allocation sites holding the most of it, if tracing is on"""
+    if not tracemalloc.is_tracing():
+        return {'tracing': False}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'tracing': True,
+        'frames': tracemalloc.get_traceback_limit(),
+        'current': current,
+        'peak': peak,
+        'top': [
+            {'site': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:limit]
+        ]
+    }
@@ -1,44 +1,575 @@
 import os
+import posixpath
+import json
+import logging
 import time
+import random
+import hashlib
 import threading
 import requests
 import subprocess
 import shutil
 import uuid
 import signal
+import socket
+import struct
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, unquote
 import re
+from metalink import parse_metalink, strongest_hash, file_basename
+from url_cache import url_metadata
+from host_profiles import HostProfiles, SEGMENT_SIZE
+from speed import SpeedSeries
+from admission import AdmissionError
+from fairshare import ByteQuota, FairQueue, QUOTA_PERIOD
+from windows import Throttle, WindowError
+from storage import StorageLayout
+from diagnostics import deep_size
+from file_index import FileIndex
+from hls import HlsError, decrypt_segment, fetch_playlist, media_filename, parse_playlist, segment_iv, select_variant
+from postprocess import PostProcessError, stage_output, streams
+
+logger = logging.getLogger('fdl_server.downloads')
+
+# Retry policy applied to every job; any key can be overridden per job
+DEFAULT_RETRY_POLICY = {
+    'max_attempts': 5,
+    'backoff_base': 1.0,   # seconds before the first retry, doubled on each attempt
+    'backoff_max': 60.0,
+    'jitter': 0.5,         # fraction of the delay that is randomised
+    'retry_statuses': [408, 425, 429, 500, 502, 503, 504]
+}
+
+# aria2c exit codes for transient failures: timeout, too slow (--lowest-speed-limit),
+# network problem, name resolution failure and server overload/maintenance
+ARIA2_RETRYABLE_EXIT_CODES = {2, 5, 6, 19, 29}
+
+# Completed jobs are appended to this file in the state directory and replayed on startup
+MANIFEST_NAME = 'history.jsonl'
+
+# Seconds between retention sweeps when nothing new has completed
+RETENTION_INTERVAL = 60
+
+# Seconds a client is told to wait when the download queue is full
+QUEUE_FULL_RETRY_AFTER = 10
+
+# Learned per-host connection counts, kept in the state directory
+HOST_PROFILES_NAME = 'host_profiles.json'
+
+# HTTP statuses, and aria2c errors, that mean a host is rate limiting us
+THROTTLE_STATUSES = {429, 503}
+ARIA2_THROTTLE_PATTERN = re.compile(r'errorCode=29|status=(429|503)')
+
+# Segmented download settings for the requests engine
+CHUNK_SIZE = 64 * 1024
+MIN_SPLIT_SIZE = 1024 * 1024
+DEFAULT_SPLIT = 4
+
+# Stall watchdogs: a connection that receives nothing for STALL_TIMEOUT seconds,
+# or averages LOW_SPEED_LIMIT bytes per second or less over LOW_SPEED_TIME
+# seconds, is dropped and its segment reconnects where it left off
+STALL_TIMEOUT = 30
+LOW_SPEED_LIMIT = 1024
+LOW_SPEED_TIME = 60
+WATCHDOG_INTERVAL = 1
+
+# HLS engine: segments fetched at once, and how far ahead of the next segment
+# to be written the fetches may run (finished segments wait on disk in between)
+HLS_WORKERS = 4
+HLS_WINDOW = 16
+
+# Seconds a cancelled aria2c gets to exit after SIGTERM before it is killed,
+# and how often its monitor looks for a cancel while aria2c prints nothing
+KILL_TIMEOUT = 5
+STOP_POLL_INTERVAL = 0.5
+
+# Seconds between checks for scheduled jobs that may start and windows that have closed
+WINDOW_INTERVAL = 5
+
+# Statuses a job stays in until it is retried
+FINISHED_STATUSES = ('completed', 'error', 'cancelled')
+
+# Job fields sent to a job's callback URL with each event
+WEBHOOK_FIELDS = ('id', 'url', 'filename', 'status', 'error', 'size', 'downloaded', 'retries', 'start_time', 'end_time')
+
+
+class RetryableError(Exception):
+    """A transient download failure that should be retried"""
+
+
+class StallError(RetryableError):
+    """A connection was dropped by the stall watchdog"""
+
 
 class DownloadManager:
-    def __init__(self, download_dir, temp_dir):
+    def __init__(self, download_dir, temp_dir, state_dir=None, retention=None, http2=None, url_cache=None,
+                 max_active=0, max_queue_depth=0, max_probes=0, stall_timeout=STALL_TIMEOUT,
+                 low_speed_limit=LOW_SPEED_LIMIT, low_speed_time=LOW_SPEED_TIME, hls_max_bandwidth=0,
+                 postprocessor=None, webhooks=None, user_weights=None, user_max_active=0, user_quota_bytes=0,
+                 quota_period=QUOTA_PERIOD, windows=None, storage_layout='flat', file_index_rescan=0):
         self.download_dir = os.path.abspath(download_dir)
         self.temp_dir = os.path.abspath(temp_dir)
+        self.state_dir = os.path.abspath(state_dir or os.path.join(self.temp_dir, 'state'))
+        self.manifest_path = os.path.join(self.state_dir, MANIFEST_NAME)
+        self.storage = StorageLayout(self.download_dir, storage_layout)  # Maps public paths to stored files
         self.active_downloads = {}
         self.download_history = {}
+        self.history_order = None  # History job ids newest first; None after a change until next needed
         self.lock = threading.Lock()
+        self.status_changed = threading.Condition(self.lock)  # Notified on every job status change
         self.processes = {}  # Store subprocess references
+        self.threads = {}  # Worker thread per job
+        self.stop_events = {}  # Set to stop a job's current run (cancel or fatal error)
+        self.speed_series = {}  # SpeedSeries per unfinished job, kept across retries
+        self.piece_hashes = {}  # Metalink piece checksums, kept out of the job dict sent to clients
+        self.manifest_lock = threading.Lock()  # Serialises writes to the history manifest
+        self.cleared_at = 0  # Files older than the last history clear are not rediscovered
+        self.ready = False  # History restored from the manifest
+        self.scan_state = {'running': False, 'scanned': 0, 'added': 0, 'removed': 0}
+        self.retention = retention  # RetentionIndex when DOWNLOAD_DIR runs as a bounded cache
+        self.retention_wakeup = threading.Event()
+        self.http2 = http2  # Http2Pool shared by the jobs of the http2 engine, when httpx is installed
+        self.url_cache = url_cache  # MetadataCache of HEAD probe results
+        self.run_starts = {}  # (time, downloaded) when a job's current run started, for host profiles
+        
+        # Admission control; 0 disables a limit
+        self.max_active = max_active  # Jobs running at once; the rest wait in self.pending
+        self.max_queue_depth = max_queue_depth  # Running plus waiting jobs
+        self.running_jobs = set()
+        self.pending = FairQueue(user_weights)  # Ids of jobs waiting for a free slot, shared out fairly between users
+        self.probe_slots = threading.BoundedSemaphore(max_probes) if max_probes else None
+        self.probes_in_flight = 0
+        self.rejected = {'queue_full': 0, 'probes': 0, 'quota': 0}
+        
+        # Per-user limits; 0 disables a limit
+        self.user_max_active = user_max_active  # Jobs one user may run at once
+        self.user_running = {}  # User -> running jobs
+        self.quota = ByteQuota(user_quota_bytes, quota_period) if user_quota_bytes else None
+        
+        # Deferred jobs: not_before times and named download windows (DownloadWindow by name)
+        self.windows = windows or {}
+        self.throttles = {name: Throttle(window.rate) for name, window in self.windows.items() if window.rate}
+        self.deferred = set()  # Ids of jobs in the 'scheduled' status, waiting for their start time
+        self.window_wakeup = threading.Event()
+        
+        # Stall watchdogs; 0 disables one
+        self.stall_timeout = stall_timeout
+        self.low_speed_limit = low_speed_limit
+        self.low_speed_time = low_speed_time
+        self.transfers = {}  # Open responses of the requests and http2 engines per job, watched for stalls
+        self.stalls = 0
+        
+        # HLS variant selection: the best stream at or below this many bits per second, 0 for the best
+        self.hls_max_bandwidth = hls_max_bandwidth
+        
+        self.postprocessor = postprocessor  # PostProcessor running the jobs' post-download stages
+        self.webhooks = webhooks  # WebhookDispatcher delivering job events to callback URLs
         
         # Create directories if they don't exist
-        os.makedirs(self.download_dir, exist_ok=True)
-        os.makedirs(self.temp_dir, exist_ok=True)
+        for directory in [self.download_dir, self.temp_dir, self.state_dir]:
+            os.makedirs(directory, exist_ok=True)
+            
+            # Ensure the directories themselves are writable; files inside get their
+            # permissions when they are created, so there is no need to walk them
+            try:
+                os.chmod(directory, 0o777)
+            except OSError as e:
+                logger.warning("Failed to set permissions on %s: %s", directory, e)
+        
+        self.host_profiles = HostProfiles(os.path.join(self.state_dir, HOST_PROFILES_NAME))
+        
+        # Listing of DOWNLOAD_DIR for /api/files, seeded by the walk that reconciles the history
+        self.file_index = None
+        if file_index_rescan > 0:
+            self.file_index = FileIndex(
+                self.download_dir,
+                skip=(self.temp_dir, self.state_dir),
+                public_path=self.storage.name_of,
+                rescan_interval=file_index_rescan,
+                seeded=True
+            )
+        
+        # Restore the history in the background so startup does not wait on the disk
+        thread = threading.Thread(target=self._restore_history, name='history-restore')
+        thread.daemon = True
+        thread.start()
         
-        # Ensure directories are writable
+        if self.retention:
+            thread = threading.Thread(target=self._retention_loop, name='retention')
+            thread.daemon = True
+            thread.start()
+        
+        if self.stall_timeout or self.low_speed_limit:
+            thread = threading.Thread(target=self._watchdog_loop, name='watchdog')
+            thread.daemon = True
+            thread.start()
+        
+        thread = threading.Thread(target=self._window_loop, name='windows')
+        thread.daemon = True
+        thread.start()
+
+    def _restore_history(self):
+        """Replay the history manifest, then reconcile it with the download directory"""
         try:
-            os.system(f'chmod -R 777 {self.download_dir}')
-            os.system(f'chmod -R 777 {self.temp_dir}')
+            self._load_manifest()
         except Exception as e:
-            print(f"Failed to set permissions: {str(e)}")
+            logger.exception("Failed to load history manifest: %s", e)
+        finally:
+            self.ready = True
+        
+        reconciled = False
+        try:
+            self._reconcile_history()
+            reconciled = True
+        except Exception as e:
+            logger.exception("History reconciliation failed: %s", e)
+        finally:
+            if self.file_index:
+                self.file_index.finish_seed(complete=reconciled)
+
+    def _load_manifest(self):
+        """Rebuild the download history from the persisted manifest"""
+        if not os.path.exists(self.manifest_path):
+            return
+        
+        history = {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn write from a crash
+                if 'cleared_at' in record:
+                    self.cleared_at = record['cleared_at']
+                    history.clear()
+                elif 'removed' in record:
+                    history.pop(record['removed'], None)
+                elif 'id' in record:
+                    history[record['id']] = record
+        
+        for entry in history.values():
+            for stage in entry.get('postprocess', []):
+                if stage['status'] not in ('completed', 'error'):
+                    stage['status'] = 'error'
+                    stage['error'] = "Interrupted by a restart"
+        
+        with self.lock:
+            # Jobs completed since startup win over their persisted copies
+            for download_id, entry in history.items():
+                self.download_history.setdefault(download_id, entry)
+            self.history_order = None
+        
+        # The newest download of a public path wins it
+        stored = {}
+        for entry in sorted(history.values(), key=lambda entry: entry.get('end_time') or 0):
+            stored[entry['filename']] = entry['final_path']
+            for stage in entry.get('postprocess', []):
+                if (stage.get('result') or {}).get('output'):
+                    output = stage['result']['output']
+                    stored[output] = os.path.join(os.path.dirname(entry['final_path']), posixpath.basename(output))
+        for public, path in stored.items():
+            self.storage.add(path, public, replace=False)
+
+    def _reconcile_history(self):
+        """Drop history entries whose files are gone and add files nobody recorded"""
+        self.scan_state['running'] = True
+        with self.lock:
+            known = {entry['final_path']: entry.get('pinned', False) for entry in self.download_history.values()}
+        
+        seen = set()
+        for entry in self._scan_download_dir():
+            self.scan_state['scanned'] += 1
+            path = entry.path
+            seen.add(path)
+            
+            stat = entry.stat()
+            if self.retention:
+                # The access time is the last time download_file served the file
+                self.retention.add(path, stat.st_size, stat.st_atime, known.get(path, False))
+            if path in known:
+                continue
+            
+            # Files not placed by the layout (left from before a layout change) keep their own path
+            public = self.storage.name_of(path)
+            self.storage.add(path, public, replace=False)
+            if stat.st_mtime <= self.cleared_at:
+                continue
+            record = {
+                'id': str(uuid.uuid5(uuid.NAMESPACE_URL, path)),
+                'url': '',
+                'urls': [],
+                'filename': public,
+                'start_time': stat.st_mtime,
+                'end_time': stat.st_mtime,
+                'final_path': path,
+                'progress': 100,
+                'status': 'completed',
+                'error': None,
+                'size': stat.st_size,
+                'downloaded': stat.st_size,
+                'speed': '0 B/s'
+            }
+            with self.lock:
+                self.download_history.setdefault(record['id'], record)
+                self.history_order = None
+            self.scan_state['added'] += 1
+        
+        with self.lock:
+            missing = [
+                download_id for download_id, entry in self.download_history.items()
+                if entry['final_path'] in known and entry['final_path'] not in seen
+            ]
+            for download_id in missing:
+                self.storage.discard(self.download_history.pop(download_id)['final_path'])
+            self.history_order = None
+        self.scan_state['removed'] = len(missing)
+        
+        self._compact_manifest()
+        self.scan_state['running'] = False
+
+    def _scan_download_dir(self):
+        """Yield a DirEntry for every file under the download directory, skipping our own directories.
+
+        Each directory fully listed is handed to the file index too, so the
+        tree is walked once at startup rather than once for each.
+        """
+        skip = {self.temp_dir, self.state_dir}
+        pending = [self.download_dir]
+        while pending:
+            directory = pending.pop()
+            files, subdirs = [], []
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path not in skip:
+                                pending.append(entry.path)
+                                subdirs.append(entry.name)
+                        elif entry.is_file(follow_symlinks=False):
+                            files.append(entry)
+                            yield entry
+            except OSError as e:
+                logger.warning("Failed to scan %s: %s", directory, e)
+                continue
+            if self.file_index:
+                self.file_index.seed_directory(directory, mtime, files, subdirs)
+
+    def _persist_history_entry(self, entry):
+        """Append a completed job to the history manifest"""
+        record = {key: value for key, value in entry.items() if key != 'segments'}
+        with self.manifest_lock:
+            try:
+                with open(self.manifest_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                logger.error("Failed to update history manifest: %s", e)
+
+    def _persist_history_removals(self, download_ids):
+        """Record in the manifest that history entries are gone"""
+        with self.manifest_lock:
+            try:
+                with open(self.manifest_path, 'a', encoding='utf-8') as f:
+                    for download_id in download_ids:
+                        f.write(json.dumps({'removed': download_id}) + '\n')
+            except OSError as e:
+                logger.error("Failed to update history manifest: %s", e)
+
+    def _compact_manifest(self, cleared=False):
+        """Rewrite the manifest from the in-memory history"""
+        with self.manifest_lock:
+            if cleared:
+                self.cleared_at = time.time()
+            with self.lock:
+                entries = list(self.download_history.values())
+            
+            temp_manifest = self.manifest_path + '.tmp'
+            try:
+                with open(temp_manifest, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps({'cleared_at': self.cleared_at}) + '\n')
+                    for entry in entries:
+                        record = {key: value for key, value in entry.items() if key != 'segments'}
+                        f.write(json.dumps(record) + '\n')
+                os.replace(temp_manifest, self.manifest_path)
+            except OSError as e:
+                logger.error("Failed to rewrite history manifest: %s", e)
+
+    def _retention_loop(self):
+        """Evict files periodically and whenever a download completes"""
+        while True:
+            self.retention_wakeup.wait(RETENTION_INTERVAL)
+            self.retention_wakeup.clear()
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                logger.exception("Retention sweep failed: %s", e)
+
+    def enforce_retention(self):
+        """Delete least recently served files until quotas and TTLs are met"""
+        victims = set(self.retention.select_victims())
+        if not victims:
+            return 0
+        
+        for path in victims:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Failed to evict %s: %s", path, e)
+                continue
+            self.storage.discard(path)
+        
+        with self.lock:
+            removed = [
+                download_id for download_id, entry in self.download_history.items()
+                if entry['final_path'] in victims
+            ]
+            for download_id in removed:
+                del self.download_history[download_id]
+            self.history_order = None
+        self._persist_history_removals(removed)
+        
+        logger.info("Evicted %d files from %s", len(victims), self.download_dir, extra={'files': len(victims)})
+        return len(victims)
+
+    def touch_file(self, path):
+        """Record that a completed file was served, for LRU eviction"""
+        if not self.retention:
+            return
+        
+        path = os.path.abspath(path)
+        now = time.time()
+        try:
+            # Keep the access time on disk so it survives restarts, even on noatime mounts
+            os.utime(path, (now, os.stat(path).st_mtime))
+        except OSError:
+            pass
+        self.retention.touch(path, now)
+
+    def pin_download(self, download_id, pinned=True):
+        """Pin a completed download so it is never evicted, or unpin it"""
+        with self.lock:
+            entry = self.download_history.get(download_id)
+            if not entry:
+                return False
+            entry['pinned'] = pinned
+            if download_id in self.active_downloads:
+                self.active_downloads[download_id]['pinned'] = pinned
+            entry = entry.copy()
+        
+        # The later manifest record for the same id wins on load
+        self._persist_history_entry(entry)
+        if self.retention:
+            self.retention.set_pinned(entry['final_path'], pinned)
+        return True
+
+    def get_admission_stats(self):
+        """Queue occupancy and admission limits"""
+        with self.lock:
+            return {
+                'running': len(self.running_jobs),
+                'queued': len(self.pending),
+                'probes_in_flight': self.probes_in_flight,
+                'user_max_active': self.user_max_active,
+                'max_active': self.max_active,
+                'max_queue_depth': self.max_queue_depth,
+                'rejected': dict(self.rejected)
+            }
+
+    def get_user_stats(self):
+        """Running and waiting jobs, current bandwidth and quota use per user"""
+        with self.lock:
+            waiting = self.pending.waiting()
+            users = set(self.user_running) | set(waiting)
+            if self.quota:
+                self.quota.used(None)  # Starts a new window if the last one has ended
+                users |= set(self.quota.used_bytes)
+            speeds = {}
+            for download_id in self.running_jobs:
+                job = self.active_downloads[download_id]
+                speeds[job.get('user')] = speeds.get(job.get('user'), 0) + job['speed_bps']
+            
+            return {
+                'quota_bytes': self.quota.limit if self.quota else 0,
+                'quota_reset_in': self.quota.reset_in() if self.quota else None,
+                'users': {
+                    user or '': {
+                        'weight': self.pending.weight(user),
+                        'running': self.user_running.get(user, 0),
+                        'queued': waiting.get(user, 0),
+                        'speed_bps': speeds.get(user, 0),
+                        'quota_used': self._user_bytes(user) if self.quota else None
+                    }
+                    for user in users
+                }
+            }
+
+    def get_window_stats(self):
+        """Each download window's state, with its scheduled and running jobs"""
+        now = time.time()
+        with self.lock:
+            jobs = [self.active_downloads[download_id] for download_id in self.deferred | self.running_jobs]
+            return {
+                name: dict(
+                    window.to_dict(now),
+                    scheduled=sum(1 for job in jobs if job.get('window') == name and job['status'] == 'scheduled'),
+                    running=sum(1 for job in jobs if job.get('window') == name and job['status'] != 'scheduled')
+                )
+                for name, window in self.windows.items()
+            }
+
+    def get_watchdog_stats(self):
+        """Stall watchdog settings, open connections being watched and connections dropped so far"""
+        with self.lock:
+            return {
+                'stall_timeout': self.stall_timeout,
+                'low_speed_limit': self.low_speed_limit,
+                'low_speed_time': self.low_speed_time,
+                'watched': sum(len(transfers) for transfers in self.transfers.values()),
+                'stalls': self.stalls
+            }
+
+    def get_memory_stats(self):
+        """Entries in the job registries and the approximate bytes each holds"""
+        # Only shallow copies are taken under the locks; walking a large history would stall every job
+        with self.lock:
+            registries = {
+                'active_downloads': dict(self.active_downloads),
+                'download_history': dict(self.download_history),
+                'speed_series': dict(self.speed_series),
+                'piece_hashes': dict(self.piece_hashes)
+            }
+        with self.storage.lock:
+            registries['storage_index'] = dict(self.storage.index)
+        return {name: {'entries': len(registry), 'bytes': deep_size(registry)} for name, registry in registries.items()}
+
+    def get_health(self):
+        """Readiness details: history restored and reconciliation progress"""
+        return {
+            'ready': self.ready,
+            'reconciliation': dict(self.scan_state),
+            'storage': {'layout': self.storage.layout, 'indexed': len(self.storage)}
+        }
+
+    def _probe_url(self, url, session=None):
+        """HEAD a URL, following redirects, unless the metadata cache already knows it"""
+        metadata = self.url_cache.get(url) if self.url_cache else None
+        if metadata is None:
+            response = (session or requests).head(url, allow_redirects=True, timeout=10)
+            metadata = url_metadata(response)
+            if self.url_cache and metadata['ok']:
+                self.url_cache.put(url, metadata)
+        return metadata
 
     def get_filename_from_url(self, url):
         """Extract filename from URL or response headers"""
         try:
             # Try to get filename from Content-Disposition header
-            response = requests.head(url, allow_redirects=True, timeout=10)
-            content_disposition = response.headers.get('Content-Disposition')
-            if content_disposition:
-                filename_match = re.search(r'filename="?([^"]+)"?', content_disposition)
-                if filename_match:
-                    return unquote(filename_match.group(1))
+            metadata = self._probe_url(url)
+            if metadata['filename']:
+                return metadata['filename']
             
             # Try to get filename from URL
             path = urlparse(url).path
@@ -47,8 +578,7 @@ class DownloadManager:
                 return unquote(filename)
             
             # Default filename if all else fails
-            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
-            extension = self._get_extension_for_content_type(content_type)
+            extension = self._get_extension_for_content_type(metadata['content_type'])
             return f"download_{uuid.uuid4().hex[:8]}{extension}"
         except Exception:
             # If all fails, use a random name
@@ -85,57 +615,665 @@ class DownloadManager:
         }
         return content_type_map.get(content_type, '')
 
-    def add_download(self, url, use_aria2=True):
-        """Add a new download job"""
+    def add_download(self, url, use_aria2=True, mirrors=None, retry=None, split=None, download_id=None, resume=None,
+                     engine=None, subdir=None, filename=None, postprocess=None, callback_url=None, user=None,
+                     not_before=None, window=None):
+        """Add a new download job.
+
+        engine ('aria2', 'requests', 'http2' or 'auto') overrides use_aria2;
+        'auto' picks http2 when the origin negotiates it. download_id and
+        resume are used by cluster mode: the job keeps the id it was queued
+        under and picks up the segments another node published. The crawler
+        passes the filename it found in a directory listing, which skips the
+        probe, and the subdir under download_dir it belongs in. postprocess
+        lists the stages (from postprocess.parse_stages) run on the file.
+        Each status change of the job is POSTed to callback_url. user is the
+        account the job is scheduled and accounted under. A job with a
+        not_before time, or in a named download window, waits as 'scheduled'
+        until it may start.
+        """
+        if window is not None and window not in self.windows:
+            raise WindowError(f"Unknown download window {window}")
+        
+        with self.lock:
+            self._admit(user=user)
+        
+        if not filename:
+            filename = self._probe_filename(url)
+        if engine == 'hls':
+            # The playlist is replaced by the stream it describes
+            filename = media_filename(filename)
+        if postprocess:
+            if not self.postprocessor:
+                raise PostProcessError("Post-processing is not available")
+            for stage in postprocess:
+                stage_output(stage['stage'], stage['option'], filename)  # Raises if the stage does not apply
+        
+        # Mirrors serve the same file; the primary URL is always tried first
+        urls = [url] + [mirror for mirror in (mirrors or []) if mirror != url]
+        
         with self.lock:
-            download_id = str(uuid.uuid4())
+            self._admit(user=user)
+            return self._create_job(urls, filename, use_aria2, retry, split, download_id=download_id, resume=resume,
+                                    engine=engine, subdir=subdir, postprocess=postprocess,
+                                    callback_url=callback_url, user=user, not_before=not_before, window=window)
+
+    def _probe_filename(self, url):
+        """Name a URL's file by probing it, within the limit of concurrent probes"""
+        if self.probe_slots and not self.probe_slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected['probes'] += 1
+            raise AdmissionError("Too many submissions are being processed", retry_after=1)
+        try:
+            with self.lock:
+                self.probes_in_flight += 1
+            # Get filename from URL or response headers. The probe runs outside the
+            # lock so listing and cancelling stay responsive while it waits on the network.
+            return self.get_filename_from_url(url)
+        finally:
+            with self.lock:
+                self.probes_in_flight -= 1
+            if self.probe_slots:
+                self.probe_slots.release()
+
+    def add_metalink(self, data, use_aria2=True, retry=None, split=None, select=None, download_id=None, resume=None,
+                     engine=None, user=None, not_before=None, window=None, callback_url=None, postprocess=None):
+        """Add one download job per file described by a Metalink document.
+
+        With select, only the file at that 1-based position is added, under
+        download_id if given. not_before, window, callback_url and
+        postprocess apply to every file's job as they do for add_download;
+        a stage that does not apply to one of the files refuses them all.
+        """
+        if window is not None and window not in self.windows:
+            raise WindowError(f"Unknown download window {window}")
+        
+        files = parse_metalink(data)
+        
+        selected = []  # (entry, urls, filename) of each file to add
+        for index, entry in enumerate(files, start=1):
+            if select is not None and index != select:
+                continue
+            urls = entry['urls']
+            if not use_aria2 or engine not in (None, 'aria2'):
+                # The Python engines only speak HTTP(S)
+                urls = [url for url in urls if urlparse(url).scheme in ('http', 'https')]
+                if not urls:
+                    continue
+            selected.append((entry, urls, file_basename(entry['name']) or file_basename(urlparse(urls[0]).path)))
+        
+        if postprocess:
+            if not self.postprocessor:
+                raise PostProcessError("Post-processing is not available")
+            for _, _, filename in selected:
+                for stage in postprocess:
+                    stage_output(stage['stage'], stage['option'], filename)  # Raises if the stage does not apply
+        
+        download_ids = []
+        with self.lock:
+            self._admit(len(files) if select is None else 1, user=user)
+            for entry, urls, filename in selected:
+                job_id = self._create_job(
+                    urls,
+                    filename,
+                    use_aria2,
+                    retry,
+                    split,
+                    metalink=entry,
+                    metalink_data=data,
+                    download_id=download_id if select is not None else None,
+                    resume=resume,
+                    engine=engine,
+                    user=user,
+                    not_before=not_before,
+                    window=window,
+                    callback_url=callback_url,
+                    postprocess=postprocess
+                )
+                download_ids.append(job_id)
+        
+        return download_ids
+
+    def _create_job(self, urls, filename, use_aria2, retry, split, metalink=None, metalink_data=None,
+                    download_id=None, resume=None, engine=None, subdir=None, postprocess=None, callback_url=None,
+                    user=None, not_before=None, window=None):
+        """Register a job and start it. Caller must hold self.lock."""
+        download_id = download_id or str(uuid.uuid4())
+        
+        # Create a unique temporary directory for this download
+        temp_dir = os.path.join(self.temp_dir, f"dl_{download_id}")
+        os.makedirs(temp_dir, exist_ok=True)
+        os.chmod(temp_dir, 0o777)  # Ensure directory is writable
+        
+        # Make the filename safe for the filesystem
+        filename = self._sanitize_filename(filename)
+        
+        if not filename:
+            filename = f"download_{download_id[:8]}"
+        
+        temp_path = os.path.join(temp_dir, filename)
+        
+        # Crawled files keep their remote directory; the filename is then their public path under /downloads/
+        subdir = self._sanitize_subdir(subdir)
+        if subdir:
+            filename = f"{subdir}/{filename}"
+        final_path = self.storage.path_for(filename, download_id)
+        
+        retry_policy = dict(DEFAULT_RETRY_POLICY)
+        retry_policy.update(retry or {})
+        
+        # Create a download job
+        download_job = {
+            'id': download_id,
+            'user': user,
+            'url': urls[0],
+            'urls': urls,
+            'filename': filename,
+            'start_time': time.time(),
+            'end_time': None,
+            'temp_path': temp_path,
+            'final_path': final_path,
+            'progress': 0,
+            'status': 'initializing',
+            'error': None,
+            'size': 0,
+            'downloaded': 0,
+            'speed': '0 B/s',  # Add speed field
+            'speed_bps': 0,  # Smoothed (EWMA) bytes per second
+            'average_speed': 0,  # Mean bytes per second since the job started
+            'eta': None,  # Seconds left at the smoothed speed
+            'temp_dir': temp_dir,
+            'engine': engine or ('aria2' if use_aria2 else 'requests'),
+            'retry': retry_policy,
+            'retries': 0,
+            'last_error': None,
+            'split': split or DEFAULT_SPLIT,
+            'tuned': split is None,  # Split and connections come from the host's learned profile
+            'connections': 0,  # Connections the current run opened per host
+            'throttled': False,  # The host answered 429/503 during the current run
+            'accept_ranges': False,
+            'segments': [],  # Byte ranges of the requests engine, kept for resuming
+            'sources': {url: {'bytes': 0, 'seconds': 0.0, 'failures': 0} for url in urls},
+            'stream_readers': 0,  # Clients reading the file while it downloads
+            'not_before': not_before,  # Earliest start, as a timestamp
+            'window': window,  # Download window the job may only run in
+            'starts_at': None  # When a scheduled job will start
+        }
+        
+        if callback_url:
+            download_job['callback_url'] = callback_url
+        
+        if postprocess:
+            download_job['postprocess'] = [{
+                'stage': stage['stage'],
+                'option': stage['option'],
+                'status': 'pending',
+                'processed': 0,  # Bytes of the file the stage has read
+                'result': None,
+                'error': None
+            } for stage in postprocess]
+        
+        if metalink:
+            # aria2c reads the document itself; the requests engine uses the parsed hashes
+            metalink_path = os.path.join(temp_dir, 'source.meta4')
+            with open(metalink_path, 'wb') as f:
+                f.write(metalink_data)
+            download_job['size'] = metalink['size']
+            download_job['hashes'] = metalink['hashes']
+            download_job['metalink'] = {
+                'path': metalink_path,
+                'index': metalink['index']  # Position in the whole document, for aria2c's --select-file
+            }
+            if metalink['pieces'] and metalink['pieces']['hashes']:
+                self.piece_hashes[download_id] = metalink['pieces']
+                download_job['pieces'] = len(metalink['pieces']['hashes'])
+                download_job['verified_pieces'] = 0
+        
+        if resume and resume.get('segments') and resume.get('filename') == filename and os.path.exists(temp_path):
+            # Another node's partial file on shared storage; continue from its last published segments
+            download_job['segments'] = [dict(segment) for segment in resume['segments']]
+            download_job['size'] = resume['size']
+            download_job['accept_ranges'] = resume['accept_ranges']
+            download_job['downloaded'] = sum(
+                segment['pos'] - segment['start'] for segment in download_job['segments']
+            )
+            download_job['retries'] = resume.get('retries', 0)
+            download_job['split'] = resume.get('split', download_job['split'])
+        
+        self.active_downloads[download_id] = download_job
+        self._schedule(download_id)
+        
+        return download_id
+
+    def _admit(self, count=1, user=None):
+        """Refuse new work once the queue is full or the user's quota is used up. Caller must hold self.lock."""
+        if self.max_queue_depth and len(self.running_jobs) + len(self.pending) + len(self.deferred) + count > self.max_queue_depth:
+            self.rejected['queue_full'] += 1
+            raise AdmissionError(
+                f"Download queue is full ({self.max_queue_depth} jobs)",
+                retry_after=QUEUE_FULL_RETRY_AFTER
+            )
+        if self.quota and self._user_bytes(user) >= self.quota.limit:
+            self.rejected['quota'] += 1
+            raise AdmissionError(
+                f"Download quota of {self.quota.limit} bytes per {self.quota.period}s is used up",
+                retry_after=self.quota.reset_in()
+            )
+
+    def _user_bytes(self, user):
+        """Bytes a user has downloaded in the current quota window, including running jobs. Caller must hold self.lock."""
+        used = self.quota.used(user)
+        for download_id in self.running_jobs:
+            job = self.active_downloads[download_id]
+            if job.get('user') == user and download_id in self.run_starts:
+                used += max(0, job['downloaded'] - self.run_starts[download_id][1])
+        return used
+
+    def _user_may_start(self, user):
+        """Whether a user is below the per-user limit of running jobs and has quota left. Caller must hold self.lock."""
+        if self.user_max_active and self.user_running.get(user, 0) >= self.user_max_active:
+            return False
+        # Jobs queued before the quota ran out wait for it to reset; the window loop starts them then
+        return not self.quota or self._user_bytes(user) < self.quota.limit
+
+    def _schedule(self, download_id):
+        """Start a job now, or queue it until a slot frees up. Caller must hold self.lock."""
+        job = self.active_downloads[download_id]
+        if self._defer(job):
+            return
+        if (self.max_active and len(self.running_jobs) >= self.max_active) or not self._user_may_start(job.get('user')):
+            self._set_status(job, 'queued')
+            self.pending.push(job.get('user'), download_id)
+        else:
+            self._start_job(download_id)
+
+    def _start_pending(self):
+        """Start waiting jobs, fairly across users, while there are free slots. Caller must hold self.lock."""
+        while not self.max_active or len(self.running_jobs) < self.max_active:
+            download_id = self.pending.pop(eligible=self._user_may_start)
+            if download_id is None:
+                break
+            job = self.active_downloads.get(download_id)
+            if job and job['status'] == 'queued' and not self._defer(job):
+                self._start_job(download_id)
+
+    def _deferred_until(self, job, now):
+        """When a job may start, or None if it may start now"""
+        start = max(now, job.get('not_before') or 0)
+        window = self.windows.get(job.get('window'))
+        if window:
+            start = window.next_open(start) or float('inf')
+        return start if start > now else None
+
+    def _defer(self, job):
+        """Hold a job as 'scheduled' if it may not start yet; returns True if it was. Caller must hold self.lock."""
+        starts_at = self._deferred_until(job, time.time())
+        job['starts_at'] = starts_at
+        if starts_at is None:
+            return False
+        self._set_status(job, 'scheduled')
+        self.deferred.add(job['id'])
+        return True
+
+    def _window_loop(self):
+        """Start scheduled jobs when their time comes, and pause jobs whose window has closed.
+
+        Also starts queued jobs held back by the byte quota once it resets.
+        """
+        while True:
+            timeout = WINDOW_INTERVAL
+            if self.quota:
+                timeout = min(timeout, self.quota.reset_in())
+            self.window_wakeup.wait(timeout)
+            self.window_wakeup.clear()
+            now = time.time()
+            with self.lock:
+                for download_id in list(self.deferred):
+                    job = self.active_downloads.get(download_id)
+                    if not job or job['status'] != 'scheduled':
+                        self.deferred.discard(download_id)
+                        continue
+                    starts_at = self._deferred_until(job, now)
+                    if starts_at is not None:
+                        job['starts_at'] = starts_at
+                        continue
+                    # A paused job's run must have fully exited before its temp files are reused
+                    thread = self.threads.get(download_id)
+                    if not (thread and thread.is_alive()):
+                        self.deferred.discard(download_id)
+                        self._schedule(download_id)
+                
+                for download_id in list(self.running_jobs):
+                    job = self.active_downloads[download_id]
+                    window = self.windows.get(job.get('window'))
+                    if window and job['status'] in ('initializing', 'downloading') and not window.is_open(now):
+                        # Paused, keeping its temp files; it resumes when the window next opens
+                        logger.info("Download %s: window %s closed, pausing", download_id, window.name, extra={'job_id': download_id, 'window': window.name})
+                        self._clear_speed(job)
+                        self._defer(job)
+                        self._stop_run(download_id)
+                
+                if self.quota:
+                    self._start_pending()
+
+    def _job_throttle(self, download_id):
+        """The Throttle shared by the jobs of this job's window, if the window has a bandwidth cap"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            return self.throttles.get(job.get('window')) if job else None
+
+    def _start_job(self, download_id):
+        """Start the worker thread for a job. Caller must hold self.lock."""
+        job = self.active_downloads[download_id]
+        self._set_status(job, 'initializing')
+        self.running_jobs.add(download_id)
+        user = job.get('user')
+        self.user_running[user] = self.user_running.get(user, 0) + 1
+        self.pending.started(user)
+        self.stop_events[download_id] = threading.Event()
+        self.run_starts[download_id] = (time.time(), job['downloaded'])
+        if download_id not in self.speed_series:
+            self.speed_series[download_id] = SpeedSeries(time.time(), job['downloaded'])
+        job['throttled'] = False
+        
+        if job['engine'] == 'aria2':
+            target = self._download_with_aria2
+        elif job['engine'] == 'hls':
+            target = self._download_with_hls
+        else:
+            target = self._download_with_requests
+        # Threads serving a job are named after it, so diagnostics can tell whose work they do
+        thread = threading.Thread(target=target, args=(download_id,), name=f"job-{download_id}")
+        thread.daemon = True
+        self.threads[download_id] = thread
+        thread.start()
+        
+        # Streaming stages consume the file as it is written, alongside this run
+        self._start_stages(download_id, streaming=True)
+
+    def retry_download(self, download_id):
+        """Restart a failed or cancelled job, resuming from the bytes already on disk"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job or job['status'] not in ('error', 'cancelled'):
+                return False
             
-            # Create a unique temporary directory for this download
-            temp_dir = os.path.join(self.temp_dir, f"dl_{download_id}")
-            os.makedirs(temp_dir, exist_ok=True)
-            os.chmod(temp_dir, 0o777)  # Ensure directory is writable
+            # The previous run must have fully exited before its temp files are reused
+            thread = self.threads.get(download_id)
+            if thread and thread.is_alive():
+                return False
             
-            # Get filename from URL or response headers
-            filename = self.get_filename_from_url(url)
+            self._admit(user=job.get('user'))
+            os.makedirs(job['temp_dir'], exist_ok=True)
+            job['error'] = None
+            job['end_time'] = None
+            self._set_status(job, 'initializing')
+            self._schedule(download_id)
+            return True
+
+    def _set_status(self, job, status):
+        """Move a job to a new status, waking long-polls and queueing its webhook. Caller must hold self.lock."""
+        if job['status'] == status:
+            return
+        job['status'] = status
+        self.status_changed.notify_all()
+        self._notify_webhook(job, status)
+
+    def _notify_webhook(self, job, event):
+        """Queue an event for the job's callback URL, if it has one. Caller must hold self.lock."""
+        if not self.webhooks or not job.get('callback_url'):
+            return
+        payload = {key: job.get(key) for key in WEBHOOK_FIELDS}
+        if 'postprocess' in job:
+            payload['postprocess'] = [dict(stage) for stage in job['postprocess']]
+        payload.update(event=event, timestamp=time.time())
+        self.webhooks.notify(job['callback_url'], payload, key=job['id'])
+
+    def wait_for_change(self, download_id, status=None, timeout=30):
+        """Block until a job's status is no longer status, or timeout seconds pass.
+
+        Without status, waits for the job to leave the status it has now;
+        a job that has already finished returns at once. Returns the job's
+        snapshot, or None if there is no such job.
+        """
+        with self.status_changed:
+            job = self.active_downloads.get(download_id)
+            if job is None:
+                # Restored history entries never change again
+                entry = self.download_history.get(download_id)
+                return self._snapshot(entry) if entry else None
             
-            # Make the filename safe for the filesystem
-            filename = self._sanitize_filename(filename)
+            if status is None and job['status'] not in FINISHED_STATUSES:
+                status = job['status']
+            if status is not None:
+                self.status_changed.wait_for(lambda: job['status'] != status, timeout)
+            return self._snapshot(job)
+
+    def _is_stopped(self, download_id):
+        """Check whether the current run of a job has been told to stop"""
+        event = self.stop_events.get(download_id)
+        return event is None or event.is_set()
+
+    def _is_retryable(self, error, policy, sources=1):
+        """Decide whether a failed attempt is worth retrying"""
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            # With mirrors, any HTTP error can be worked around by another source
+            return sources > 1 or error.response.status_code in policy['retry_statuses']
+        return isinstance(error, (
+            RetryableError,
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError
+        ))
+
+    def _backoff_delay(self, policy, attempt, error=None):
+        """Exponential backoff with jitter, honouring a server's Retry-After"""
+        delay = min(policy['backoff_max'], policy['backoff_base'] * (2 ** (attempt - 1)))
+        delay *= 1 - policy['jitter'] * random.random()
+        
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(policy['backoff_max'], int(retry_after)))
+        return delay
+
+    def _wait_before_retry(self, download_id, policy, attempt, error):
+        """Record a failed attempt and back off. Returns True if the job was stopped meanwhile."""
+        delay = self._backoff_delay(policy, attempt, error)
+        response = getattr(error, 'response', None)
+        url = None
+        with self.lock:
+            if download_id in self.active_downloads:
+                if response is not None and response.status_code in THROTTLE_STATUSES:
+                    self.active_downloads[download_id]['throttled'] = True
+                self.active_downloads[download_id]['retries'] += 1
+                self.active_downloads[download_id]['last_error'] = str(error)
+                self._clear_speed(self.active_downloads[download_id])
+                url = self.active_downloads[download_id]['url']
+        logger.warning(
+            "Download %s attempt %d failed (%s), retrying in %.1fs", download_id, attempt, error, delay,
+            extra={'job_id': download_id, 'host': urlparse(url).hostname if url else None, 'attempt': attempt, 'delay': round(delay, 1)}
+        )
+        
+        event = self.stop_events.get(download_id)
+        return event is None or event.wait(delay)
+
+    def _complete_download(self, download_id):
+        """Mark a job completed and add it to the download history"""
+        with self.lock:
+            if download_id not in self.active_downloads:
+                return
             
-            if not filename:
-                filename = f"download_{download_id[:8]}"
+            self.active_downloads[download_id]['progress'] = 100
+            self.active_downloads[download_id]['end_time'] = time.time()
+            self._clear_speed(self.active_downloads[download_id])
             
-            temp_path = os.path.join(temp_dir, filename)
-            final_path = os.path.join(self.download_dir, filename)
+            series = self.speed_series.pop(download_id, None)
+            if series:
+                # A compact speed history stays with the job for post-hoc analysis
+                self.active_downloads[download_id]['average_speed'] = round(series.average())
+                self.active_downloads[download_id]['speed_history'] = series.history()
+            self._set_status(self.active_downloads[download_id], 'completed')
             
-            # Create a download job
-            download_job = {
-                'id': download_id,
-                'url': url,
-                'filename': filename,
-                'start_time': time.time(),
-                'end_time': None,
-                'temp_path': temp_path,
-                'final_path': final_path,
-                'progress': 0,
-                'status': 'initializing',
-                'error': None,
-                'size': 0,
-                'downloaded': 0,
-                'speed': '0 B/s',  # Add speed field
-                'temp_dir': temp_dir
+            # Add to download history
+            entry = self.active_downloads[download_id].copy()
+            self.download_history[download_id] = entry
+            self.history_order = None
+        
+        self.storage.add(entry['final_path'], entry['filename'])
+        self._persist_history_entry(entry)
+        duration = entry['end_time'] - entry['start_time']
+        logger.info(
+            "Download %s completed: %s, %d bytes in %.1fs", download_id, entry['filename'], entry['downloaded'], duration,
+            extra={
+                'job_id': download_id,
+                'host': urlparse(entry['url']).hostname,
+                'bytes': entry['downloaded'],
+                'duration': round(duration, 3),
+                'retries': entry['retries']
             }
-            
-            self.active_downloads[download_id] = download_job
-            
-            # Start download in a separate thread
-            if use_aria2:
-                thread = threading.Thread(target=self._download_with_aria2, args=(download_id, url, temp_dir, temp_path, final_path))
+        )
+        
+        if self.retention:
+            self.retention.add(entry['final_path'], entry['size'] or entry['downloaded'])
+            self.retention_wakeup.set()
+        
+        with self.lock:
+            self._start_stages(download_id, streaming=False)
+
+    def _fail_download(self, download_id, error):
+        """Mark a job as failed; its temp files are kept so it can be resumed"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if job:
+                job['error'] = str(error)
+                self._clear_speed(job)
+                self._set_status(job, 'error')
+        logger.error(
+            "Download %s failed: %s", download_id, error,
+            extra={'job_id': download_id, 'host': urlparse(job['url']).hostname if job else None}
+        )
+
+    def _finish_run(self, download_id, temp_dir):
+        """Release per-run resources; temp files are only kept for failed jobs"""
+        with self.lock:
+            self.processes.pop(download_id, None)
+            run_start = self.run_starts.pop(download_id, None)
+            job = self.active_downloads.get(download_id)
+            # Failed jobs can be retried and paused ones resume, both from their partial files
+            keep_temp = job is not None and job['status'] in ('error', 'scheduled')
+            if not keep_temp:
+                self.speed_series.pop(download_id, None)
+            if download_id in self.running_jobs:
+                self.running_jobs.discard(download_id)
+                user = job.get('user') if job else None
+                self.user_running[user] -= 1
+                if not self.user_running[user]:
+                    del self.user_running[user]
+                if self.quota and job and run_start:
+                    self.quota.add(user, max(0, job['downloaded'] - run_start[1]))
+            self._start_pending()
+            job = dict(job) if job else None
+        
+        if job and run_start:
+            self._record_host_profile(job, run_start)
+        
+        if not keep_temp and os.path.exists(temp_dir):
+            try:
+                shutil.rmtree(temp_dir)
+            except Exception:
+                pass
+
+    def _start_stages(self, download_id, streaming):
+        """Submit a job's streaming stages, or all it has left once the file is finished.
+
+        A streaming stage that finds no stream slot free stays pending and
+        runs on the finished file. Caller must hold self.lock.
+        """
+        job = self.active_downloads[download_id]
+        for index, stage in enumerate(job.get('postprocess', [])):
+            # Stages that failed with an earlier run are tried again
+            if stage['status'] not in ('pending', 'error'):
+                continue
+            if streaming and not streams(stage['stage'], stage['option'], job['filename']):
+                continue
+            try:
+                submitted = self.postprocessor.submit(
+                    stage['stage'],
+                    stage['option'],
+                    job['final_path'],
+                    lambda processed, index=index: self._stage_progress(download_id, index, processed),
+                    lambda result, error, index=index: self._stage_done(download_id, index, result, error),
+                    stream=self._stage_stream(download_id) if streaming else None
+                )
+            except (PostProcessError, OSError) as e:
+                stage.update(status='error', error=str(e))
+                continue
+            if submitted:
+                stage.update(status='queued', processed=0, result=None, error=None)
+
+    def _stage_stream(self, download_id):
+        """The job's bytes as they are written; raises if the run ends or pauses without completing the file"""
+        yield from self.stream_download(download_id, running_only=True)
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job or job['status'] != 'completed':
+                raise PostProcessError("The download did not complete")
+
+    def _stage_progress(self, download_id, index, processed):
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if job:
+                job['postprocess'][index].update(status='running', processed=processed)
+
+    def _stage_done(self, download_id, index, result, error):
+        """Record a stage's outcome; a completed job's history entry is persisted again with it"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job:
+                return
+            stage = job['postprocess'][index]
+            if error and job['status'] in ('scheduled', 'queued'):
+                # The stream ended because the job was paused; the stage runs again when it resumes
+                stage.update(status='pending', processed=0, error=None)
+                return
+            if error:
+                stage.update(status='error', error=str(error) or type(error).__name__)
             else:
-                thread = threading.Thread(target=self._download_with_requests, args=(download_id, url, temp_path, final_path))
-            thread.daemon = True
-            thread.start()
+                if result.get('output'):
+                    # Outputs sit next to the file, so they are served from its public directory
+                    public = posixpath.join(posixpath.dirname(job['filename']), os.path.basename(result['output']))
+                    self.storage.add(result['output'], public)
+                    result['output'] = public
+                stage.update(status='completed', processed=job['size'] or job['downloaded'], result=result)
+            
+            if all(stage['status'] in ('completed', 'error') for stage in job['postprocess']):
+                self._notify_webhook(job, 'postprocessed')
             
-            return download_id
+            entry = None
+            if job['status'] == 'completed' and download_id in self.download_history:
+                entry = dict(self.download_history[download_id])
+                entry['postprocess'] = [dict(stage) for stage in job['postprocess']]
+        
+        label = f"{stage['stage']}:{stage['option']}" if stage['option'] else stage['stage']
+        logger.log(
+            logging.WARNING if error else logging.INFO,
+            "Post-processing %s of %s %s%s", label, job['filename'], stage['status'], f": {stage['error']}" if error else '',
+            extra={'job_id': download_id, 'stage': label}
+        )
+        if entry:
+            self._persist_history_entry(entry)
+
+    def _record_host_profile(self, job, run_start):
+        """Feed a finished run's throughput, or its throttling, into the host's profile"""
+        started, downloaded = run_start
+        nbytes = job['downloaded'] - downloaded
+        if job.get('window') in self.throttles:
+            return  # Held to the window's bandwidth cap, so its speed says nothing about the host
+        # Small or single-connection transfers say little about how many connections a host takes;
+        # failures other than throttling say nothing at all
+        if job['throttled'] or (job['status'] == 'completed' and job['connections'] > 1 and nbytes >= 2 * SEGMENT_SIZE):
+            self.host_profiles.record(job['url'], job['connections'], nbytes, time.time() - started, job['throttled'])
 
     def _sanitize_filename(self, filename):
         """Make filename safe for the filesystem"""
@@ -149,162 +1287,267 @@ class DownloadManager:
             filename = name[:255-len(ext)] + ext
         return filename or "download"
 
-    def _download_with_aria2(self, download_id, url, temp_dir, temp_path, final_path):
+    def _sanitize_subdir(self, subdir):
+        """Make a relative directory safe, dropping components that would escape download_dir"""
+        parts = [self._sanitize_filename(part) for part in (subdir or '').split('/') if part.strip()]
+        return '/'.join(part for part in parts if part not in ('.', '..'))
+
+    def _download_with_aria2(self, download_id):
         """Download using aria2c for better performance"""
+        with self.lock:
+            if download_id not in self.active_downloads:
+                return
+            
+            job = self.active_downloads[download_id]
+            if job['status'] == 'initializing':  # Not paused or cancelled before the thread got going
+                self._set_status(job, 'downloading')
+            job['speed'] = '0 B/s'  # Initialize speed
+            urls = list(job['urls'])
+            temp_dir = job['temp_dir']
+            final_path = job['final_path']
+            policy = job['retry']
+            metalink = job.get('metalink')
+        
         try:
+            if metalink:
+                # aria2c handles Metalink natively: it picks sources from the document
+                # and verifies piece and file hashes as it goes. The output is pinned to
+                # the job's own filename, never the document's name, which may hold a path.
+                output = os.path.basename(final_path)
+                sources = [
+                    '--metalink-file', metalink['path'],
+                    f"--select-file={metalink['index']}",
+                    f"--index-out={metalink['index']}={output}",
+                    '--check-integrity=true'
+                ]
+            else:
+                output = os.path.basename(final_path)
+                sources = ['--out', output] + urls
+            
+            tuning = self._aria2_tuning(download_id, urls[0])
             with self.lock:
-                if download_id not in self.active_downloads:
-                    return
-                
-                self.active_downloads[download_id]['status'] = 'downloading'
-                self.active_downloads[download_id]['speed'] = '0 B/s'  # Initialize speed
+                job['temp_path'] = os.path.join(temp_dir, output)
+                job['connections'] = min(tuning['split'], tuning['connections'])
+                rate = self._aria2_rate_limit(download_id)
+            
+            # aria2c only limits its own process, so a capped window's rate is shared out when the job starts
+            limits = [f"--max-download-limit={rate}"] if rate else [f"--lowest-speed-limit={self.low_speed_limit}"]
             
-            # Build aria2c command with enhanced output options
+            # Build aria2c command with enhanced output options. Every URL is a
+            # mirror of the same file, so aria2c spreads the split across them.
             cmd = [
                 'aria2c',
-                '--max-connection-per-server=16',
-                '--min-split-size=1M',
-                '--split=10',
+                f"--max-connection-per-server={tuning['connections']}",
+                f"--min-split-size={tuning['min_split_size']}",
+                f"--split={tuning['split']}",
                 '--continue=true',
+                f"--max-tries={policy['max_attempts']}",
+                # aria2c's own watchdogs: a connection idle this long is retried, and an
+                # uncapped run exits with code 5 below the lowest speed so it is restarted and resumed
+                f"--timeout={self.stall_timeout or 60}",
+                *limits,
+                f"--retry-wait={max(1, int(policy['backoff_base']))}",  # Also enables retrying on 503
+                '--uri-selector=adaptive',
+                # Favour pieces near the start and save the control file often, so
+                # stream-through readers can follow the completed prefix
+                '--stream-piece-selector=geom',
+                '--auto-save-interval=1',
                 '--dir', temp_dir,
-                '--out', os.path.basename(final_path),
                 '--summary-interval=1',  # Update summary every second
                 '--console-log-level=notice',  # More verbose output
                 '--human-readable=true',  # Human readable output
                 '--download-result=full',  # Detailed download result
-                url
-            ]
-            
-            # Start aria2c process
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                preexec_fn=os.setsid if hasattr(os, 'setsid') else None  # For process group control
-            )
-            
-            # Store process reference for potential cancellation
-            with self.lock:
-                if download_id in self.active_downloads:
-                    self.processes[download_id] = process
-            
-            # Monitor aria2c progress
-            total_size = 0
-            downloaded = 0
-            last_update_time = time.time()
-            last_downloaded = 0
+            ] + sources
             
+            # aria2c retries individual connections itself; if it still gives up on a
+            # transient error, run it again and let --continue resume from the partial file
+            attempt = 0
             while True:
-                if download_id in self.active_downloads and self.active_downloads[download_id]['status'] == 'cancelled':
-                    # Kill the process if download was cancelled
-                    try:
-                        if hasattr(os, 'killpg') and hasattr(os, 'getpgid'):
-                            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                        else:
-                            process.terminate()
-                    except Exception:
-                        pass
+                attempt += 1
+                returncode = self._run_aria2(download_id, cmd)
+                if returncode is None:
+                    return  # Cancelled
+                if returncode == 0:
+                    break
+                
+                error = Exception(f"aria2c failed with exit code {returncode}")
+                if returncode not in ARIA2_RETRYABLE_EXIT_CODES or attempt >= policy['max_attempts']:
+                    raise error
+                if self._wait_before_retry(download_id, policy, attempt, error):
                     return
+            
+            # Move file from temp to final location
+            temp_file = os.path.join(temp_dir, output)
+            if os.path.exists(temp_file):
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                shutil.move(temp_file, final_path)
+                os.chmod(final_path, 0o644)  # Set read permissions for everyone
+                self._complete_download(download_id)
+            else:
+                raise Exception("Download file not found in temp directory")
                 
-                line = process.stdout.readline()
-                if not line and process.poll() is not None:
-                    break
+        except Exception as e:
+            self._fail_download(download_id, e)
+        finally:
+            self._finish_run(download_id, temp_dir)
+
+    def _aria2_rate_limit(self, download_id):
+        """A job's share of its window's bandwidth cap, or 0 if uncapped. Caller must hold self.lock."""
+        name = self.active_downloads[download_id].get('window')
+        if name not in self.throttles:
+            return 0
+        sharing = sum(1 for other in self.running_jobs if self.active_downloads[other].get('window') == name)
+        return max(1, self.windows[name].rate // max(1, sharing))
+
+    def _aria2_tuning(self, download_id, url):
+        """Connection, split and segment size flags for aria2c, from the host profile unless the job set a split"""
+        with self.lock:
+            job = self.active_downloads[download_id]
+            tuned = job['tuned']
+            split = job['split']
+            size = job['size']
+        
+        if not tuned:
+            return {'connections': min(split, 16), 'split': split, 'min_split_size': '1M'}
+        
+        if not size and self.url_cache:
+            # The filename probe usually left the size in the cache
+            metadata = self.url_cache.get(url)
+            size = metadata['size'] if metadata else 0
+        plan = self.host_profiles.plan(url, size)
+        with self.lock:
+            job['split'] = plan['split']
+        return plan
+
+    def _run_aria2(self, download_id, cmd):
+        """Run one aria2c attempt and track its progress. Returns the exit code, or None if cancelled."""
+        # Start aria2c process
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            preexec_fn=os.setsid if hasattr(os, 'setsid') else None  # For process group control
+        )
+        
+        # Store process reference for potential cancellation
+        with self.lock:
+            if download_id in self.active_downloads:
+                self.processes[download_id] = process
+        
+        # A reader thread feeds the output through a queue, so a cancel is noticed
+        # even while aria2c is silent instead of at its next line
+        lines = queue.Queue()
+        reader = threading.Thread(target=self._read_lines, args=(process.stdout, lines), name=f"job-{download_id}-aria2c")
+        reader.daemon = True
+        reader.start()
+        
+        # Monitor aria2c progress
+        total_size = 0
+        downloaded = 0
+        last_update_time = time.time()
+        last_downloaded = 0
+        
+        while True:
+            if self._is_stopped(download_id):
+                # Kill the process if download was cancelled
+                self._terminate_process(process)
+                return None
+            
+            try:
+                line = lines.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+            
+            if ARIA2_THROTTLE_PATTERN.search(line):
+                with self.lock:
+                    if download_id in self.active_downloads:
+                        self.active_downloads[download_id]['throttled'] = True
+            
+            # Parse progress information
+            try:
+                # Extract percentage
+                percent_match = re.search(r'(\d+)%', line)
+                if percent_match:
+                    progress = int(percent_match.group(1))
+                    with self.lock:
+                        if download_id in self.active_downloads:
+                            self.active_downloads[download_id]['progress'] = progress
                 
-                if not line:
-                    continue
+                # Extract downloaded/total
+                size_match = re.search(r'\((\d+\.?\d*)([KMGT]?i?B)/(\d+\.?\d*)([KMGT]?i?B)\)', line)
+                if size_match:
+                    downloaded_str = size_match.group(1) + size_match.group(2)
+                    total_str = size_match.group(3) + size_match.group(4)
+                    
+                    downloaded = self._parse_size(downloaded_str)
+                    total_size = self._parse_size(total_str)
+                    
+                    with self.lock:
+                        if download_id in self.active_downloads:
+                            self.active_downloads[download_id]['size'] = total_size
+                            self.active_downloads[download_id]['downloaded'] = downloaded
+                            self._update_speed(download_id, self.active_downloads[download_id])
                 
-                # Parse progress information
-                try:
-                    # Extract percentage
-                    percent_match = re.search(r'(\d+)%', line)
-                    if percent_match:
-                        progress = int(percent_match.group(1))
-                        with self.lock:
-                            if download_id in self.active_downloads:
-                                self.active_downloads[download_id]['progress'] = progress
+                # Extract speed information directly from aria2c output
+                speed_match = re.search(r'(\d+\.?\d*[KMGT]?i?B/s)', line)
+                if speed_match:
+                    speed = speed_match.group(1)
+                    with self.lock:
+                        if download_id in self.active_downloads:
+                            self.active_downloads[download_id]['speed'] = speed
+                else:
+                    # Calculate speed if not provided by aria2c
+                    current_time = time.time()
+                    elapsed = current_time - last_update_time
                     
-                    # Extract downloaded/total
-                    size_match = re.search(r'\((\d+\.?\d*)([KMGT]?i?B)/(\d+\.?\d*)([KMGT]?i?B)\)', line)
-                    if size_match:
-                        downloaded_str = size_match.group(1) + size_match.group(2)
-                        total_str = size_match.group(3) + size_match.group(4)
-                        
-                        downloaded = self._parse_size(downloaded_str)
-                        total_size = self._parse_size(total_str)
+                    if elapsed >= 1 and last_downloaded > 0:
+                        bytes_per_sec = (downloaded - last_downloaded) / elapsed
+                        speed = self._format_speed(bytes_per_sec)
                         
-                        with self.lock:
-                            if download_id in self.active_downloads:
-                                self.active_downloads[download_id]['size'] = total_size
-                                self.active_downloads[download_id]['downloaded'] = downloaded
-                    
-                    # Extract speed information directly from aria2c output
-                    speed_match = re.search(r'(\d+\.?\d*[KMGT]?i?B/s)', line)
-                    if speed_match:
-                        speed = speed_match.group(1)
                         with self.lock:
                             if download_id in self.active_downloads:
                                 self.active_downloads[download_id]['speed'] = speed
-                    else:
-                        # Calculate speed if not provided by aria2c
-                        current_time = time.time()
-                        elapsed = current_time - last_update_time
                         
-                        if elapsed >= 1 and last_downloaded > 0:
-                            bytes_per_sec = (downloaded - last_downloaded) / elapsed
-                            speed = self._format_speed(bytes_per_sec)
-                            
-                            with self.lock:
-                                if download_id in self.active_downloads:
-                                    self.active_downloads[download_id]['speed'] = speed
-                            
-                            last_update_time = current_time
-                            last_downloaded = downloaded
-                except Exception as e:
-                    print(f"Error parsing aria2c output: {e}")
-            
-            # Check if download was successful
-            if process.returncode == 0:
-                # Move file from temp to final location
-                temp_file = os.path.join(temp_dir, os.path.basename(final_path))
-                if os.path.exists(temp_file):
-                    os.makedirs(os.path.dirname(final_path), exist_ok=True)
-                    shutil.move(temp_file, final_path)
-                    os.chmod(final_path, 0o644)  # Set read permissions for everyone
-                    
-                    with self.lock:
-                        if download_id in self.active_downloads:
-                            self.active_downloads[download_id]['status'] = 'completed'
-                            self.active_downloads[download_id]['progress'] = 100
-                            self.active_downloads[download_id]['end_time'] = time.time()
-                            self.active_downloads[download_id]['speed'] = '0 B/s'
-                            
-                            # Add to download history
-                            self.download_history[download_id] = self.active_downloads[download_id].copy()
-                else:
-                    raise Exception("Download file not found in temp directory")
-            else:
-                raise Exception(f"aria2c failed with exit code {process.returncode}")
-                
-        except Exception as e:
-            with self.lock:
-                if download_id in self.active_downloads:
-                    self.active_downloads[download_id]['status'] = 'error'
-                    self.active_downloads[download_id]['error'] = str(e)
-                    self.active_downloads[download_id]['speed'] = '0 B/s'
-            print(f"Download error: {e}")
+                        last_update_time = current_time
+                        last_downloaded = downloaded
+            except Exception as e:
+                logger.warning("Error parsing aria2c output: %s", e, extra={'job_id': download_id})
+        
+        process.wait()
+        return process.returncode
+
+    def _read_lines(self, stream, lines):
+        """Copy a process's output into a queue line by line; None marks the end"""
+        try:
+            for line in stream:
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
         finally:
-            # Remove from processes
-            with self.lock:
-                if download_id in self.processes:
-                    del self.processes[download_id]
-            
-            # Clean up temp directory
-            if os.path.exists(temp_dir):
-                try:
-                    shutil.rmtree(temp_dir)
-                except Exception:
-                    pass
+            lines.put(None)
+
+    def _signal_process(self, process, sig):
+        """Send a signal to a process's group, or to the process alone where groups are unavailable"""
+        try:
+            if hasattr(os, 'killpg') and hasattr(os, 'getpgid'):
+                os.killpg(os.getpgid(process.pid), sig)
+            else:
+                process.send_signal(sig)
+        except (OSError, ValueError):
+            pass  # Already gone
+
+    def _terminate_process(self, process):
+        """SIGTERM a process, then SIGKILL it if it has not exited within KILL_TIMEOUT"""
+        self._signal_process(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=KILL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning("aria2c (pid %d) ignored SIGTERM, killing it", process.pid)
+            self._signal_process(process, signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+            process.wait()
 
     def _parse_size(self, size_str):
         """Parse size string like 10.5MB to bytes"""
@@ -327,67 +1570,70 @@ class DownloadManager:
         else:
             return f"{bytes_per_sec/(1024*1024*1024):.1f} GB/s"
 
-    def _download_with_requests(self, download_id, url, temp_path, final_path):
-        """Download using requests as a fallback"""
+    def _download_with_requests(self, download_id):
+        """Download using requests, fetching byte ranges in parallel when the server allows it"""
+        with self.lock:
+            if download_id not in self.active_downloads:
+                return
+            
+            job = self.active_downloads[download_id]
+            if job['status'] == 'initializing':  # Not paused or cancelled before the thread got going
+                self._set_status(job, 'downloading')
+            job['speed'] = '0 B/s'  # Initialize speed
+            urls = list(job['urls'])
+            temp_dir = job['temp_dir']
+            temp_path = job['temp_path']
+            final_path = job['final_path']
+            policy = job['retry']
+            segments = job['segments']
+            engine = job['engine']
+        
         try:
-            with self.lock:
-                if download_id not in self.active_downloads:
-                    return
-                
-                self.active_downloads[download_id]['status'] = 'downloading'
-                self.active_downloads[download_id]['speed'] = '0 B/s'  # Initialize speed
+            if engine == 'auto':
+                self._resolve_engine(download_id, urls[0])
             
             # Create directory for temp path
             os.makedirs(os.path.dirname(temp_path), exist_ok=True)
             
-            # Start the download
-            session = requests.Session()
-            response = session.get(url, stream=True, timeout=30)
-            response.raise_for_status()
+            # Resume from the bytes already on disk if a previous run left them behind
+            if not segments or not os.path.exists(temp_path):
+                segments = self._plan_segments(download_id, urls, temp_path)
+            
+            errors = []
+            single = len(segments) == 1
             
-            # Get file size
-            total_size = int(response.headers.get('content-length', 0))
+            def run_segment(segment):
+                try:
+                    # Once its own range is done, a worker takes over half of another
+                    while segment is not None:
+                        self._download_segment(download_id, segment, single)
+                        segment = None if self._is_stopped(download_id) else self._split_segment(download_id)
+                except Exception as e:
+                    errors.append(e)
+                    # Stop the other segments; there is no point finishing the file
+                    self.stop_events[download_id].set()
+            
+            pending = [segment for segment in segments if not self._segment_done(segment)]
             with self.lock:
-                if download_id in self.active_downloads:
-                    self.active_downloads[download_id]['size'] = total_size
+                # Idle workers steal ranges rather than exit, so this many connections stay open
+                self.active_downloads[download_id]['connections'] = len(pending)
+            threads = [
+                threading.Thread(target=run_segment, args=(segment,), name=f"job-{download_id}-segment", daemon=True)
+                for segment in pending[1:]
+            ]
+            for thread in threads:
+                thread.start()
+            if pending:
+                run_segment(pending[0])
+            for thread in threads:
+                thread.join()
             
-            # Download the file
-            downloaded = 0
-            last_update_time = time.time()
-            last_downloaded = 0
-            chunk_size = 8192
+            if errors:
+                raise errors[0]
+            if self._is_stopped(download_id):
+                return  # Cancelled
             
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    # Check if download was cancelled
-                    with self.lock:
-                        if download_id not in self.active_downloads or self.active_downloads[download_id]['status'] == 'cancelled':
-                            return
-                    
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        # Update progress
-                        current_time = time.time()
-                        elapsed = current_time - last_update_time
-                        
-                        if total_size > 0:
-                            progress = int((downloaded / total_size) * 100)
-                            
-                            with self.lock:
-                                if download_id in self.active_downloads:
-                                    self.active_downloads[download_id]['progress'] = progress
-                                    self.active_downloads[download_id]['downloaded'] = downloaded
-                                    
-                                    # Calculate and update speed
-                                    if elapsed >= 1:
-                                        bytes_per_sec = (downloaded - last_downloaded) / elapsed
-                                        speed = self._format_speed(bytes_per_sec)
-                                        self.active_downloads[download_id]['speed'] = speed
-                                        
-                                        last_update_time = current_time
-                                        last_downloaded = downloaded
+            self._verify_file_hash(download_id, temp_path)
             
             # Move to final location
             os.makedirs(os.path.dirname(final_path), exist_ok=True)
@@ -396,85 +1642,876 @@ class DownloadManager:
             
             with self.lock:
                 if download_id in self.active_downloads:
-                    self.active_downloads[download_id]['status'] = 'completed'
-                    self.active_downloads[download_id]['progress'] = 100
-                    self.active_downloads[download_id]['end_time'] = time.time()
-                    self.active_downloads[download_id]['speed'] = '0 B/s'
+                    job = self.active_downloads[download_id]
+                    job['size'] = job['size'] or job['downloaded']
+            self._complete_download(download_id)
+            
+        except Exception as e:
+            self._fail_download(download_id, e)
+        finally:
+            self._finish_run(download_id, temp_dir)
+
+    def _download_with_hls(self, download_id):
+        """Download an HLS stream into one file.
+
+        Segments are fetched HLS_WORKERS at a time, at most HLS_WINDOW ahead of
+        the next one to be written, and appended to the output in playlist
+        order as soon as that one lands. A retried job resumes after the last
+        segment that was written.
+        """
+        with self.lock:
+            if download_id not in self.active_downloads:
+                return
+            
+            job = self.active_downloads[download_id]
+            if job['status'] == 'initializing':  # Not paused or cancelled before the thread got going
+                self._set_status(job, 'downloading')
+            job['speed'] = '0 B/s'  # Initialize speed
+            url = job['url']
+            temp_dir = job['temp_dir']
+            media = job.get('media')
+        
+        session = requests.Session()
+        pool = None
+        try:
+            variant, segments = self._load_media_playlist(session, url)
+            fragmented = any(segment['init'] for segment in segments)
+            
+            with self.lock:
+                resume = (
+                    media and media['variant'] == variant and media['segments'] == len(segments)
+                    and os.path.exists(job['temp_path'])
+                )
+                if not resume:
+                    media = job['media'] = {'variant': variant, 'segments': len(segments), 'written': 0, 'bytes': 0}
+                    if fragmented and job['filename'].endswith('.ts'):
+                        # fMP4 segments (EXT-X-MAP) make an MP4 file, not a transport stream
+                        job['filename'] = job['filename'][:-3] + '.mp4'
+                        job['temp_path'] = job['temp_path'][:-3] + '.mp4'
+                        job['final_path'] = self.storage.path_for(job['filename'], download_id)
+                job['downloaded'] = media['bytes']
+                job['connections'] = HLS_WORKERS
+                temp_path = job['temp_path']
+                final_path = job['final_path']
+                written = media['written']
+            
+            keys = {}  # Key URI -> key, fetched once per stream
+            pool = ThreadPoolExecutor(max_workers=HLS_WORKERS, thread_name_prefix=f"job-{download_id}-hls")
+            futures = {}
+            next_fetch = written
+            with open(temp_path, 'r+b' if resume else 'wb') as out:
+                out.truncate(media['bytes'])
+                out.seek(media['bytes'])
+                
+                while written < len(segments):
+                    while next_fetch < len(segments) and next_fetch < written + HLS_WINDOW:
+                        part_path = os.path.join(temp_dir, f"segment_{next_fetch}")
+                        futures[next_fetch] = pool.submit(
+                            self._fetch_media_segment, download_id, session, segments[next_fetch], keys, part_path
+                        )
+                        next_fetch += 1
                     
-                    # Add to download history
-                    self.download_history[download_id] = self.active_downloads[download_id].copy()
+                    part_path = futures.pop(written).result()
+                    if part_path is None:
+                        return  # Cancelled
+                    with open(part_path, 'rb') as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(part_path)
+                    out.flush()
+                    written += 1
+                    
+                    with self.lock:
+                        media['written'] = written
+                        media['bytes'] = out.tell()
+                        job['progress'] = written * 100 // len(segments)
+            
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            shutil.move(temp_path, final_path)
+            os.chmod(final_path, 0o644)  # Set read permissions
+            
+            with self.lock:
+                job['size'] = media['bytes']
+                job['downloaded'] = media['bytes']
+            self._complete_download(download_id)
             
         except Exception as e:
+            # Stop the other segment fetches; the written prefix is kept for a retry
+            self.stop_events[download_id].set()
+            self._fail_download(download_id, e)
+        finally:
+            if pool:
+                pool.shutdown(wait=True, cancel_futures=True)
+            self._finish_run(download_id, temp_dir)
+
+    def _load_media_playlist(self, session, url):
+        """Fetch a playlist, following a master playlist to its selected variant; returns the variant URL and segments"""
+        text, base_url = fetch_playlist(session, url)
+        playlist = parse_playlist(text, base_url)
+        variant = url
+        if 'variants' in playlist:
+            variant = select_variant(playlist['variants'], self.hls_max_bandwidth)['url']
+            text, base_url = fetch_playlist(session, variant)
+            playlist = parse_playlist(text, base_url)
+            if 'variants' in playlist:
+                raise HlsError("Variant is itself a master playlist")
+        if not playlist['ended']:
+            raise HlsError("Live playlists are not supported; the playlist has no EXT-X-ENDLIST")
+        return variant, playlist['segments']
+
+    def _fetch_media_segment(self, download_id, session, segment, keys, path):
+        """Download and decrypt one media segment to path, retrying with backoff. Returns None if the job stopped."""
+        with self.lock:
+            policy = self.active_downloads[download_id]['retry']
+        
+        headers = {}
+        if segment['byterange']:
+            offset, length = segment['byterange']
+            headers['Range'] = f"bytes={offset}-{offset + length - 1}"
+        
+        attempt = 0
+        while True:
+            if self._is_stopped(download_id):
+                return None
+            received = 0
+            try:
+                with session.get(segment['url'], headers=headers, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if headers and response.status_code != 206:
+                        raise RetryableError(f"{urlparse(segment['url']).netloc} ignored the range request")
+                    chunks = []
+                    last_chunk_time = time.time()
+                    for chunk in self._iter_response(download_id, response):
+                        chunks.append(chunk)
+                        received += len(chunk)
+                        current_time = time.time()
+                        self._add_progress(download_id, len(chunk), elapsed=current_time - last_chunk_time)
+                        last_chunk_time = current_time
+                if self._is_stopped(download_id):
+                    return None
+                break
+            except Exception as e:
+                # Bytes of a failed attempt are fetched again
+                self._add_progress(download_id, -received)
+                attempt += 1
+                if attempt >= policy['max_attempts'] or not self._is_retryable(e, policy):
+                    raise
+                if self._wait_before_retry(download_id, policy, attempt, e):
+                    return None
+        
+        data = b''.join(chunks)
+        if segment['key']:
+            data = decrypt_segment(data, self._media_key(session, segment['key']['uri'], keys), segment_iv(segment))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _media_key(self, session, uri, keys):
+        """The AES-128 key at uri, fetched on first use"""
+        key = keys.get(uri)
+        if key is None:
+            response = session.get(uri, timeout=30)
+            response.raise_for_status()
+            if len(response.content) != 16:
+                raise HlsError(f"Key at {uri} is not a 16-byte AES-128 key")
+            key = keys[uri] = response.content
+        return key
+
+    def _resolve_engine(self, download_id, url):
+        """Settle an 'auto' job on http2 if the origin negotiates it, else requests"""
+        engine = 'http2' if self.http2 and self.http2.negotiates_h2(url) else 'requests'
+        with self.lock:
+            if download_id in self.active_downloads:
+                self.active_downloads[download_id]['engine'] = engine
+
+    def _open_session(self, download_id):
+        """HTTP session for a job: multiplexed over the shared HTTP/2 pool, or a requests session"""
+        with self.lock:
+            engine = self.active_downloads[download_id]['engine']
+        if engine == 'http2':
+            if not self.http2:
+                raise Exception("The http2 engine requires httpx with HTTP/2 support")
+            return self.http2.session()
+        return requests.Session()
+
+    def _plan_segments(self, download_id, urls, temp_path):
+        """Probe the source and split the job into byte ranges"""
+        size = 0
+        accept_ranges = False
+        session = self._open_session(download_id)
+        for url in urls:
+            try:
+                metadata = self._probe_url(url, session)
+                if metadata['ok']:
+                    size = metadata['size']
+                    accept_ranges = metadata['accept_ranges']
+                    break
+            except Exception:
+                continue
+        
+        with self.lock:
+            job = self.active_downloads[download_id]
+            size = size or job['size']
+            if job['tuned']:
+                job['split'] = self.host_profiles.plan(urls[0], size)['split']
+            split = job['split']
+        pieces = self.piece_hashes.get(download_id)
+        
+        if size > 0 and accept_ranges and split > 1 and size >= 2 * MIN_SPLIT_SIZE:
+            # At least one segment per source so every mirror contributes bandwidth
+            count = min(max(split, len(urls)), size // MIN_SPLIT_SIZE)
+            step = -(-size // count)
+            if pieces:
+                # Align segments to pieces so each piece is written by one segment
+                step = -(-step // pieces['length']) * pieces['length']
+            segments = [
+                {'index': index, 'start': start, 'end': min(start + step, size) - 1, 'pos': start}
+                for index, start in enumerate(range(0, size, step))
+            ]
+        else:
+            # A single stream; 'end' stays unknown until the server closes it if there is no size
+            segments = [{'index': 0, 'start': 0, 'end': size - 1 if size > 0 else None, 'pos': 0}]
+        
+        if pieces:
+            # Offset up to which the segment's pieces have passed verification
+            for segment in segments:
+                segment['verified'] = segment['start']
+        
+        # Preallocate so every segment can write at its own offset
+        with open(temp_path, 'wb') as f:
+            if size > 0:
+                f.truncate(size)
+        
+        with self.lock:
+            job = self.active_downloads[download_id]
+            job['size'] = size
+            job['downloaded'] = 0
+            job['progress'] = 0
+            job['accept_ranges'] = accept_ranges
+            job['segments'] = segments
+        
+        return segments
+
+    def _split_segment(self, download_id):
+        """Hand an idle worker the second half of an unfinished segment's remaining range.
+
+        While a client is streaming the file the leading unfinished segment is
+        split, so the contiguous prefix grows sooner; otherwise the largest.
+        """
+        pieces = self.piece_hashes.get(download_id)
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job or not job['accept_ranges'] or job['split'] < 2:
+                return None
+            
+            # The margin keeps the new range clear of the chunk the owner is writing
+            candidates = [
+                segment for segment in job['segments']
+                if segment['end'] is not None and segment['end'] - segment['pos'] + 1 >= 2 * MIN_SPLIT_SIZE
+            ]
+            if not candidates:
+                return None
+            if job['stream_readers']:
+                victim = min(candidates, key=lambda segment: segment['start'])
+            else:
+                victim = max(candidates, key=lambda segment: segment['end'] - segment['pos'])
+            
+            start = victim['pos'] + (victim['end'] - victim['pos'] + 1) // 2
+            if pieces:
+                start = -(-start // pieces['length']) * pieces['length']
+                if start > victim['end']:
+                    return None
+            
+            segment = {'index': len(job['segments']), 'start': start, 'end': victim['end'], 'pos': start}
+            if pieces:
+                segment['verified'] = start
+            victim['end'] = start - 1
+            job['segments'].append(segment)
+            return segment
+
+    def _segment_done(self, segment):
+        """Check whether every byte of a segment has been written"""
+        return segment['end'] is not None and segment['pos'] > segment['end']
+
+    def _download_segment(self, download_id, segment, single):
+        """Fetch one byte range, retrying with backoff and failing over between mirrors"""
+        with self.lock:
+            job = self.active_downloads[download_id]
+            urls = job['urls']
+            policy = job['retry']
+        
+        session = self._open_session(download_id)
+        attempt = 0
+        failed_url = None
+        while not self._segment_done(segment) and not self._is_stopped(download_id):
+            url = self._pick_source(download_id, exclude=failed_url)
+            try:
+                self._fetch_segment(download_id, session, url, segment, single)
+            except Exception as e:
+                attempt += 1
+                failed_url = url
+                self._record_source_failure(download_id, url)
+                if attempt >= policy['max_attempts'] or not self._is_retryable(e, policy, len(urls)):
+                    raise
+                if self._wait_before_retry(download_id, policy, attempt, e):
+                    return
+
+    def _pick_source(self, download_id, exclude=None):
+        """Choose a source for the next request, weighted by its observed throughput"""
+        with self.lock:
+            sources = self.active_downloads[download_id]['sources']
+            candidates = [url for url in sources if url != exclude] or list(sources)
+            
+            rates = {
+                url: sources[url]['bytes'] / sources[url]['seconds']
+                for url in candidates if sources[url]['seconds'] > 0
+            }
+            # Untried sources get the best observed rate so they are explored early
+            best = max(rates.values(), default=1.0) or 1.0
+            weights = [rates.get(url, best) / (2 ** sources[url]['failures']) for url in candidates]
+        
+        return random.choices(candidates, weights=weights)[0]
+
+    def _record_source_failure(self, download_id, url):
+        """Count a failed request against a source"""
+        if self.url_cache:
+            # The cached redirect target may have expired; go through the original URL next time
+            self.url_cache.invalidate(url)
+        with self.lock:
+            if download_id in self.active_downloads:
+                source = self.active_downloads[download_id]['sources'].get(url)
+                if source:
+                    source['failures'] += 1
+
+    def _fetch_segment(self, download_id, session, url, segment, single):
+        """Stream the rest of a segment from url into the temp file"""
+        with self.lock:
+            job = self.active_downloads[download_id]
+            temp_path = job['temp_path']
+            accept_ranges = job['accept_ranges']
+        pieces = self.piece_hashes.get(download_id)
+        
+        headers = {}
+        if accept_ranges and (segment['pos'] > 0 or not single):
+            end = segment['end'] if segment['end'] is not None else ''
+            headers['Range'] = f"bytes={segment['pos']}-{end}"
+        elif segment['pos'] > 0:
+            # No range support: the only option is to start over
+            self._add_progress(download_id, -segment['pos'])
+            segment['pos'] = 0
+        
+        # Skip the redirect chain the metadata probe already followed
+        request_url = self.url_cache.final_url(url) if self.url_cache else url
+        with session.get(request_url, headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            
+            if headers and response.status_code != 206:
+                if not single:
+                    raise RetryableError(f"{urlparse(url).netloc} ignored the range request")
+                # Whole file sent again; rewrite it from the start
+                self._add_progress(download_id, -segment['pos'])
+                segment['pos'] = 0
+            
+            with open(temp_path, 'r+b') as f:
+                f.seek(segment['pos'])
+                last_chunk_time = time.time()
+                for chunk in self._iter_response(download_id, response):
+                    if segment['end'] is not None:
+                        chunk = chunk[:segment['end'] - segment['pos'] + 1]
+                    
+                    f.write(chunk)
+                    segment['pos'] += len(chunk)
+                    
+                    current_time = time.time()
+                    self._add_progress(download_id, len(chunk), url, current_time - last_chunk_time)
+                    last_chunk_time = current_time
+                    
+                    if pieces and segment['end'] is not None:
+                        f.flush()
+                        self._verify_pieces(download_id, f, segment, pieces)
+                    
+                    if self._segment_done(segment):
+                        break
+        
+        # Check if download was cancelled
+        if self._is_stopped(download_id):
+            return
+        if segment['end'] is None:
+            # Unknown length: the server closing the stream marks the end
+            segment['end'] = segment['pos'] - 1
+        elif not self._segment_done(segment):
+            raise RetryableError("Connection closed before the segment was complete")
+
+    def _iter_response(self, download_id, response):
+        """Chunks of a response body, watched for stalls; ends early once the job is stopped"""
+        transfer = self._watch_transfer(download_id, response)
+        throttle = self._job_throttle(download_id)
+        transfer['throttled'] = throttle is not None
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if self._is_stopped(download_id):
+                    return
+                if transfer['stalled']:
+                    raise StallError(transfer['stalled'])
+                if not chunk:
+                    continue
+                transfer['bytes'] += len(chunk)
+                transfer['last_data'] = time.time()
+                yield chunk
+                
+                delay = throttle.delay(len(chunk)) if throttle else 0
+                if delay:
+                    # Pausing reads lets the connection's receive window close, slowing the sender
+                    event = self.stop_events.get(download_id)
+                    if event is None or event.wait(delay):
+                        return
+                    transfer['last_data'] = time.time()
+        except Exception as e:
+            # The watchdog or a cancel shut the connection down under the read
+            if self._is_stopped(download_id):
+                return
+            if transfer['stalled'] and not isinstance(e, StallError):
+                raise StallError(transfer['stalled']) from e
+            raise
+        finally:
+            self._unwatch_transfer(download_id, transfer)
+
+    def _watch_transfer(self, download_id, response):
+        """Register an open response with the stall watchdog"""
+        now = time.time()
+        transfer = {
+            'response': response,
+            'bytes': 0,  # Received so far; only the fetching thread writes it
+            'last_data': now,
+            'window_start': now,  # Low-speed window, and the byte count when it opened
+            'window_bytes': 0,
+            'stalled': None,  # Why the watchdog dropped the connection
+            'throttled': False  # Held to a window's bandwidth cap, so exempt from the low-speed check
+        }
+        with self.lock:
+            self.transfers.setdefault(download_id, []).append(transfer)
+        return transfer
+
+    def _unwatch_transfer(self, download_id, transfer):
+        with self.lock:
+            transfers = self.transfers.get(download_id, [])
+            if transfer in transfers:
+                transfers.remove(transfer)
+            if not transfers:
+                self.transfers.pop(download_id, None)
+
+    def _watchdog_loop(self):
+        """Drop connections that stopped receiving or slowed to a trickle, so their segments reconnect"""
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            now = time.time()
+            with self.lock:
+                for download_id, transfers in self.transfers.items():
+                    for transfer in transfers:
+                        if transfer['stalled']:
+                            continue
+                        
+                        reason = None
+                        if self.stall_timeout and now - transfer['last_data'] >= self.stall_timeout:
+                            reason = f"No progress for {self.stall_timeout}s"
+                        elif (self.low_speed_limit and not transfer['throttled']
+                              and now - transfer['window_start'] >= self.low_speed_time):
+                            rate = (transfer['bytes'] - transfer['window_bytes']) / (now - transfer['window_start'])
+                            if rate <= self.low_speed_limit:
+                                reason = f"Slower than {self._format_speed(self.low_speed_limit)} for {self.low_speed_time}s"
+                            transfer['window_start'] = now
+                            transfer['window_bytes'] = transfer['bytes']
+                        
+                        if reason:
+                            logger.info("Download %s: %s, reconnecting", download_id, reason, extra={'job_id': download_id})
+                            transfer['stalled'] = reason
+                            self.stalls += 1
+                            self._abort_transfer(transfer)
+
+    def _abort_transfer(self, transfer):
+        """Unblock a thread waiting in iter_content on a response. Caller must hold self.lock."""
+        response = transfer['response']
+        if hasattr(response, 'abort'):
+            # Http2Response: the reader wakes within ABORT_POLL; its connection stays up for other jobs
+            response.abort()
+            return
+        try:
+            # Closing the response does not wake a blocked read; shutting the socket down does
+            response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def _verify_pieces(self, download_id, f, segment, pieces):
+        """Check every Metalink piece the segment has finished writing.
+
+        Segments are piece-aligned, so the pieces between segment['start'] and
+        the write position belong to this segment alone. A bad piece is
+        discarded and the segment resumes from its start on another source.
+        """
+        length = pieces['length']
+        next_piece = segment['verified']
+        
+        while next_piece <= segment['end'] and (next_piece + length <= segment['pos'] or self._segment_done(segment)):
+            index = next_piece // length
+            piece_size = min(length, segment['end'] + 1 - next_piece)
+            data = os.pread(f.fileno(), piece_size, next_piece)
+            
+            if index < len(pieces['hashes']) and hashlib.new(pieces['type'], data).hexdigest() != pieces['hashes'][index]:
+                self._add_progress(download_id, next_piece - segment['pos'])
+                segment['pos'] = next_piece
+                f.seek(next_piece)
+                raise RetryableError(f"Piece {index} failed {pieces['type']} verification")
+            
+            next_piece += piece_size
+            segment['verified'] = next_piece
             with self.lock:
                 if download_id in self.active_downloads:
-                    self.active_downloads[download_id]['status'] = 'error'
-                    self.active_downloads[download_id]['error'] = str(e)
-                    self.active_downloads[download_id]['speed'] = '0 B/s'
-            print(f"Download error: {e}")
+                    self.active_downloads[download_id]['verified_pieces'] += 1
+
+    def _verify_file_hash(self, download_id, path):
+        """Compare the finished file against the strongest hash the job came with"""
+        with self.lock:
+            expected = strongest_hash(self.active_downloads[download_id].get('hashes') or {})
+        if not expected:
+            return
+        
+        hash_type, digest = expected
+        hasher = hashlib.new(hash_type)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        if hasher.hexdigest() != digest:
+            with self.lock:
+                # Start over on the next retry; the bytes on disk cannot be trusted
+                self.active_downloads[download_id]['segments'] = []
+            raise Exception(f"{hash_type} checksum mismatch")
+
+    def _add_progress(self, download_id, nbytes, source=None, elapsed=0.0):
+        """Account for bytes written by the requests engine and refresh progress and speed"""
+        with self.lock:
+            if download_id not in self.active_downloads:
+                return
+            
+            job = self.active_downloads[download_id]
+            job['downloaded'] += nbytes
+            if source in job['sources']:
+                job['sources'][source]['bytes'] += nbytes
+                job['sources'][source]['seconds'] += elapsed
+            if job['size'] > 0:
+                job['progress'] = min(100, int((job['downloaded'] / job['size']) * 100))
+            
+            # Calculate and update speed
+            if self._update_speed(download_id, job):
+                job['speed'] = self._format_speed(job['speed_bps'])
+
+    def _update_speed(self, download_id, job):
+        """Sample a job's byte count and refresh its smoothed speed, average and ETA.
+
+        Returns True if the fields changed. Caller must hold self.lock.
+        """
+        series = self.speed_series.get(download_id)
+        if series is None or not series.add(time.time(), job['downloaded']):
+            return False
+        job['speed_bps'] = round(series.speed)
+        job['average_speed'] = round(series.average())
+        job['eta'] = series.eta(job['size'] - job['downloaded']) if job['size'] > 0 else None
+        return True
+
+    def _clear_speed(self, job):
+        """Zero the live speed of a job that is not transferring. Caller must hold self.lock."""
+        job['speed'] = '0 B/s'
+        job['speed_bps'] = 0
+        job['eta'] = None
+
+    def resolve_file(self, filename):
+        """Path on disk of the completed file served as /downloads/<filename>, or None if none is known"""
+        return self.storage.resolve(filename)
+
+    def find_active_download(self, filename):
+        """Find the in-progress job that will produce the given file"""
+        with self.lock:
+            for download_id, job in self.active_downloads.items():
+                if job['filename'] == filename and job['status'] in ('initializing', 'downloading'):
+                    return download_id
+            return None
+
+    def _write_frontier(self, download_id):
+        """Number of leading bytes of a job's file that are on disk and final"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job:
+                return 0
+            if job['status'] == 'completed':
+                return job['size'] or job['downloaded']
+            
+            if job['engine'] == 'hls':
+                # Segments are appended in order, so everything written is final
+                return job['media']['bytes'] if job.get('media') else 0
+            
+            if job['engine'] != 'aria2':
+                # Contiguous prefix of the segments; verified pieces only for Metalink jobs
+                frontier = 0
+                for segment in sorted(job['segments'], key=lambda segment: segment['start']):
+                    if segment['start'] > frontier:
+                        break
+                    frontier = max(frontier, segment.get('verified', segment['pos']))
+                    if not self._segment_done(segment):
+                        break
+                return frontier
+            
+            temp_path = job['temp_path']
+            size = job['size']
+        
+        frontier = self._aria2_frontier(temp_path + '.aria2')
+        if frontier is None:
+            # aria2c keeps no control file when the size is unknown; it writes sequentially
+            if size:
+                return 0
+            try:
+                return os.path.getsize(temp_path)
+            except OSError:
+                return 0
+        return frontier
+
+    def _aria2_frontier(self, control_path):
+        """Length of the leading run of completed pieces recorded in an aria2 control file"""
+        try:
+            with open(control_path, 'rb') as f:
+                data = f.read()
+            
+            # Version 1 files are big-endian; version 0 used the host byte order
+            version = struct.unpack('>H', data[0:2])[0]
+            order = '>' if version == 1 else '='
+            info_hash_length = struct.unpack(order + 'I', data[6:10])[0]
+            offset = 10 + info_hash_length
+            piece_length, total_length = struct.unpack(order + 'IQ', data[offset:offset + 12])
+            offset += 20  # Skip the upload length
+            bitfield_length = struct.unpack(order + 'I', data[offset:offset + 4])[0]
+            bitfield = data[offset + 4:offset + 4 + bitfield_length]
+        except (OSError, struct.error):
+            return None
+        
+        pieces = 0
+        for byte in bitfield:
+            if byte == 0xff:
+                pieces += 8
+                continue
+            while byte & 0x80:
+                pieces += 1
+                byte = (byte << 1) & 0xff
+            break
+        return min(total_length, pieces * piece_length)
+
+    def stream_download(self, download_id, poll_interval=0.25, running_only=False):
+        """Yield a file's bytes while it is still downloading, following the write frontier.
+
+        With running_only the stream also ends when the job stops running
+        without completing, e.g. paused by its download window, rather than
+        waiting for it to resume.
+        """
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job:
+                return
+            job['stream_readers'] += 1
+        
+        f = None
+        position = 0
+        try:
+            while True:
+                with self.lock:
+                    status = job['status']
+                    size = job['size']
+                    path = job['final_path'] if status == 'completed' else job['temp_path']
+                if running_only and status not in ('initializing', 'downloading', 'completed'):
+                    return
+                
+                if f is None:
+                    # Once open, the file stays readable even after it is moved into place
+                    try:
+                        f = open(path, 'rb')
+                    except OSError:
+                        if status in ('error', 'cancelled'):
+                            return
+                        time.sleep(poll_interval)
+                        continue
+                
+                frontier = self._write_frontier(download_id)
+                if position < frontier:
+                    data = os.pread(f.fileno(), min(CHUNK_SIZE, frontier - position), position)
+                    if not data:
+                        return
+                    position += len(data)
+                    yield data
+                    continue
+                
+                if status in ('error', 'cancelled') or (status == 'completed' and position >= frontier):
+                    return
+                time.sleep(poll_interval)
         finally:
-            # Cleanup temp file
-            if os.path.exists(temp_path):
-                try:
-                    os.remove(temp_path)
-                except Exception:
-                    pass
+            if f is not None:
+                f.close()
+            with self.lock:
+                job['stream_readers'] -= 1
+
+    def _snapshot(self, job, speed_history=True):
+        """Copy of a job that is safe to serialise while its workers keep running"""
+        snapshot = dict(job)
+        if not speed_history:
+            snapshot.pop('speed_history', None)
+        if 'segments' in job:
+            snapshot['segments'] = [dict(segment) for segment in job['segments']]
+        if 'sources' in job:
+            snapshot['sources'] = {url: dict(stats) for url, stats in job['sources'].items()}
+        if 'postprocess' in job:
+            snapshot['postprocess'] = [dict(stage) for stage in job['postprocess']]
+        return snapshot
 
     def get_download_status(self, download_id):
         """Get current status of a download"""
         with self.lock:
             if download_id in self.active_downloads:
-                return self.active_downloads[download_id]
+                snapshot = self._snapshot(self.active_downloads[download_id])
+                series = self.speed_series.get(download_id)
+                if series:
+                    # Live graph data for the job so far
+                    snapshot['speed_history'] = series.history()
+                return snapshot
             elif download_id in self.download_history:
-                return self.download_history[download_id]
+                return self._snapshot(self.download_history[download_id])
             return None
 
-    def get_all_downloads(self):
-        """Get all active and completed downloads"""
+    def get_all_downloads(self, history_offset=0, history_limit=None):
+        """Get all active and completed downloads.
+
+        With history_limit, only that many history entries from
+        history_offset on are included; history_total counts them all.
+        """
         with self.lock:
             # Sort downloads by start time (newest first)
             active = sorted(
-                list(self.active_downloads.values()), 
+                [self._snapshot(job, speed_history=False) for job in self.active_downloads.values()], 
                 key=lambda x: x['start_time'], 
                 reverse=True
             )
             
-            history = sorted(
-                list(self.download_history.values()), 
-                key=lambda x: x['start_time'], 
-                reverse=True
-            )
+            # Only the requested page is copied; the order is kept until the history changes
+            if self.history_order is None:
+                self.history_order = sorted(
+                    self.download_history,
+                    key=lambda download_id: self.download_history[download_id]['start_time'],
+                    reverse=True
+                )
+            end = None if history_limit is None else history_offset + history_limit
+            
+            # Speed histories are only served per job, to keep the polled list small
+            history = [
+                self._snapshot(self.download_history[download_id], speed_history=False)
+                for download_id in self.history_order[history_offset:end]
+            ]
             
             return {
                 'active': active,
-                'history': history
+                'history': history,
+                'history_total': len(self.history_order),
+                'history_offset': history_offset
             }
 
+    def get_export_entries(self, download_ids=None, name_filter=None, since=None):
+        """List (path, arcname) pairs of completed downloads for an archive export.
+
+        Selects the given job ids, or every completed download matching the
+        optional filename substring and minimum completion time.
+        """
+        with self.lock:
+            if download_ids:
+                jobs = [self.download_history[i] for i in download_ids if i in self.download_history]
+            else:
+                jobs = sorted(self.download_history.values(), key=lambda x: x['start_time'])
+                if name_filter:
+                    jobs = [job for job in jobs if name_filter.lower() in job['filename'].lower()]
+                if since:
+                    jobs = [job for job in jobs if (job['end_time'] or 0) >= since]
+            
+            entries = []
+            seen = set()
+            for job in jobs:
+                path = job['final_path']
+                # Only files inside the download directory, each once
+                if path in seen or not path.startswith(self.download_dir + os.sep):
+                    continue
+                seen.add(path)
+                entries.append((path, job['filename']))
+            return entries
+
     def cancel_download(self, download_id):
         """Cancel an active download"""
         with self.lock:
             if download_id in self.active_downloads:
-                self.active_downloads[download_id]['status'] = 'cancelled'
-                
-                # Kill associated process if it exists
-                if download_id in self.processes:
-                    try:
-                        process = self.processes[download_id]
-                        # Try process group kill first (Linux)
-                        try:
-                            if hasattr(os, 'killpg') and hasattr(os, 'getpgid'):
-                                os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-                            else:
-                                process.terminate()
-                        except Exception:
-                            process.terminate()
-                    except Exception as e:
-                        print(f"Failed to terminate process: {e}")
-                
+                job = self.active_downloads[download_id]
+                if job['status'] in ('completed', 'error', 'cancelled'):
+                    return False
+                if job['status'] == 'queued':
+                    # Never started: nothing to stop, just its empty temp directory to remove
+                    self.pending.remove(download_id)
+                    shutil.rmtree(job['temp_dir'], ignore_errors=True)
+                elif job['status'] == 'scheduled':
+                    # Waiting, possibly paused with a partial file its stopped run left behind
+                    self.deferred.discard(download_id)
+                    thread = self.threads.get(download_id)
+                    if not (thread and thread.is_alive()):
+                        shutil.rmtree(job['temp_dir'], ignore_errors=True)
+                self._set_status(job, 'cancelled')
+                self._stop_run(download_id)
                 return True
             return False
 
+    def release_download(self, download_id, reason):
+        """Stop a job's run but keep its temp files, so another cluster node can continue it"""
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job or job['status'] in ('completed', 'error', 'cancelled'):
+                return False
+            job['error'] = reason
+            self._clear_speed(job)
+            self._set_status(job, 'error')
+            self._stop_run(download_id)
+            return True
+
+    def release_scheduled(self, download_id):
+        """Forget a job waiting for its start time, keeping its temp files, so the cluster queue holds it instead.
+
+        Returns False if the job is not waiting or its paused run has not exited yet.
+        """
+        with self.lock:
+            job = self.active_downloads.get(download_id)
+            if not job or job['status'] != 'scheduled':
+                return False
+            thread = self.threads.get(download_id)
+            if thread and thread.is_alive():
+                return False
+            self.deferred.discard(download_id)
+            del self.active_downloads[download_id]
+            for table in (self.threads, self.stop_events, self.speed_series, self.piece_hashes):
+                table.pop(download_id, None)
+            return True
+
+    def _stop_run(self, download_id):
+        """Signal a job's workers to stop and kill its aria2c process. Caller must hold self.lock."""
+        if download_id in self.stop_events:
+            self.stop_events[download_id].set()
+        
+        # Wake segment threads blocked on the network; they see the stop event and exit
+        for transfer in self.transfers.get(download_id, []):
+            self._abort_transfer(transfer)
+        
+        # Kill associated process if it exists; the job's monitor escalates to SIGKILL
+        if download_id in self.processes:
+            self._signal_process(self.processes[download_id], signal.SIGTERM)
+
     def clear_download_history(self):
         """Clear download history"""
         with self.lock:
             self.download_history.clear()
-            return True
+            self.history_order = None
+        self._compact_manifest(cleared=True)
+        return True
@@ -0,0 +1,120 @@
+import time
+from collections import deque
+
+# Share of a user without an entry in USER_WEIGHTS
+DEFAULT_WEIGHT = 1.0
+
+# Length of a byte quota window; windows are aligned to the epoch, so daily quotas reset at midnight UTC
+QUOTA_PERIOD = 24 * 3600
+
+
+def parse_weights(value):
+    """User weights from a setting such as 'alice=3, bob=0.5'"""
+    weights = {}
+    for item in (value or '').replace(',', ' ').split():
+        user, _, weight = item.partition('=')
+        try:
+            weights[user] = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid user weight {item!r}; expected user=number")
+        if weights[user] <= 0:
+            raise ValueError(f"User weight of {user} must be positive")
+    return weights
+
+
+class FairQueue:
+    """Jobs waiting for a slot, shared out between users by weighted fair queuing.
+
+    Each user has their own FIFO of job ids and a pass: the virtual time at
+    which their next job is due. Starting a job advances its user's pass by
+    1 / weight, and the next slot goes to the waiting user with the lowest
+    pass, so a user with weight 2 starts two jobs for every one of a user
+    with weight 1 while both have work waiting. A user who has been idle
+    comes back at the current virtual time rather than with banked credit,
+    and one with a thousand queued jobs does not delay another's single job
+    by more than a job start.
+
+    Not thread-safe; the download manager calls it under its lock.
+    """
+
+    def __init__(self, weights=None, default_weight=DEFAULT_WEIGHT):
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self.queues = {}  # User -> deque of waiting job ids, only for users with jobs waiting
+        self.owners = {}  # Waiting job id -> user
+        self.passes = {}  # User -> virtual time of their next job start
+        self.virtual_time = 0.0  # Pass of the most recently started job
+
+    def weight(self, user):
+        return self.weights.get(user, self.default_weight)
+
+    def __len__(self):
+        return len(self.owners)
+
+    def push(self, user, download_id):
+        """Queue a job behind the user's other waiting jobs"""
+        if user not in self.queues:
+            self.queues[user] = deque()
+            self.passes[user] = max(self.passes.get(user, 0.0), self.virtual_time)
+        self.queues[user].append(download_id)
+        self.owners[download_id] = user
+
+    def remove(self, download_id):
+        """Drop a waiting job, e.g. when it is cancelled"""
+        user = self.owners.pop(download_id)
+        self.queues[user].remove(download_id)
+        if not self.queues[user]:
+            del self.queues[user]
+
+    def pop(self, eligible=None):
+        """The next job to start, from the users for whom eligible(user) is true; None if there is none"""
+        users = [user for user in self.queues if eligible is None or eligible(user)]
+        if not users:
+            return None
+        user = min(users, key=lambda user: self.passes[user])
+        download_id = self.queues[user].popleft()
+        if not self.queues[user]:
+            del self.queues[user]
+        del self.owners[download_id]
+        return download_id
+
+    def started(self, user):
+        """Charge a user for a job start, whether it waited in the queue or not"""
+        start = max(self.passes.get(user, 0.0), self.virtual_time)
+        self.virtual_time = start
+        self.passes[user] = start + 1 / self.weight(user)
+
+    def waiting(self):
+        """Number of waiting jobs per user"""
+        return {user: len(queue) for user, queue in self.queues.items()}
+
+
+class ByteQuota:
+    """Bytes each user may download per period.
+
+    Not thread-safe; the download manager calls it under its lock.
+    """
+
+    def __init__(self, limit, period=QUOTA_PERIOD):
+        self.limit = limit
+        self.period = period
+        self.window = None
+        self.used_bytes = {}  # User -> bytes downloaded in the current window
+
+    def _roll(self):
+        window = int(time.time() // self.period)
+        if window != self.window:
+            self.window = window
+            self.used_bytes = {}
+
+    def add(self, user, nbytes):
+        self._roll()
+        self.used_bytes[user] = self.used_bytes.get(user, 0) + nbytes
+
+    def used(self, user):
+        self._roll()
+        return self.used_bytes.get(user, 0)
+
+    def reset_in(self):
+        """Seconds until the current window ends and every quota is full again"""
+        return max(1, int(self.period - time.time() % self.period))
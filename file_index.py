@@ -0,0 +1,353 @@
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+logger = logging.getLogger('fdl_server.files')
+
+# Seconds between incremental rescans. With inotify they only catch what it
+# missed (an overflowed event queue, watches beyond the kernel limit);
+# without it they are how the index learns about changes.
+RESCAN_INTERVAL = 60
+
+# Largest page /api/files serves
+MAX_PAGE = 1000
+
+SORT_KEYS = ('name', 'size', 'mtime')
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, name length
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    INOTIFY_AVAILABLE = True
+except (OSError, AttributeError):
+    INOTIFY_AVAILABLE = False
+
+
+class FileIndex:
+    """In-memory listing of the files under a directory, kept current as they change.
+
+    A background thread walks the tree once, then follows it with inotify
+    watches on every directory where the kernel offers them, and rescans it
+    incrementally every rescan_interval seconds: a directory whose mtime has
+    not changed since it was last listed is not listed again, so a rescan
+    costs a stat per directory rather than per file. Queries never touch
+    the disk. Files are kept in name order as they change; size and mtime
+    orders are sorted on demand and reused until the next change.
+
+    With seeded, the first walk is left to a walk of the tree that happens
+    anyway, which reports each directory through seed_directory and calls
+    finish_seed at the end.
+    """
+
+    def __init__(self, root, skip=(), public_path=None, rescan_interval=RESCAN_INTERVAL, seeded=False):
+        self.root = os.path.abspath(root)
+        self.skip = {os.path.abspath(path) for path in skip}
+        self.public_path = public_path or (lambda path: os.path.relpath(path, self.root).replace(os.sep, '/'))
+        self.rescan_interval = rescan_interval
+        self.files = {}  # Stored path -> {'name', 'size', 'mtime'}
+        self.by_name = []  # Sorted (public name, stored path)
+        self.views = {}  # Sort key -> (version, stored paths in that order)
+        self.version = 0  # Bumped on every change, invalidating self.views
+        self.dirs = {}  # Directory -> (mtime_ns, file names, subdirectory names) when it was last listed
+        self.lock = threading.Lock()
+        self.ready = False  # First walk finished
+        self.inotify_fd = None
+        self.watches = {}  # Watch descriptor -> directory
+        self.watch_limit_hit = False
+        self.stats = {'events': 0, 'rescans': 0, 'overflows': 0, 'last_scan': None, 'last_scan_seconds': None}
+        self.seeded = threading.Event() if seeded else None  # Set by finish_seed
+        self.seed_complete = False
+
+        # Opened here so that a seeding walk can add watches before the thread runs
+        if INOTIFY_AVAILABLE:
+            fd = _libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                logger.warning("inotify unavailable (%s), indexing %s by rescans only", os.strerror(ctypes.get_errno()), self.root)
+            else:
+                self.inotify_fd = fd
+
+        thread = threading.Thread(target=self._run, name='file-index')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        if self.seeded is not None:
+            self.seeded.wait()
+        if not self.seed_complete:
+            self._rescan(full=True)
+        with self.lock:
+            # Sorted once here rather than file by file as the first walk finds them
+            self.by_name = sorted((entry['name'], path) for path, entry in self.files.items())
+            self.version += 1
+        self.ready = True
+
+        next_rescan = time.monotonic() + self.rescan_interval
+        while True:
+            timeout = max(0, next_rescan - time.monotonic())
+            if self.inotify_fd is None:
+                time.sleep(timeout)
+            elif select.select([self.inotify_fd], [], [], timeout)[0]:
+                if self._read_events():
+                    next_rescan = 0  # The kernel dropped events; only a rescan can say what changed
+                continue
+
+            try:
+                self._rescan()
+            except Exception as e:
+                logger.exception("Rescan of %s failed: %s", self.root, e)
+            next_rescan = time.monotonic() + self.rescan_interval
+
+    def _rescan(self, full=False):
+        """Bring the index up to date with the disk, listing only directories that changed"""
+        started = time.monotonic()
+        seen = set()
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            seen.add(directory)
+            pending.extend(self._scan_directory(directory, full))
+
+        # Directories that are gone take their files with them
+        for directory in [directory for directory in self.dirs if directory not in seen]:
+            self._forget_directory(directory)
+
+        self.stats['rescans'] += 1
+        self.stats['last_scan'] = time.time()
+        self.stats['last_scan_seconds'] = round(time.monotonic() - started, 3)
+
+    def seed_directory(self, directory, mtime, entries, subdirs):
+        """Record a directory listed by the seeding walk: its mtime_ns from before
+        the listing, the os.DirEntry of each file in it and its subdirectory names"""
+        self._watch(directory)
+        for entry in entries:
+            self._update_file(entry.path, entry.stat())  # Cached by the DirEntry, no second stat
+        self.dirs[directory] = (mtime, {entry.name for entry in entries}, set(subdirs))
+
+    def finish_seed(self, complete=True):
+        """End the seeding walk; an incomplete one is followed by a walk of our own"""
+        self.seed_complete = complete
+        if complete:
+            self.stats['last_scan'] = time.time()
+        self.seeded.set()
+
+    def _scan_directory(self, directory, full=False):
+        """Refresh one directory if its mtime changed; returns the subdirectories to visit"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        known = self.dirs.get(directory)
+        if known and known[0] == mtime and not full:
+            return [os.path.join(directory, name) for name in known[2]]
+
+        self._watch(directory)
+        files, subdirs = set(), set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in self.skip:
+                            subdirs.add(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.add(entry.name)
+                        self._update_file(entry.path)
+        except OSError as e:
+            logger.warning("Failed to scan %s: %s", directory, e)
+            return []
+
+        if known:
+            for name in known[1] - files:
+                self._remove_file(os.path.join(directory, name))
+            for name in known[2] - subdirs:
+                self._forget_directory(os.path.join(directory, name))
+        self.dirs[directory] = (mtime, files, subdirs)
+        return [os.path.join(directory, name) for name in subdirs]
+
+    def _forget_directory(self, directory):
+        """Drop a directory that no longer exists, and everything that was below it"""
+        known = self.dirs.pop(directory, None)
+        if not known:
+            return
+        for name in known[1]:
+            self._remove_file(os.path.join(directory, name))
+        for name in known[2]:
+            self._forget_directory(os.path.join(directory, name))
+
+    def _watch(self, directory):
+        if self.inotify_fd is None or self.watch_limit_hit:
+            return
+        wd = _libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+        elif ctypes.get_errno() == errno.ENOSPC:
+            # fs.inotify.max_user_watches reached; rescans cover the rest of the tree
+            self.watch_limit_hit = True
+            logger.warning("inotify watch limit reached at %d directories, rescanning the rest of %s", len(self.watches), self.root)
+
+    def _read_events(self):
+        """Apply a batch of inotify events; returns True if the kernel queue overflowed"""
+        data = os.read(self.inotify_fd, 64 * 1024)
+        overflowed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            self.stats['events'] += 1
+
+            if mask & IN_Q_OVERFLOW:
+                self.stats['overflows'] += 1
+                overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue  # The parent's event for this directory does the work
+
+            path = os.path.join(directory, os.fsdecode(name))
+            known = self.dirs.get(directory)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and path not in self.skip:
+                    if known:
+                        known[2].add(os.fsdecode(name))
+                    # Files may have landed before the new watch did, so list it now
+                    pending = [path]
+                    while pending:
+                        pending.extend(self._scan_directory(pending.pop(), full=True))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    if known:
+                        known[2].discard(os.fsdecode(name))
+                    self._forget_directory(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if known:
+                    known[1].add(os.fsdecode(name))
+                self._update_file(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                if known:
+                    known[1].discard(os.fsdecode(name))
+                self._remove_file(path)
+        return overflowed
+
+    def _update_file(self, path, stat=None):
+        try:
+            stat = stat or os.stat(path, follow_symlinks=False)
+        except OSError:
+            self._remove_file(path)
+            return
+        entry = {'name': self.public_path(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        with self.lock:
+            old = self.files.get(path)
+            if old == entry:
+                return
+            if not self.ready:
+                self.files[path] = entry
+                return
+            if old is None or old['name'] != entry['name']:
+                if old is not None:
+                    self._unlist(old['name'], path)
+                bisect.insort(self.by_name, (entry['name'], path))
+            self.files[path] = entry
+            self.version += 1
+
+    def _remove_file(self, path):
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                self._unlist(old['name'], path)
+                self.version += 1
+
+    def _unlist(self, name, path):
+        """Caller must hold self.lock."""
+        index = bisect.bisect_left(self.by_name, (name, path))
+        if index < len(self.by_name) and self.by_name[index] == (name, path):
+            del self.by_name[index]
+
+    def _ordered(self, sort):
+        """Stored paths in sort order. Caller must hold self.lock."""
+        if sort == 'name':
+            return [path for _, path in self.by_name]
+        cached = self.views.get(sort)
+        if cached is None or cached[0] != self.version:
+            paths = sorted(self.files, key=lambda path: (self.files[path][sort], self.files[path]['name']))
+            cached = self.views[sort] = (self.version, paths)
+        return cached[1]
+
+    def query(self, search=None, prefix=None, sort='name', descending=False, offset=0, limit=100):
+        """A page of files as (total matching, [{'name', 'size', 'mtime'}]).
+
+        search matches anywhere in the name, case-insensitively; prefix
+        keeps the files below one directory, e.g. 'site/docs'.
+        """
+        search = search.casefold() if search else None
+        prefix = prefix.strip('/') + '/' if prefix and prefix.strip('/') else None
+        with self.lock:
+            if sort == 'name' and not search:
+                # Straight off the name order, without visiting the files outside the page
+                lo, hi = 0, len(self.by_name)
+                if prefix:
+                    lo = bisect.bisect_left(self.by_name, (prefix,))
+                    hi = bisect.bisect_left(self.by_name, (prefix[:-1] + chr(ord('/') + 1),))
+                page = _slice(self.by_name, lo, hi, offset, limit, descending)
+                return hi - lo, [dict(self.files[path]) for _, path in page]
+
+            paths = self._ordered(sort)
+            if not search and not prefix:
+                return len(paths), [dict(self.files[path]) for path in _slice(paths, 0, len(paths), offset, limit, descending)]
+
+            total = 0
+            page = []
+            for path in reversed(paths) if descending else paths:
+                entry = self.files[path]
+                if prefix and not entry['name'].startswith(prefix):
+                    continue
+                if search and search not in entry['name'].casefold():
+                    continue
+                if offset <= total < offset + limit:
+                    page.append(dict(entry))
+                total += 1
+            return total, page
+
+    def get_stats(self):
+        with self.lock:
+            files = len(self.files)
+        return dict(
+            self.stats,
+            ready=self.ready,
+            files=files,
+            directories=len(self.dirs),
+            mode='inotify' if self.inotify_fd is not None else 'rescan',
+            watches=len(self.watches),
+            watch_limit_hit=self.watch_limit_hit
+        )
+
+
+def _slice(items, lo, hi, offset, limit, descending):
+    """The page of items[lo:hi] after skipping offset of them, counting from the end if descending"""
+    if descending:
+        start = max(lo, hi - offset - limit)
+        return items[start:max(start, hi - offset)][::-1]
+    return items[lo + offset:max(lo + offset, min(hi, lo + offset + limit))]
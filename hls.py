@@ -0,0 +1,180 @@
+import os
+import re
+from urllib.parse import urljoin, urlparse
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # Optional; encrypted streams cannot be downloaded without it
+    Cipher = None
+
+AES_AVAILABLE = Cipher is not None
+
+HLS_CONTENT_TYPES = {'application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'audio/x-mpegurl'}
+HLS_EXTENSIONS = ('.m3u8',)
+
+# Largest playlist we are willing to fetch
+MAX_PLAYLIST_SIZE = 10 * 1024 * 1024
+
+# Attribute lists: KEY=value pairs where a value may be a quoted string containing commas
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class HlsError(Exception):
+    """Raised when a playlist cannot be downloaded as a single file"""
+
+
+def is_hls(url, content_type=''):
+    """Check whether a URL or content type refers to an HLS playlist"""
+    path = urlparse(url).path.lower()
+    return path.endswith(HLS_EXTENSIONS) or content_type.split(';')[0].strip().lower() in HLS_CONTENT_TYPES
+
+
+def media_filename(name, fragmented=False):
+    """Output name for a stream whose playlist is called name"""
+    base, ext = os.path.splitext(name)
+    if ext.lower() in HLS_EXTENSIONS:
+        name = base
+    return name + ('.mp4' if fragmented else '.ts')
+
+
+def fetch_playlist(session, url):
+    """Download a playlist; returns its text and final URL, which relative URIs resolve against"""
+    with session.get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        data = b''
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data += chunk
+            if len(data) > MAX_PLAYLIST_SIZE:
+                raise HlsError("Playlist is too large")
+        return data.decode('utf-8', errors='replace'), str(response.url)
+
+
+def _parse_attributes(text):
+    return {name: value.strip('"') for name, value in ATTRIBUTE_PATTERN.findall(text)}
+
+
+def _parse_byterange(text, previous_end):
+    """(offset, length) of an EXT-X-BYTERANGE; without an offset it follows the previous range"""
+    length, _, offset = text.partition('@')
+    return (int(offset) if offset else previous_end), int(length)
+
+
+def parse_playlist(text, base_url):
+    """Parse an HLS master or media playlist.
+
+    A master playlist gives {'variants': [...]}, each variant a dict with
+    'url', 'bandwidth' and 'resolution'. A media playlist gives
+    {'segments': [...], 'ended': bool}, each segment a dict with 'url',
+    'duration', 'byterange' ((offset, length) or None), 'key' (None or a dict
+    with 'uri' and 'iv') and 'sequence'. Initialisation sections (EXT-X-MAP)
+    appear as segments with 'init' set, before the segments they apply to.
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    if not lines or lines[0] != '#EXTM3U':
+        raise HlsError("Not an HLS playlist")
+
+    variants = []
+    segments = []
+    ended = False
+    sequence = 0
+    duration = 0.0
+    key = None
+    byterange = None
+    range_end = 0
+    init = None
+    pending_variant = None
+
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = _parse_attributes(line.split(':', 1)[1])
+            pending_variant = {
+                'bandwidth': int(attributes.get('BANDWIDTH') or 0),
+                'resolution': attributes.get('RESOLUTION')
+            }
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',')[0] or 0)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byterange = _parse_byterange(line.split(':', 1)[1], range_end)
+        elif line.startswith('#EXT-X-KEY:'):
+            attributes = _parse_attributes(line.split(':', 1)[1])
+            method = attributes.get('METHOD', 'NONE')
+            if method == 'NONE':
+                key = None
+            elif method == 'AES-128':
+                iv = attributes.get('IV')
+                key = {
+                    'uri': urljoin(base_url, attributes['URI']),
+                    'iv': bytes.fromhex(iv[2:] if iv.lower().startswith('0x') else iv) if iv else None
+                }
+            else:
+                raise HlsError(f"Unsupported segment encryption {method}")
+        elif line.startswith('#EXT-X-MAP:'):
+            attributes = _parse_attributes(line.split(':', 1)[1])
+            section = {
+                'url': urljoin(base_url, attributes['URI']),
+                'duration': 0.0,
+                'byterange': _parse_byterange(attributes['BYTERANGE'], 0) if attributes.get('BYTERANGE') else None,
+                'key': key,
+                'sequence': None,
+                'init': True
+            }
+            if section != init:
+                init = section
+                segments.append(dict(section))
+        elif line == '#EXT-X-ENDLIST':
+            ended = True
+        elif line.startswith('#'):
+            continue
+        elif pending_variant is not None:
+            pending_variant['url'] = urljoin(base_url, line)
+            variants.append(pending_variant)
+            pending_variant = None
+        else:
+            segments.append({
+                'url': urljoin(base_url, line),
+                'duration': duration,
+                'byterange': byterange,
+                'key': key,
+                'sequence': sequence,
+                'init': False
+            })
+            if byterange:
+                range_end = byterange[0] + byterange[1]
+            sequence += 1
+            duration = 0.0
+            byterange = None
+
+    if variants:
+        return {'variants': variants}
+    if not any(not segment['init'] for segment in segments):
+        raise HlsError("Playlist has no segments")
+    return {'segments': segments, 'ended': ended}
+
+
+def select_variant(variants, max_bandwidth=0):
+    """The highest-bandwidth variant, or the best one within max_bandwidth bits per second"""
+    candidates = [variant for variant in variants if not max_bandwidth or variant['bandwidth'] <= max_bandwidth]
+    if not candidates:
+        candidates = [min(variants, key=lambda variant: variant['bandwidth'])]
+    return max(candidates, key=lambda variant: variant['bandwidth'])
+
+
+def decrypt_segment(data, key, iv):
+    """Decrypt an AES-128 (CBC, PKCS#7) segment"""
+    if not AES_AVAILABLE:
+        raise HlsError("Encrypted streams require the cryptography package")
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    return unpadder.update(decryptor.update(data) + decryptor.finalize()) + unpadder.finalize()
+
+
+def segment_iv(segment):
+    """The segment's explicit IV, or its media sequence number as a 16-byte big-endian integer"""
+    if segment['key']['iv'] is not None:
+        return segment['key']['iv']
+    return (segment['sequence'] or 0).to_bytes(16, 'big')
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger('fdl_server.hosts')
+
+# Bounds and starting point of the connection count learned per host
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 16  # aria2c's own limit per server
+INITIAL_CONNECTIONS = 4
+
+# Each connection should get at least this much of the file; smaller files
+# get fewer segments, and anything under two of them is fetched in one piece
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# A step up is kept only if it raised throughput by this factor
+GAIN_THRESHOLD = 1.1
+
+# Weight of the newest throughput sample in the per-connection-count average
+EWMA_ALPHA = 0.3
+
+
+def host_of(url):
+    return (urlparse(url).hostname or '').lower()
+
+
+class HostProfiles:
+    """Connection counts per host, learned from finished jobs and persisted as JSON.
+
+    Additive increase, multiplicative decrease: a clean job that was faster
+    than the last one at one connection fewer earns the host another
+    connection; a job that was throttled (429/503) halves it. Throughput is
+    averaged per connection count, so a host that has plateaued stops
+    climbing instead of being pushed until it starts refusing connections.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.profiles = {}  # host -> {'connections', 'rates', 'jobs', 'throttled', 'updated'}
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.profiles = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable host profiles %s: %s", self.path, e)
+
+    def _save(self):
+        """Write the profiles atomically. Caller must hold self.lock."""
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.profiles, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error("Failed to save host profiles: %s", e)
+
+    def connections(self, url):
+        """Connections to open to a URL's host"""
+        with self.lock:
+            profile = self.profiles.get(host_of(url))
+            return profile['connections'] if profile else INITIAL_CONNECTIONS
+
+    def plan(self, url, size):
+        """Connections and segment count for a file of size bytes (0 if unknown) at url"""
+        connections = self.connections(url)
+        if size > 0:
+            split = max(1, min(connections, size // SEGMENT_SIZE))
+        else:
+            split = connections
+        return {'connections': connections, 'split': split, 'min_split_size': SEGMENT_SIZE}
+
+    def record(self, url, connections, nbytes, seconds, throttled=False):
+        """Learn from a finished run that used the given number of connections"""
+        host = host_of(url)
+        if not host or seconds <= 0:
+            return
+
+        with self.lock:
+            profile = self.profiles.setdefault(host, {
+                'connections': INITIAL_CONNECTIONS,
+                'rates': {},
+                'jobs': 0,
+                'throttled': 0,
+                'updated': 0
+            })
+            profile['jobs'] += 1
+            profile['updated'] = time.time()
+
+            if throttled:
+                profile['throttled'] += 1
+                # Halve what the host is allowed, whatever this run happened to open
+                profile['connections'] = max(MIN_CONNECTIONS, profile['connections'] // 2)
+            else:
+                rate = nbytes / seconds
+                key = str(connections)  # JSON object keys are strings
+                previous = profile['rates'].get(key)
+                profile['rates'][key] = rate if previous is None else previous + EWMA_ALPHA * (rate - previous)
+
+                fewer = profile['rates'].get(str(connections - 1))
+                if connections >= profile['connections'] and (fewer is None or profile['rates'][key] >= fewer * GAIN_THRESHOLD):
+                    profile['connections'] = min(MAX_CONNECTIONS, connections + 1)
+                elif fewer is not None and profile['rates'][key] < fewer:
+                    # The extra connection made things worse; step back
+                    profile['connections'] = max(MIN_CONNECTIONS, connections - 1)
+
+            self._save()
+
+    def stats(self):
+        """Learned settings per host"""
+        with self.lock:
+            return {
+                host: {
+                    'connections': profile['connections'],
+                    'jobs': profile['jobs'],
+                    'throttled': profile['throttled'],
+                    'best_rate': max(profile['rates'].values(), default=0)
+                }
+                for host, profile in self.profiles.items()
+            }
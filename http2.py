@@ -0,0 +1,210 @@
+import queue
+import threading
+from urllib.parse import urlparse
+
+import requests
+
+try:
+    import httpx
+    import h2  # noqa: F401 -- httpx only negotiates HTTP/2 when h2 is installed
+except ImportError:  # Optional; the http2 engine is unavailable without them
+    httpx = None
+
+HTTP2_AVAILABLE = httpx is not None
+
+# Connections kept per origin. Each carries many concurrent streams, so a
+# few are enough for thousands of small transfers from the same CDN.
+CONNECTIONS_PER_ORIGIN = 2
+
+# Received chunks buffered per stream ahead of the reader; a small buffer keeps
+# the stream's flow-control window closing when the reader falls behind
+BUFFERED_CHUNKS = 4
+
+# Seconds between checks for an abort while a stream is waiting for data
+ABORT_POLL = 0.25
+
+
+class RetryableTransportError(requests.ConnectionError):
+    """An httpx transport failure, surfaced as the requests error the engines already retry"""
+
+
+class Http2Pool:
+    """Shared HTTP/2 clients, one per origin, used by every job of the http2 engine.
+
+    Requests to the same origin are multiplexed as streams over at most
+    CONNECTIONS_PER_ORIGIN connections; h2's per-stream flow control keeps a
+    slow job from stalling the others sharing its connection.
+    """
+
+    def __init__(self, connections_per_origin=CONNECTIONS_PER_ORIGIN, cleartext=False):
+        self.connections_per_origin = connections_per_origin
+        # Speak HTTP/2 with prior knowledge (h2c) to http:// origins; otherwise
+        # HTTP/2 is negotiated through TLS ALPN and plain HTTP stays HTTP/1.1
+        self.cleartext = cleartext
+        self.clients = {}  # origin -> httpx.Client
+        self.protocols = {}  # origin -> negotiated HTTP version
+        self.lock = threading.Lock()
+
+    def client(self, url):
+        """The client for a URL's origin, created on first use"""
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            client = self.clients.get(origin)
+            if client is None:
+                client = self.clients[origin] = httpx.Client(
+                    http1=not (self.cleartext and parsed.scheme == 'http'),
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=self.connections_per_origin,
+                        max_keepalive_connections=self.connections_per_origin
+                    ),
+                    timeout=httpx.Timeout(30.0),
+                    follow_redirects=True
+                )
+            return client
+
+    def negotiates_h2(self, url):
+        """Whether the origin speaks HTTP/2, probed once per origin with a HEAD request"""
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            version = self.protocols.get(origin)
+        if version is None:
+            try:
+                version = self.client(url).head(url).http_version
+            except httpx.HTTPError:
+                return False
+            with self.lock:
+                self.protocols[origin] = version
+        return version == 'HTTP/2'
+
+    def session(self):
+        """A requests-like session over the shared clients"""
+        return Http2Session(self)
+
+    def stats(self):
+        """Origins with an open client and the protocol each negotiated"""
+        with self.lock:
+            return {origin: self.protocols.get(origin) for origin in self.clients}
+
+    def close(self):
+        """Close every client and its connections"""
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+
+class Http2Session:
+    """The subset of requests.Session the download engine uses, backed by an Http2Pool"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def head(self, url, allow_redirects=True, timeout=10, headers=None):
+        try:
+            response = self.pool.client(url).head(url, headers=headers, follow_redirects=allow_redirects, timeout=timeout)
+        except httpx.TransportError as e:
+            raise RetryableTransportError(str(e))
+        return Http2Response(response)
+
+    def get(self, url, headers=None, stream=True, timeout=30):
+        client = self.pool.client(url)
+        request = client.build_request('GET', url, headers=headers, timeout=timeout)
+        try:
+            response = client.send(request, stream=True)
+        except httpx.TransportError as e:
+            raise RetryableTransportError(str(e))
+        return Http2Response(response)
+
+    def close(self):
+        pass  # The clients are shared and outlive the session
+
+
+class Http2Response:
+    """Wraps an httpx response in the requests.Response interface the engine relies on.
+
+    The body is read by a pump thread into a small buffer. A stream that has
+    stalled blocks the pump, not the reader, so abort() takes effect within
+    ABORT_POLL seconds instead of when the connection's read timeout fires;
+    closing or timing out the shared connection from another thread would
+    fail every stream on it.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.http_version = response.http_version
+        self.aborted = False
+        self.chunks = queue.Queue(BUFFERED_CHUNKS)  # Body chunks, then None at the end or the error that ended it
+        self.pump = None
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def iter_content(self, chunk_size=None):
+        # Data is passed on as it arrives rather than gathered into chunk_size pieces
+        self.pump = threading.Thread(target=self._pump, name=f"{threading.current_thread().name}-h2")
+        self.pump.daemon = True
+        self.pump.start()
+        while True:
+            if self.aborted:
+                raise RetryableTransportError("Stream aborted")
+            try:
+                chunk = self.chunks.get(timeout=ABORT_POLL)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def _pump(self):
+        """Read the body into self.chunks until it ends or the response is aborted or closed"""
+        try:
+            for chunk in self.response.iter_bytes():
+                if not self._offer(chunk):
+                    return
+            self._offer(None)
+        except httpx.TransportError as e:
+            self._offer(RetryableTransportError(str(e)))
+        finally:
+            # Closed on this thread, so a stream still being read is never reset under it
+            self.response.close()
+
+    def _offer(self, item):
+        """Buffer an item for the reader; False once the response has been aborted"""
+        while not self.aborted:
+            try:
+                self.chunks.put(item, timeout=ABORT_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def abort(self):
+        """Fail the stream within ABORT_POLL seconds; safe to call from another thread"""
+        self.aborted = True
+
+    def close(self):
+        # Resets the stream if the body was not read to the end; the connection stays up.
+        # While the pump is still reading, it closes the response itself once it stops.
+        self.aborted = True
+        if self.pump is None or not self.pump.is_alive():
+            self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
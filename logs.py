@@ -0,0 +1,133 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+
+from admission import AdmissionError, RateLimiter
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Records waiting for the writer thread; beyond this they are dropped rather than block the caller
+QUEUE_SIZE = 10000
+
+# Rotating JSON log file in LOG_DIR
+LOG_FILE = 'fdl-server.log'
+MAX_BYTES = 50 * 1024 * 1024
+BACKUPS = 5
+
+# Attributes every LogRecord has; anything else on a record came from extra= and is a structured field
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the record's extra= fields.
+
+    Records arrive through the queue already prepared, with any traceback
+    rendered into the message.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the writer has fallen behind, so logging never blocks"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """The thread that takes records off the queue and hands them to the real handlers"""
+
+    def start(self):
+        super().start()
+        self._thread.name = 'log-writer'
+
+
+class AccessLogFilter(logging.Filter):
+    """Samples and rate-limits access log records; client and server errors always pass.
+
+    A record that passes after others were held back carries their number
+    in its 'suppressed' field.
+    """
+
+    def __init__(self, sample=1.0, rate=0):
+        super().__init__()
+        self.sample = sample
+        self.limiter = RateLimiter(rate, max(1, rate)) if rate > 0 else None
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, 'status', 0) < 400:
+            if self.sample < 1 and random.random() >= self.sample:
+                return self._suppress()
+            if self.limiter:
+                try:
+                    self.limiter.acquire('access')
+                except AdmissionError:
+                    return self._suppress()
+        with self.lock:
+            record.suppressed, self.suppressed = self.suppressed, 0
+        return True
+
+    def _suppress(self):
+        with self.lock:
+            self.suppressed += 1
+        return False
+
+
+def setup_logging(level='INFO', json_console=False, log_dir=None, max_bytes=MAX_BYTES, backups=BACKUPS):
+    """Route every logger through a queue to a writer thread; returns the LogWriter, not yet started.
+
+    The writer prints to stderr (as text or JSON) and, with log_dir,
+    appends JSON lines to a rotating file there. Records logged before the
+    listener starts wait in the queue.
+    """
+    handlers = []
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(JsonFormatter() if json_console else logging.Formatter(TEXT_FORMAT))
+    handlers.append(console)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, LOG_FILE), maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return LogWriter(handler.queue, *handlers, respect_handler_level=True)
+
+
+def get_stats(listener):
+    """Queue depth and records dropped by the handler feeding listener"""
+    handler = next(h for h in logging.getLogger().handlers if isinstance(h, DroppingQueueHandler))
+    return {'queued': listener.queue.qsize(), 'dropped': handler.dropped}
@@ -0,0 +1,198 @@
+import os
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
+
+import requests
+
+METALINK_V3_NS = 'http://www.metalinker.org/'
+METALINK_V4_NS = 'urn:ietf:params:xml:ns:metalink'
+
+METALINK_CONTENT_TYPES = {'application/metalink+xml', 'application/metalink4+xml'}
+METALINK_EXTENSIONS = ('.metalink', '.meta4')
+
+# Largest Metalink document we are willing to fetch or accept
+MAX_METALINK_SIZE = 10 * 1024 * 1024
+
+# Metalink hash type names mapped to hashlib names, strongest first
+HASH_TYPES = {
+    'sha-512': 'sha512',
+    'sha-384': 'sha384',
+    'sha-256': 'sha256',
+    'sha-1': 'sha1',
+    'sha1': 'sha1',
+    'sha256': 'sha256',
+    'md5': 'md5'
+}
+
+
+class MetalinkError(Exception):
+    """Raised when a Metalink document cannot be used"""
+
+
+def is_metalink(url, content_type=''):
+    """Check whether a URL or content type refers to a Metalink document"""
+    path = urlparse(url).path.lower()
+    return path.endswith(METALINK_EXTENSIONS) or content_type.split(';')[0].strip() in METALINK_CONTENT_TYPES
+
+
+def fetch_metalink(url):
+    """Download a Metalink document, refusing anything unreasonably large"""
+    response = requests.get(url, stream=True, timeout=30)
+    response.raise_for_status()
+
+    data = b''
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        data += chunk
+        if len(data) > MAX_METALINK_SIZE:
+            raise MetalinkError("Metalink document is too large")
+    return data
+
+
+def parse_metalink(data):
+    """Parse a Metalink v3 or v4 document.
+
+    Returns a list of files, each a dict with 'name', 'size', 'urls' (best
+    first), 'hashes' ({hashlib name: hex digest}), 'pieces' (None or a
+    dict with 'type', 'length' and the ordered list of piece 'hashes') and
+    'index', the file's 1-based position among every <file> of the
+    document, as aria2c's --select-file counts them. Files without URLs
+    are left out.
+    """
+    if len(data) > MAX_METALINK_SIZE:
+        raise MetalinkError("Metalink document is too large")
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError as e:
+        raise MetalinkError(f"Invalid Metalink document: {e}")
+
+    if root.tag == f'{{{METALINK_V4_NS}}}metalink':
+        files = [_parse_v4_file(element) for element in root.iter(f'{{{METALINK_V4_NS}}}file')]
+    elif root.tag == f'{{{METALINK_V3_NS}}}metalink':
+        files = [_parse_v3_file(element) for element in root.iter(f'{{{METALINK_V3_NS}}}file')]
+    else:
+        raise MetalinkError("Not a Metalink document")
+
+    for index, entry in enumerate(files, start=1):
+        entry['index'] = index
+    files = [f for f in files if f['urls']]
+    if not files:
+        raise MetalinkError("Metalink document does not list any downloadable files")
+    return files
+
+
+def _parse_v4_file(element):
+    """Parse a <file> element of a Metalink v4 (RFC 5854) document"""
+    ns = f'{{{METALINK_V4_NS}}}'
+
+    # Lower priority values are preferred; unranked URLs go last
+    urls = sorted(
+        (_int_attribute(url, 'priority', 999999), url.text.strip())
+        for url in element.findall(f'{ns}url') if url.text and url.text.strip()
+    )
+
+    pieces = None
+    pieces_element = element.find(f'{ns}pieces')
+    if pieces_element is not None and pieces_element.get('type', '').lower() in HASH_TYPES:
+        pieces = {
+            'type': HASH_TYPES[pieces_element.get('type').lower()],
+            'length': _piece_length(pieces_element),
+            'hashes': [(h.text or '').strip().lower() for h in pieces_element.findall(f'{ns}hash')]
+        }
+
+    return {
+        'name': element.get('name', ''),
+        'size': _parse_int(element.findtext(f'{ns}size')),
+        'urls': [url for _, url in urls],
+        'hashes': _parse_hashes(element.findall(f'{ns}hash')),
+        'pieces': pieces
+    }
+
+
+def _parse_v3_file(element):
+    """Parse a <file> element of a Metalink v3 document"""
+    ns = f'{{{METALINK_V3_NS}}}'
+
+    # Higher preference values are preferred
+    urls = sorted(
+        (-_int_attribute(url, 'preference', 0), url.text.strip())
+        for url in element.iter(f'{ns}url') if url.text and url.text.strip()
+    )
+
+    hashes = {}
+    pieces = None
+    verification = element.find(f'{ns}verification')
+    if verification is not None:
+        hashes = _parse_hashes(verification.findall(f'{ns}hash'))
+        pieces_element = verification.find(f'{ns}pieces')
+        if pieces_element is not None and pieces_element.get('type', '').lower() in HASH_TYPES:
+            piece_hashes = sorted(
+                (_int_attribute(h, 'piece', 0), (h.text or '').strip().lower())
+                for h in pieces_element.findall(f'{ns}hash')
+            )
+            pieces = {
+                'type': HASH_TYPES[pieces_element.get('type').lower()],
+                'length': _piece_length(pieces_element),
+                'hashes': [value for _, value in piece_hashes]
+            }
+
+    return {
+        'name': element.get('name', ''),
+        'size': _parse_int(element.findtext(f'{ns}size')),
+        'urls': [url for _, url in urls],
+        'hashes': hashes,
+        'pieces': pieces
+    }
+
+
+def _parse_hashes(elements):
+    """Collect whole-file hashes of supported types"""
+    hashes = {}
+    for element in elements:
+        hash_type = HASH_TYPES.get(element.get('type', '').lower())
+        if hash_type and element.text:
+            hashes[hash_type] = element.text.strip().lower()
+    return hashes
+
+
+def _int_attribute(element, name, default):
+    """An optional integer attribute; a value that is not one makes the document invalid"""
+    value = element.get(name)
+    if not value:
+        return default
+    try:
+        return int(value.strip())
+    except ValueError:
+        raise MetalinkError(f"Invalid Metalink document: <{_local_name(element)}> {name} {value!r} is not an integer")
+
+
+def _piece_length(element):
+    """The required, positive length attribute of a <pieces> element"""
+    length = _int_attribute(element, 'length', None)
+    if length is None or length <= 0:
+        raise MetalinkError("Invalid Metalink document: <pieces> needs a positive length")
+    return length
+
+
+def _local_name(element):
+    return element.tag.rpartition('}')[2]
+
+
+def _parse_int(text):
+    """Parse an optional integer element"""
+    try:
+        return int(text.strip())
+    except (AttributeError, ValueError):
+        return 0
+
+
+def strongest_hash(hashes):
+    """Pick the strongest available (hashlib name, digest) pair, or None"""
+    for hash_type in ('sha512', 'sha384', 'sha256', 'sha1', 'md5'):
+        if hash_type in hashes:
+            return hash_type, hashes[hash_type]
+    return None
+
+
+def file_basename(name):
+    """The last path component of a Metalink file name"""
+    return os.path.basename(name.replace('\\', '/'))
@@ -0,0 +1,357 @@
+import bz2
+import gzip
+import hashlib
+import lzma
+import multiprocessing
+import os
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker processes shared by every job's stages
+WORKERS = 2
+
+# Bytes read from the source at a time, and seconds between progress reports
+READ_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.5
+
+STAGES = ('checksum', 'unpack', 'recompress')
+DEFAULT_CHECKSUM = 'sha256'
+
+# Compressed file suffixes, with the short tar forms expanded
+DECOMPRESSORS = {
+    '.gz': lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+    '.xz': lambda f: lzma.LZMAFile(f, 'rb'),
+    '.bz2': lambda f: bz2.BZ2File(f, 'rb')
+}
+TAR_SUFFIXES = {'.tgz': '.tar.gz', '.txz': '.tar.xz', '.tbz2': '.tar.bz2', '.tbz': '.tar.bz2'}
+RECOMPRESS_FORMATS = {
+    'gz': lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6),
+    'xz': lambda f: lzma.LZMAFile(f, 'wb', preset=6),
+    'bz2': lambda f: bz2.BZ2File(f, 'wb', compresslevel=9)
+}
+
+# Set in each worker process by _init_worker
+_progress_queue = None
+
+
+class PostProcessError(Exception):
+    """Raised when a post-processing stage is misconfigured or cannot run on a file"""
+
+
+def parse_stages(value):
+    """Stages from a comma separated list such as 'checksum:md5, unpack, recompress:xz'"""
+    stages = []
+    for item in (value or '').split(','):
+        name, _, option = item.strip().partition(':')
+        if not name:
+            continue
+        if name not in STAGES:
+            raise PostProcessError(f"Unknown post-processing stage {name}; expected one of {', '.join(STAGES)}")
+        if name == 'checksum':
+            option = option or DEFAULT_CHECKSUM
+            if option not in hashlib.algorithms_available:
+                raise PostProcessError(f"Unknown checksum algorithm {option}")
+        elif name == 'recompress':
+            option = option or 'xz'
+            if option not in RECOMPRESS_FORMATS:
+                raise PostProcessError(f"Recompress format must be one of {', '.join(RECOMPRESS_FORMATS)}")
+        elif option:
+            raise PostProcessError(f"The {name} stage takes no option")
+        stages.append({'stage': name, 'option': option or None})
+    return stages
+
+
+def _split_compression(name):
+    """(name without its compression suffix, suffix) for a compressed file, else (name, '')"""
+    base, ext = os.path.splitext(name)
+    ext = ext.lower()
+    if ext in TAR_SUFFIXES:
+        return base + '.tar', TAR_SUFFIXES[ext][4:]
+    if ext in DECOMPRESSORS:
+        return base, ext
+    return name, ''
+
+
+def _archive_type(name):
+    """'tar', 'zip', 'compressed' (a single compressed file) or None"""
+    base, ext = _split_compression(name)
+    if base.lower().endswith('.tar'):
+        return 'tar'
+    if ext:
+        return 'compressed'
+    if name.lower().endswith('.zip'):
+        return 'zip'
+    return None
+
+
+def streams(stage, option, name):
+    """Whether a stage can consume the file front to back while it is still arriving"""
+    # A ZIP's directory is at its end, so unpacking one needs the whole file
+    return not (stage == 'unpack' and _archive_type(name) == 'zip')
+
+
+def stage_output(stage, option, path):
+    """Where a stage writes next to the downloaded file at path, or None for stages without output"""
+    directory, name = os.path.split(path)
+    base, ext = _split_compression(name)
+    if stage == 'unpack':
+        kind = _archive_type(name)
+        if kind == 'tar':
+            return os.path.join(directory, base[:-4])
+        if kind == 'zip':
+            return os.path.join(directory, os.path.splitext(name)[0])
+        if kind == 'compressed':
+            return os.path.join(directory, base)
+        raise PostProcessError(f"{name} is not a zip, tar, gz, xz or bz2 file")
+    if stage == 'recompress':
+        if ext == f".{option}":
+            raise PostProcessError(f"{name} is already {option} compressed")
+        return os.path.join(directory, f"{base}.{option}")
+    return None
+
+
+class _ProgressReader:
+    """File wrapper that reports how far into the source a worker has read"""
+
+    def __init__(self, f, task_id):
+        self.f = f
+        self.task_id = task_id
+        self.position = 0
+        self.reported = 0.0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.position += len(data)
+        now = time.monotonic()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            _progress_queue.put((self.task_id, self.position))
+        return data
+
+    def __getattr__(self, name):
+        # seek, tell and seekable for zipfile, which needs the finished file
+        return getattr(self.f, name)
+
+
+def _init_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _safe_members(archive, output):
+    """Members of a tar archive that stay inside output, for Pythons without extraction filters"""
+    root = os.path.realpath(output)
+    for member in archive:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()) or os.path.commonpath([root, target]) != root:
+            continue  # Links, devices and paths escaping the output directory
+        member.mode &= stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
+        yield member
+
+
+def run_stage(task_id, stage, option, source, name, output):
+    """Run one stage in a worker process.
+
+    source is the downloaded file, or a FIFO the server feeds it into while it
+    downloads; name is the file's own name. Returns the stage's result.
+    """
+    with open(source, 'rb') as f:
+        result = _run_stage(_ProgressReader(f, task_id), stage, option, name, output)
+        if stat.S_ISFIFO(os.fstat(f.fileno()).st_mode):
+            # Archives can end before the file does (tar padding); read on so the
+            # result only stands once the server has delivered the whole download
+            while f.read(READ_SIZE):
+                pass
+    return result
+
+
+def _run_stage(reader, stage, option, name, output):
+    if stage == 'checksum':
+        digest = hashlib.new(option)
+        for block in iter(lambda: reader.read(READ_SIZE), b''):
+            digest.update(block)
+        return {'algorithm': option, 'digest': digest.hexdigest()}
+
+    if stage == 'recompress':
+        base, ext = _split_compression(name)
+        temp_output = output + '.part'
+        with open(temp_output, 'wb') as out, RECOMPRESS_FORMATS[option](out) as compressor:
+            # A compressed download is decompressed first, so this converts between formats
+            shutil.copyfileobj(DECOMPRESSORS[ext](reader) if ext else reader, compressor, READ_SIZE)
+        os.replace(temp_output, output)
+        return {'output': output, 'bytes': os.path.getsize(output)}
+
+    kind = _archive_type(name)
+    if kind == 'zip':
+        with zipfile.ZipFile(reader) as archive:
+            members = archive.infolist()
+            archive.extractall(output)  # Strips absolute paths and '..'
+        return {'output': output, 'files': sum(1 for member in members if not member.is_dir())}
+
+    if kind == 'tar':
+        os.makedirs(output, exist_ok=True)
+        files = 0
+        # Stream mode reads the archive strictly front to back, as a FIFO requires
+        with tarfile.open(fileobj=reader, mode='r|*') as archive:
+            if hasattr(tarfile, 'data_filter'):
+                members, options = archive, {'filter': 'data'}
+            else:
+                members, options = _safe_members(archive, output), {}
+            for member in members:
+                archive.extract(member, output, **options)
+                files += member.isfile()
+        return {'output': output, 'files': files}
+
+    base, ext = _split_compression(name)
+    temp_output = output + '.part'
+    with open(temp_output, 'wb') as out:
+        shutil.copyfileobj(DECOMPRESSORS[ext](reader), out, READ_SIZE)
+    os.replace(temp_output, output)
+    return {'output': output, 'bytes': os.path.getsize(output)}
+
+
+class PostProcessor:
+    """Runs post-download stages in a bounded pool of worker processes.
+
+    Stages that read the file front to back (checksums, tar and single-file
+    unpacking, recompression) start with the download: the server pumps the
+    bytes into a FIFO as they are written and the worker reads the other end,
+    so they finish shortly after the download does. Unpacking a ZIP starts
+    once the file is complete. A streaming stage holds its worker for as
+    long as the download runs, so at most max_streams of them run at once
+    (by default all workers but one, which stays free for stages on
+    finished files); the others wait for the file. Workers are forked up
+    front, before the download threads exist, and report progress through
+    a shared queue.
+    """
+
+    def __init__(self, work_dir, workers=WORKERS, max_streams=None):
+        self.work_dir = os.path.abspath(work_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        # Fork, not spawn: spawned workers would re-import the web app as their main module
+        context = multiprocessing.get_context('fork')
+        self.progress_queue = context.Queue()
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.progress_queue,)
+        )
+        self.tasks = {}  # Task id -> progress callback
+        self.next_task = 0
+        self.max_streams = max(0, workers - 1) if max_streams is None else max_streams
+        self.streaming = 0  # Streaming stages submitted and not finished
+        self.lock = threading.Lock()
+
+        for _ in range(workers):
+            self.pool.submit(time.sleep, 0)
+
+        thread = threading.Thread(target=self._progress_loop, name='postprocess-progress')
+        thread.daemon = True
+        thread.start()
+
+    def _progress_loop(self):
+        while True:
+            task_id, position = self.progress_queue.get()
+            with self.lock:
+                on_progress = self.tasks.get(task_id)
+            if on_progress:
+                on_progress(position)
+
+    def submit(self, stage, option, path, on_progress, on_done, stream=None):
+        """Run a stage on the file at path.
+
+        With stream, a generator of the file's bytes as they arrive, the worker
+        reads them through a FIFO; otherwise it reads the finished file.
+        on_progress(bytes read) and on_done(result, error) are called from
+        server threads. Returns False, without running the stage, when
+        max_streams streaming stages are already running.
+        """
+        output = stage_output(stage, option, path)
+        with self.lock:
+            if stream is not None:
+                if self.streaming >= self.max_streams:
+                    return False
+                self.streaming += 1
+            task_id = self.next_task
+            self.next_task += 1
+            self.tasks[task_id] = on_progress
+
+        source = path
+        if stream is not None:
+            source = os.path.join(self.work_dir, f"stage_{os.getpid()}_{task_id}.fifo")
+            try:
+                os.mkfifo(source, 0o600)
+            except OSError:
+                with self.lock:
+                    self.tasks.pop(task_id, None)
+                    self.streaming -= 1
+                raise
+            truncated = threading.Event()
+            pump = threading.Thread(target=self._pump, args=(source, stream, truncated), name=f"postprocess-pump-{task_id}")
+            pump.daemon = True
+            pump.start()
+
+        future = self.pool.submit(run_stage, task_id, stage, option, source, os.path.basename(path), output)
+
+        def finished(future):
+            with self.lock:
+                self.tasks.pop(task_id, None)
+                if stream is not None:
+                    self.streaming -= 1
+            error = future.exception()
+            if stream is not None:
+                # Release a pump still waiting for a reader that will never come
+                self._unblock(source)
+                os.unlink(source)
+                if truncated.is_set():
+                    # Whatever the stage made of a partial file, the download is the cause
+                    error = PostProcessError("The download did not complete")
+            if error is not None and output:
+                shutil.rmtree(output, ignore_errors=True) if os.path.isdir(output) else _remove(output)
+                _remove(output + '.part')
+            on_done(None if error else future.result(), error)
+
+        future.add_done_callback(finished)
+        return True
+
+    def _pump(self, fifo, stream, truncated):
+        """Feed the downloaded bytes into a worker's FIFO.
+
+        The stream raises if the download stops short of completing, which
+        sets truncated; the worker closing its end just ends the pump.
+        """
+        try:
+            with open(fifo, 'wb') as f:
+                for data in stream:
+                    try:
+                        f.write(data)
+                    except OSError:
+                        return  # The worker failed and stopped reading
+        except PostProcessError:
+            truncated.set()
+        except OSError:
+            pass
+        finally:
+            stream.close()
+
+    def _unblock(self, fifo):
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
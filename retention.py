@@ -0,0 +1,117 @@
+import heapq
+import threading
+import time
+
+
+class RetentionIndex:
+    """LRU index of completed files for running the download directory as a bounded cache.
+
+    Files sit in a min-heap keyed by last access time. Touching a file pushes
+    a fresh heap entry and leaves the old one behind; stale entries are
+    skipped when they reach the top, so finding the next victim is O(log n)
+    and nothing ever rescans the directory. Pinned files are never evicted.
+    """
+
+    def __init__(self, max_bytes=0, max_files=0, ttl=0):
+        self.max_bytes = max_bytes  # 0 disables a limit
+        self.max_files = max_files
+        self.ttl = ttl  # Seconds since last access
+        self.entries = {}  # path -> {'size', 'last_access', 'pinned'}
+        self.heap = []  # (last_access, path), possibly stale
+        self.total_bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, path, size, last_access=None, pinned=False):
+        """Track a file, replacing any previous entry for the same path"""
+        with self.lock:
+            self._discard(path)
+            entry = {'size': size, 'last_access': last_access or time.time(), 'pinned': pinned}
+            self.entries[path] = entry
+            self.total_bytes += size
+            if not pinned:
+                heapq.heappush(self.heap, (entry['last_access'], path))
+
+    def touch(self, path, when=None):
+        """Record that a file was served"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return
+            entry['last_access'] = when or time.time()
+            if not entry['pinned']:
+                heapq.heappush(self.heap, (entry['last_access'], path))
+                self._compact()
+
+    def set_pinned(self, path, pinned):
+        """Pin or unpin a file; returns False if the file is not tracked"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return False
+            if entry['pinned'] and not pinned:
+                heapq.heappush(self.heap, (entry['last_access'], path))
+            entry['pinned'] = pinned
+            return True
+
+    def remove(self, path):
+        """Stop tracking a file"""
+        with self.lock:
+            self._discard(path)
+
+    def select_victims(self, now=None):
+        """Pop and return the paths to delete to bring the cache back within its limits"""
+        now = now or time.time()
+        victims = []
+        with self.lock:
+            while self.heap:
+                last_access, path = self.heap[0]
+                entry = self.entries.get(path)
+                if entry is None or entry['pinned'] or entry['last_access'] != last_access:
+                    heapq.heappop(self.heap)  # Stale
+                    continue
+
+                over_quota = (
+                    (self.max_bytes and self.total_bytes > self.max_bytes)
+                    or (self.max_files and len(self.entries) > self.max_files)
+                )
+                expired = self.ttl and now - last_access > self.ttl
+                if not over_quota and not expired:
+                    break
+
+                heapq.heappop(self.heap)
+                self._discard(path)
+                self.evicted_files += 1
+                self.evicted_bytes += entry['size']
+                victims.append(path)
+        return victims
+
+    def stats(self):
+        """Usage and limits of the cache"""
+        with self.lock:
+            return {
+                'files': len(self.entries),
+                'bytes': self.total_bytes,
+                'pinned': sum(1 for entry in self.entries.values() if entry['pinned']),
+                'max_files': self.max_files,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'evicted_files': self.evicted_files,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+    def _discard(self, path):
+        """Drop a file's entry; its heap entries become stale. Caller must hold self.lock."""
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.total_bytes -= entry['size']
+
+    def _compact(self):
+        """Rebuild the heap once stale entries dominate it. Caller must hold self.lock."""
+        if len(self.heap) > 2 * len(self.entries) + 1024:
+            self.heap = [
+                (entry['last_access'], path)
+                for path, entry in self.entries.items() if not entry['pinned']
+            ]
+            heapq.heapify(self.heap)
@@ -0,0 +1,103 @@
+import math
+from array import array
+
+# Seconds between speed updates, and the starting spacing of stored samples
+SAMPLE_INTERVAL = 1.0
+
+# Samples held per job: two doubles each, so 4 KiB per job
+SAMPLE_CAPACITY = 256
+
+# Time constant of the smoothed speed; older rates fade by 1/e every EWMA_TAU seconds
+EWMA_TAU = 5.0
+
+# Points kept in the speed history of a completed job
+HISTORY_POINTS = 60
+
+
+class SpeedSeries:
+    """Throughput samples of one job in a fixed-size numeric buffer.
+
+    (time, downloaded bytes) pairs are interleaved in a single array('d').
+    When it fills up, every other sample is dropped and the spacing between
+    samples doubles, so the buffer always spans the whole job at the finest
+    resolution that fits and memory per job stays constant.
+    """
+
+    __slots__ = ('data', 'capacity', 'count', 'interval', 'ewma', 'started', 'start_bytes', 'last_time', 'last_bytes')
+
+    def __init__(self, now, downloaded, capacity=SAMPLE_CAPACITY):
+        self.data = array('d', bytes(2 * capacity * array('d').itemsize))
+        self.capacity = capacity
+        self.count = 0
+        self.interval = SAMPLE_INTERVAL
+        self.ewma = None
+        self.started = now
+        self.start_bytes = downloaded
+        self.last_time = now
+        self.last_bytes = downloaded
+        self._append(now, downloaded)
+
+    def add(self, now, downloaded):
+        """Account for the job's byte count; returns True if the speed was updated"""
+        elapsed = now - self.last_time
+        if elapsed < SAMPLE_INTERVAL:
+            return False
+
+        rate = max(0.0, (downloaded - self.last_bytes) / elapsed)
+        if self.ewma is None:
+            self.ewma = rate
+        else:
+            # Weighted by elapsed time, so irregular updates smooth the same way
+            self.ewma += (1 - math.exp(-elapsed / EWMA_TAU)) * (rate - self.ewma)
+        self.last_time = now
+        self.last_bytes = downloaded
+
+        if now - self.data[2 * (self.count - 1)] >= self.interval:
+            if self.count == self.capacity:
+                self._decimate()
+            self._append(now, downloaded)
+        return True
+
+    def _append(self, now, downloaded):
+        self.data[2 * self.count] = now
+        self.data[2 * self.count + 1] = downloaded
+        self.count += 1
+
+    def _decimate(self):
+        """Keep every other sample and double the spacing of future ones"""
+        kept = (self.count + 1) // 2
+        for i in range(kept):
+            self.data[2 * i] = self.data[4 * i]
+            self.data[2 * i + 1] = self.data[4 * i + 1]
+        self.count = kept
+        self.interval *= 2
+
+    @property
+    def speed(self):
+        """Smoothed bytes per second"""
+        return self.ewma or 0.0
+
+    def average(self):
+        """Mean bytes per second since the series started"""
+        elapsed = self.last_time - self.started
+        return (self.last_bytes - self.start_bytes) / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, remaining):
+        """Seconds until remaining more bytes arrive at the smoothed speed, or None if unknown"""
+        if remaining <= 0 or not self.ewma:
+            return None
+        return round(remaining / self.ewma)
+
+    def history(self, points=HISTORY_POINTS):
+        """Up to points [seconds since start, bytes per second] pairs covering the whole series"""
+        if self.count < 2:
+            return []
+        step = max(1, math.ceil((self.count - 1) / points))
+        history = []
+        for i in range(0, self.count - 1, step):
+            j = min(i + step, self.count - 1)
+            t0, b0 = self.data[2 * i], self.data[2 * i + 1]
+            t1, b1 = self.data[2 * j], self.data[2 * j + 1]
+            if t1 > t0:
+                history.append([round(t1 - self.started, 1), round(max(0.0, b1 - b0) / (t1 - t0))])
+        return history
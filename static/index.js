@@ -0,0 +1,653 @@
+// DOM elements
+const downloadForm = document.getElementById('downloadForm');
+const downloadUrl = document.getElementById('downloadUrl');
+const engineSelect = document.getElementById('engine');
+const mirrorUrls = document.getElementById('mirrorUrls');
+const postprocessStages = document.getElementById('postprocessStages');
+const notBefore = document.getElementById('notBefore');
+const downloadWindow = document.getElementById('downloadWindow');
+const crawlMode = document.getElementById('crawlMode');
+const crawlInclude = document.getElementById('crawlInclude');
+const crawlExclude = document.getElementById('crawlExclude');
+const crawlList = document.getElementById('crawlList');
+const activeDownloads = document.getElementById('activeDownloads');
+const downloadHistory = document.getElementById('downloadHistory');
+const clearHistoryBtn = document.getElementById('clearHistoryBtn');
+const exportHistoryBtn = document.getElementById('exportHistoryBtn');
+const logoutBtn = document.getElementById('logoutBtn');
+const alertMessage = document.getElementById('alertMessage');
+
+// The history is fetched a page at a time around what is in view, and
+// rows this far outside the viewport are rendered ahead of scrolling
+const HISTORY_PAGE = 100;
+const OVERSCAN_ROWS = 3;
+let historyOffset = 0;
+let historyLimit = HISTORY_PAGE;
+let historyFetchTimer = null;
+
+// Format bytes to human-readable size
+function formatBytes(bytes, decimals = 2) {
+    if (bytes === 0) return '0 Bytes';
+    
+    const k = 1024;
+    const dm = decimals < 0 ? 0 : decimals;
+    const sizes = ['Bytes', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB'];
+    
+    const i = Math.floor(Math.log(bytes) / Math.log(k));
+    
+    return parseFloat((bytes / Math.pow(k, i)).toFixed(dm)) + ' ' + sizes[i];
+}
+
+// Format a number of seconds as e.g. 1h 02m or 3m 05s
+function formatDuration(seconds) {
+    const h = Math.floor(seconds / 3600);
+    const m = Math.floor((seconds % 3600) / 60);
+    const s = Math.floor(seconds % 60);
+    if (h > 0) return `${h}h ${String(m).padStart(2, '0')}m`;
+    if (m > 0) return `${m}m ${String(s).padStart(2, '0')}s`;
+    return `${s}s`;
+}
+
+// One line per post-processing stage: its status, how far it has read, and its result
+function formatStages(download) {
+    if (!download.postprocess) return '';
+    return download.postprocess.map(stage => {
+        const name = stage.option ? `${stage.stage}:${stage.option}` : stage.stage;
+        let detail = stage.status;
+        if (stage.status === 'running') {
+            detail += download.size > 0
+                ? ` ${Math.min(100, Math.round(stage.processed / download.size * 100))}%`
+                : ` ${formatBytes(stage.processed)}`;
+        } else if (stage.status === 'error') {
+            detail = `error: ${stage.error}`;
+        } else if (stage.result) {
+            if (stage.result.digest) detail = stage.result.digest;
+            else if (stage.result.files != null) detail = `${stage.result.files} files in ${stage.result.output}/`;
+            else if (stage.result.output) detail = `${stage.result.output} (${formatBytes(stage.result.bytes)})`;
+        }
+        return `<div class="stage stage-${stage.status}">${escapeHtml(name)}: ${escapeHtml(detail)}</div>`;
+    }).join('');
+}
+
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => ({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'})[c]);
+}
+
+// Create a download item element; updateDownloadItem fills it in
+function createDownloadItem(download) {
+    const item = document.createElement('div');
+    item.dataset.id = download.id;
+    item.innerHTML = `
+        <div class="download-info">
+            <div class="download-title"></div>
+            <div class="download-url"></div>
+            <div class="download-meta">
+                <div class="download-status"></div>
+                <div class="download-size"></div>
+            </div>
+            <div class="download-speed"></div>
+            <div class="download-stages"></div>
+        </div>
+        <div class="progress-container">
+            <div class="progress-bar"></div>
+        </div>
+        <div class="download-meta download-times"></div>
+        <div class="download-actions"></div>
+    `;
+    item.fields = {};  // Values last written to the element, by field
+    updateDownloadItem(item, download);
+    return item;
+}
+
+// Write the fields of a download item that changed since it was last updated
+function updateDownloadItem(item, download) {
+    const patch = (field, value, apply) => {
+        if (item.fields[field] !== value) {
+            item.fields[field] = value;
+            apply(value);
+        }
+    };
+    const text = (selector, value) => patch(selector, value, () => {
+        const element = item.querySelector(selector);
+        element.textContent = value;
+        element.hidden = !value;
+    });
+    const html = (selector, value) => patch(selector, value, () => {
+        const element = item.querySelector(selector);
+        element.innerHTML = value;
+        element.hidden = !value;
+    });
+    
+    let progressText = '';
+    if ((download.status === 'downloading' || download.status === 'initializing') && download.size > 0) {
+        progressText = `${formatBytes(download.downloaded)} / ${formatBytes(download.size)}`;
+    } else if (download.size > 0) {
+        progressText = formatBytes(download.size);
+    }
+    
+    let statusText = download.status.charAt(0).toUpperCase() + download.status.slice(1);
+    if (download.error) {
+        statusText = `Error: ${download.error}`;
+    } else if (download.status === 'downloading' && download.retries > 0) {
+        statusText += ` (retry ${download.retries})`;
+    } else if (download.status === 'scheduled') {
+        const window = download.window ? ` in window ${download.window}` : '';
+        statusText = download.starts_at
+            ? `Starts ${new Date(download.starts_at * 1000).toLocaleString()}${window}`
+            : `Scheduled${window}`;
+    }
+    
+    // Display download speed for active downloads
+    let speedText = '';
+    if (download.status === 'downloading' && download.speed) {
+        const eta = download.eta != null ? ` · ${formatDuration(download.eta)} left` : '';
+        speedText = `${download.speed}${eta}`;
+    } else if (download.status === 'completed' && download.average_speed) {
+        speedText = `Average ${formatBytes(download.average_speed)}/s`;
+    }
+    
+    let actions = '';
+    if (download.status === 'completed') {
+        actions = `<button class="btn-pin" onclick="pinDownload('${download.id}', ${!download.pinned})">${download.pinned ? 'Unpin' : 'Pin'}</button>
+            <button class="btn-download" onclick="window.location.href='/downloads/${encodeURIComponent(download.filename)}'">Download</button>`;
+    } else if (['downloading', 'initializing', 'queued', 'scheduled'].includes(download.status)) {
+        actions = `<button class="btn-cancel" onclick="cancelDownload('${download.id}')">Cancel</button>`;
+    } else if (download.status === 'error' || download.status === 'cancelled') {
+        actions = `<button class="btn-retry" onclick="retryDownload('${download.id}')">Retry</button>`;
+    }
+    
+    const times = [`<div class="download-time">Started: ${new Date(download.start_time * 1000).toLocaleString()}</div>`];
+    if (download.end_time) times.push(`<div class="download-time">Ended: ${new Date(download.end_time * 1000).toLocaleString()}</div>`);
+    if (download.node) times.push(`<div class="download-time">Node: ${escapeHtml(download.node)}</div>`);
+    
+    patch('status', download.status, status => { item.className = `download-item status-${status}`; });
+    text('.download-title', download.filename);
+    text('.download-url', download.url);
+    text('.download-status', statusText);
+    text('.download-size', progressText);
+    text('.download-speed', speedText);
+    html('.download-stages', formatStages(download));
+    patch('progress', download.progress, progress => { item.querySelector('.progress-bar').style.width = `${progress}%`; });
+    html('.download-times', times.join(''));
+    html('.download-actions', actions);
+}
+
+// A download list that keeps only the items near the viewport in the DOM.
+// Items are keyed by job id, so each poll patches the elements already
+// shown instead of rebuilding them, and the list scrolls with the page,
+// padded above and below to the estimated height of the rows left out.
+class VirtualList {
+    constructor(container, onRangeChange = () => {}) {
+        this.container = container;
+        this.emptyMessage = container.querySelector('.empty-message');
+        this.onRangeChange = onRangeChange;  // Called with the range of items rendered
+        this.items = [];
+        this.offset = 0;  // Index in the whole list of items[0]
+        this.total = 0;
+        this.elements = new Map();  // Job id, or the index of an item not loaded yet -> element
+        this.rowHeight = 200;  // Row height plus gap: the mean over the rows measured so far
+        this.measuredRows = 0;
+        this.measuredHeight = 0;
+        this.first = 0;  // Range of items rendered
+        this.last = 0;
+    }
+    
+    // Replace the items; items may be a page of a longer list, starting at offset
+    setItems(items, total = items.length, offset = 0) {
+        this.items = items;
+        this.total = total;
+        this.offset = offset;
+        this.render();
+    }
+    
+    render() {
+        if (this.total === 0) {
+            this.elements.clear();
+            this.container.replaceChildren(this.emptyMessage);
+            this.container.style.padding = '';
+            this.first = this.last = 0;
+            return;
+        }
+        
+        const style = getComputedStyle(this.container);
+        const columns = style.gridTemplateColumns.split(' ').length;
+        const gap = parseFloat(style.rowGap) || 0;
+        const rows = Math.ceil(this.total / columns);
+        const rect = this.container.getBoundingClientRect();
+        const firstRow = Math.min(rows, Math.max(0, Math.floor(-rect.top / this.rowHeight) - OVERSCAN_ROWS));
+        const lastRow = Math.min(rows, Math.max(firstRow, Math.ceil((window.innerHeight - rect.top) / this.rowHeight) + OVERSCAN_ROWS));
+        this.first = firstRow * columns;
+        this.last = Math.min(this.total, lastRow * columns);
+        
+        const wanted = [];
+        for (let index = this.first; index < this.last; index++) {
+            const download = this.items[index - this.offset];
+            const key = download ? download.id : index;
+            let element = this.elements.get(key);
+            if (!element) {
+                element = download ? createDownloadItem(download) : createPlaceholder();
+                this.elements.set(key, element);
+            } else if (download) {
+                updateDownloadItem(element, download);
+            }
+            if (!download) element.style.height = `${this.rowHeight - gap}px`;
+            wanted.push(element);
+        }
+        
+        const keep = new Set(wanted);
+        for (const [key, element] of this.elements) {
+            if (!keep.has(element)) {
+                element.remove();
+                this.elements.delete(key);
+            }
+        }
+        if (this.emptyMessage.parentNode) this.emptyMessage.remove();
+        // Move only the elements that are out of place
+        wanted.forEach((element, position) => {
+            const current = this.container.children[position];
+            if (current !== element) this.container.insertBefore(element, current || null);
+        });
+        
+        this.container.style.paddingTop = `${firstRow * this.rowHeight}px`;
+        this.container.style.paddingBottom = `${(rows - lastRow) * this.rowHeight}px`;
+        
+        // Refine the estimate with the rows just rendered; a change moves the padding, so render again
+        if (lastRow > firstRow) {
+            const height = this.container.getBoundingClientRect().height
+                - (firstRow + rows - lastRow) * this.rowHeight;
+            this.measuredRows += lastRow - firstRow;
+            this.measuredHeight += height + gap;
+            const estimate = this.measuredHeight / this.measuredRows;
+            if (Math.abs(estimate - this.rowHeight) > 1) {
+                this.rowHeight = estimate;
+                scheduleRender();
+            }
+        }
+        this.onRangeChange(this.first, this.last);
+    }
+}
+
+// Stands in for a history item whose page has not arrived yet
+function createPlaceholder() {
+    const item = document.createElement('div');
+    item.className = 'download-item download-placeholder';
+    item.textContent = 'Loading…';
+    return item;
+}
+
+const activeList = new VirtualList(activeDownloads);
+const historyList = new VirtualList(downloadHistory, (first, last) => {
+    // Ask for the pages around what is in view when the last response does not cover it
+    if (first >= historyList.offset && last <= historyList.offset + historyList.items.length) return;
+    const offset = Math.floor(first / HISTORY_PAGE) * HISTORY_PAGE;
+    const limit = Math.max(HISTORY_PAGE, Math.ceil(last / HISTORY_PAGE) * HISTORY_PAGE - offset);
+    if (offset !== historyOffset || limit !== historyLimit) {
+        historyOffset = offset;
+        historyLimit = limit;
+        clearTimeout(historyFetchTimer);
+        historyFetchTimer = setTimeout(fetchDownloads, 100);  // Once scrolling settles
+    }
+});
+
+// Render both lists at most once per frame while scrolling
+let renderPending = false;
+function scheduleRender() {
+    if (renderPending) return;
+    renderPending = true;
+    requestAnimationFrame(() => {
+        renderPending = false;
+        activeList.render();
+        historyList.render();
+    });
+}
+
+window.addEventListener('scroll', scheduleRender, {passive: true});
+window.addEventListener('resize', scheduleRender);
+
+// Update download list display
+function updateDownloadList(data) {
+    activeList.setItems(data.active);
+    historyList.setItems(data.history, data.history_total, data.history_offset);
+}
+
+// Show directory crawls that are running or recently finished
+function updateCrawlList(crawls) {
+    crawlList.innerHTML = '';
+    crawls.forEach(crawl => {
+        const item = document.createElement('div');
+        item.className = `crawl-item status-${crawl.status}`;
+        let summary = `${crawl.pages} pages, ${crawl.files} files queued`;
+        if (crawl.skipped) summary += `, ${crawl.skipped} skipped`;
+        if (crawl.truncated) summary += ' (file limit reached)';
+        if (crawl.error) summary = `Error: ${crawl.error}`;
+        const status = crawl.status.charAt(0).toUpperCase() + crawl.status.slice(1);
+        // The URL and error come from the crawled server, so they are escaped
+        item.innerHTML = `
+            <div class="download-info">
+                <div class="download-url">${escapeHtml(status)} ${escapeHtml(crawl.url)}</div>
+                <div class="download-status">${escapeHtml(summary)}</div>
+            </div>
+            ${crawl.status === 'crawling' ? `<button class="btn-cancel" onclick="cancelCrawl('${escapeHtml(crawl.id)}')">Stop</button>` : ''}
+        `;
+        crawlList.appendChild(item);
+    });
+}
+
+// Fetch all downloads
+function fetchDownloads() {
+    fetch(`/api/downloads?history_offset=${historyOffset}&history_limit=${historyLimit}`)
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    // Redirect to login page if unauthorized
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            updateDownloadList(data);
+            updateCrawlList(data.crawls || []);
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Failed to fetch downloads: ' + error.message);
+            }
+        });
+}
+
+// Add a new download
+function addDownload(url, engine, mirrors = '') {
+    const formData = new FormData();
+    formData.append('url', url);
+    formData.append('engine', engine);
+    formData.append('use_aria2', engine === 'aria2');
+    formData.append('mirrors', mirrors);
+    formData.append('postprocess', postprocessStages.value.trim());
+    // Sent as a timestamp, so the browser's time zone applies rather than the server's
+    if (notBefore.value) formData.append('not_before', new Date(notBefore.value).getTime() / 1000);
+    formData.append('window', downloadWindow.value);
+    
+    fetch('/api/download', {
+        method: 'POST',
+        body: formData
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                if (response.status === 429) {
+                    return response.json().then(data => {
+                        throw new Error(`${data.error}. Try again in ${data.retry_after}s.`);
+                    });
+                }
+                if (response.status === 400) {
+                    return response.json().then(data => {
+                        throw new Error(data.error);
+                    });
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                downloadUrl.value = '';
+                mirrorUrls.value = '';
+                fetchDownloads();
+            } else {
+                showAlert(data.error || 'Failed to start download');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error adding download: ' + error.message);
+            }
+        });
+}
+
+// Queue every file below a directory listing
+function addCrawl(url, engine) {
+    const formData = new FormData();
+    formData.append('url', url);
+    formData.append('engine', engine);
+    formData.append('use_aria2', engine === 'aria2');
+    formData.append('include', crawlInclude.value.trim());
+    formData.append('exclude', crawlExclude.value.trim());
+    
+    fetch('/api/crawl', {
+        method: 'POST',
+        body: formData
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                if (response.status === 400 || response.status === 429) {
+                    return response.json().then(data => {
+                        throw new Error(data.retry_after ? `${data.error}. Try again in ${data.retry_after}s.` : data.error);
+                    });
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                downloadUrl.value = '';
+                fetchDownloads();
+            } else {
+                showAlert(data.error || 'Failed to start crawl');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error starting crawl: ' + error.message);
+            }
+        });
+}
+
+// Stop discovering files; downloads already queued keep going
+function cancelCrawl(id) {
+    fetch(`/api/crawl/${id}/cancel`, {
+        method: 'POST'
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                fetchDownloads();
+            } else {
+                showAlert('Failed to stop crawl');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error stopping crawl: ' + error.message);
+            }
+        });
+}
+
+// Pin a completed download so retention never evicts it, or unpin it
+function pinDownload(id, pinned) {
+    const formData = new FormData();
+    formData.append('pinned', pinned);
+    
+    fetch(`/api/download/${id}/pin`, {
+        method: 'POST',
+        body: formData
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                fetchDownloads();
+            } else {
+                showAlert('Failed to update pin');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error updating pin: ' + error.message);
+            }
+        });
+}
+
+// Cancel a download
+function cancelDownload(id) {
+    fetch(`/api/download/${id}/cancel`, {
+        method: 'POST'
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                fetchDownloads();
+            } else {
+                showAlert('Failed to cancel download');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error cancelling download: ' + error.message);
+            }
+        });
+}
+
+// Retry a failed download, resuming from what is already on disk
+function retryDownload(id) {
+    fetch(`/api/download/${id}/retry`, {
+        method: 'POST'
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                if (response.status === 429) {
+                    return response.json().then(data => {
+                        throw new Error(`${data.error}. Try again in ${data.retry_after}s.`);
+                    });
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                fetchDownloads();
+            } else {
+                showAlert('Failed to retry download');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error retrying download: ' + error.message);
+            }
+        });
+}
+
+// Clear download history
+function clearHistory() {
+    if (!confirm('Are you sure you want to clear download history?')) {
+        return;
+    }
+    
+    fetch('/api/downloads/clear_history', {
+        method: 'POST'
+    })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    throw new Error('Session expired. Please log in again.');
+                }
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data.success) {
+                fetchDownloads();
+            } else {
+                showAlert('Failed to clear history');
+            }
+        })
+        .catch(error => {
+            if (!error.message.includes('Session expired')) {
+                showAlert('Error clearing history: ' + error.message);
+            }
+        });
+}
+
+// Show alert message
+function showAlert(message) {
+    alertMessage.textContent = message;
+    alertMessage.style.display = 'block';
+    setTimeout(() => {
+        alertMessage.style.display = 'none';
+    }, 5000);
+}
+
+// Event listeners
+downloadForm.addEventListener('submit', function(e) {
+    e.preventDefault();
+    const url = downloadUrl.value.trim();
+    if (url && crawlMode.checked) {
+        addCrawl(url, engineSelect.value);
+    } else if (url) {
+        addDownload(url, engineSelect.value, mirrorUrls.value.trim());
+    }
+});
+
+clearHistoryBtn.addEventListener('click', clearHistory);
+
+// Download every completed file as one streamed archive
+exportHistoryBtn.addEventListener('click', function() {
+    window.location.href = '/api/downloads/export?format=zip';
+});
+
+logoutBtn.addEventListener('click', function() {
+    window.location.href = '/logout';
+});
+
+// Poll for download updates (more frequently for active downloads)
+function pollDownloads() {
+    fetchDownloads();
+    setTimeout(pollDownloads, 1500); // Update every 1.5 seconds for smoother UI updates
+}
+
+// Initial load
+fetchDownloads();
+pollDownloads();
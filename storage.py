@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import uuid
+
+# How completed files are placed under DOWNLOAD_DIR: 'flat' at their public
+# path, 'hash' under shards picked by a hash of the public path, 'id' under
+# shards picked by job id with a directory per job
+LAYOUTS = ('flat', 'hash', 'id')
+
+# Levels of shard directories, each with up to 256 two-hex-digit names
+SHARD_LEVELS = 2
+SHARD_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+
+
+def _shard(key):
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return [digest[2 * level:2 * level + 2] for level in range(SHARD_LEVELS)]
+
+
+def _prune(directory, root):
+    """Remove directory and its parents up to root while they are empty"""
+    while directory != root and directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+
+class StorageLayout:
+    """Maps the public paths served under /downloads/ to files under the download directory.
+
+    A public path is the job's filename, e.g. 'site/docs/manual.pdf' for a
+    crawled file. The flat layout stores it as is. The sharded layouts keep
+    any one directory small on disk: 'hash' stores it under ab/cd/ from a
+    hash of the public path, so a name always lands in the same place, and
+    'id' under ab/cd/<job id>/, so jobs with the same filename never
+    overwrite each other. Either way the public path stays the tail of the
+    stored path, so the mapping can be rebuilt from the directory tree
+    alone; the index kept here is what lets a request resolve without
+    searching for it.
+    """
+
+    def __init__(self, download_dir, layout='flat'):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown storage layout {layout}; expected one of {', '.join(LAYOUTS)}")
+        self.download_dir = os.path.abspath(download_dir)
+        self.layout = layout
+        self.depth = {'flat': 0, 'hash': SHARD_LEVELS, 'id': SHARD_LEVELS + 1}[layout]
+        self.index = {}  # Public path -> stored path, for the sharded layouts
+        self.paths = {}  # Stored path -> public path
+        self.lock = threading.Lock()
+
+    @property
+    def sharded(self):
+        return self.layout != 'flat'
+
+    def path_for(self, public, download_id=None):
+        """Where a job stores the file with this public path"""
+        parts = public.split('/')
+        if self.layout == 'hash':
+            parts = _shard(public) + parts
+        elif self.layout == 'id':
+            parts = _shard(download_id) + [download_id] + parts
+        return os.path.join(self.download_dir, *parts)
+
+    def public_path(self, path):
+        """The public path of a file stored at path, or None if this layout would not have put it there"""
+        parts = os.path.relpath(path, self.download_dir).split(os.sep)
+        if parts[0] == '..' or len(parts) <= self.depth:
+            return None
+        if self.sharded and not all(SHARD_PATTERN.match(part) for part in parts[:SHARD_LEVELS]):
+            return None
+        return '/'.join(parts[self.depth:])
+
+    def name_of(self, path):
+        """The public path of a file under the download directory, placed by this layout or not"""
+        return self.public_path(path) or os.path.relpath(path, self.download_dir).replace(os.sep, '/')
+
+    def add(self, path, public=None, replace=True):
+        """Make a stored file (or directory of stage output) resolvable by its public path.
+
+        Without replace, a public path that already resolves keeps its file,
+        e.g. a newer download of the same name over one found on disk.
+        """
+        if not self.sharded:
+            return
+        public = public or self.public_path(path)
+        if public is None:
+            return
+        with self.lock:
+            if replace or public not in self.index:
+                self.index[public] = path
+                self.paths[path] = public
+
+    def discard(self, path):
+        """Forget a file that was removed, and prune the shard directories it leaves empty"""
+        if not self.sharded:
+            return
+        with self.lock:
+            public = self.paths.pop(path, None)
+            if public is not None and self.index.get(public) == path:
+                del self.index[public]
+        _prune(os.path.dirname(path), self.download_dir)
+
+    def resolve(self, public):
+        """The stored path for a public path, or None if nothing is known there.
+
+        A path below an indexed directory (the output of an unpack stage)
+        resolves through its nearest indexed parent.
+        """
+        if not self.sharded:
+            return os.path.join(self.download_dir, public)
+        parts = public.split('/')
+        with self.lock:
+            for end in range(len(parts), 0, -1):
+                stored = self.index.get('/'.join(parts[:end]))
+                if stored:
+                    return os.path.join(stored, *parts[end:])
+        if self.layout == 'hash':
+            # Placed by name, so files written by other cluster nodes are found too
+            return self.path_for(public)
+        return None
+
+    def __len__(self):
+        return len(self.index)
+
+
+def _walk_files(directory, skip):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in skip]
+        for name in files:
+            yield os.path.join(root, name)
+
+
+def migrate(download_dir, source, target, manifest_path=None, skip=(), dry_run=False):
+    """Move every file under download_dir from the source layout to the target one.
+
+    Run it while the server is stopped. Job ids for the 'id' layout come
+    from the history manifest, whose records are rewritten with the new
+    paths; files without a record get an id derived from their public path.
+    Returns (moved, skipped) counts.
+    """
+    source = StorageLayout(download_dir, source)
+    target = StorageLayout(download_dir, target)
+    skip = {os.path.abspath(path) for path in skip}
+
+    records = []
+    if manifest_path and os.path.exists(manifest_path):
+        torn = 0
+        with open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    torn += 1  # Torn write from a crash; the server skips these too
+        if torn:
+            print(f"Skipping {torn} unreadable lines of {manifest_path}")
+    ids = {record['final_path']: record['id'] for record in records if 'final_path' in record}
+
+    moved = {}
+    skipped = 0
+    for path in list(_walk_files(source.download_dir, skip)):
+        public = source.public_path(path)
+        if public is None:
+            print(f"Skipping {path}: not in the {source.layout} layout")
+            skipped += 1
+            continue
+        download_id = ids.get(path) or str(uuid.uuid5(uuid.NAMESPACE_URL, public))
+        new_path = target.path_for(public, download_id)
+        if new_path == path:
+            continue
+        if os.path.exists(new_path):
+            print(f"Skipping {path}: {new_path} already exists")
+            skipped += 1
+            continue
+        if not dry_run:
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(path, new_path)
+            _prune(os.path.dirname(path), source.download_dir)
+        moved[path] = new_path
+
+    if moved and records and not dry_run:
+        temp_manifest = manifest_path + '.tmp'
+        with open(temp_manifest, 'w', encoding='utf-8') as f:
+            for record in records:
+                if record.get('final_path') in moved:
+                    record['final_path'] = moved[record['final_path']]
+                f.write(json.dumps(record) + '\n')
+        os.replace(temp_manifest, manifest_path)
+    return len(moved), skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move the files in DOWNLOAD_DIR to another storage layout. Stop the server first."
+    )
+    parser.add_argument('--download-dir', default=os.environ.get('DOWNLOAD_DIR') or 'downloads')
+    parser.add_argument('--temp-dir', default=os.environ.get('TEMP_DIR') or 'downloads/temp')
+    parser.add_argument('--state-dir', default=os.environ.get('STATE_DIR') or 'state')
+    parser.add_argument('--from', dest='source', choices=LAYOUTS, default='flat')
+    parser.add_argument('--to', dest='target', choices=LAYOUTS, required=True)
+    parser.add_argument('--dry-run', action='store_true', help="Report what would move without moving it")
+    args = parser.parse_args(argv)
+
+    from download_manager import MANIFEST_NAME
+    moved, skipped = migrate(
+        args.download_dir,
+        args.source,
+        args.target,
+        manifest_path=os.path.join(args.state_dir, MANIFEST_NAME),
+        skip=(args.temp_dir, args.state_dir),
+        dry_run=args.dry_run
+    )
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} files, skipped {skipped}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
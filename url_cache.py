@@ -0,0 +1,144 @@
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    """Cache key for a URL: scheme and host are case-insensitive and the fragment is never sent"""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def url_metadata(response):
+    """What a HEAD response tells us about a URL, from a requests or Http2Session response"""
+    headers = response.headers
+    filename = None
+    content_disposition = headers.get('Content-Disposition')
+    if content_disposition:
+        filename_match = re.search(r'filename="?([^"]+)"?', content_disposition)
+        if filename_match:
+            filename = unquote(filename_match.group(1))
+
+    try:
+        size = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        size = 0
+
+    return {
+        'status': response.status_code,
+        'ok': response.ok,
+        'final_url': str(response.url),
+        'filename': filename,
+        'size': size,
+        'content_type': headers.get('Content-Type', '').split(';')[0].strip(),
+        'accept_ranges': headers.get('Accept-Ranges', '').lower() == 'bytes',
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'fetched': time.time()
+    }
+
+
+class _TTLCache:
+    """Bounded LRU mapping whose entries expire ttl seconds after they were stored"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+class MetadataCache(_TTLCache):
+    """Results of HEAD probes, so repeated submissions of a URL skip the round trip.
+
+    Only successful probes are stored; an entry whose final URL stops working
+    is invalidated by the engine so the next attempt probes afresh.
+    """
+
+    def __init__(self, max_entries=4096, ttl=300):
+        super().__init__(max_entries, ttl)
+
+    def get(self, url):
+        return super().get(normalize_url(url))
+
+    def put(self, url, metadata):
+        super().put(normalize_url(url), metadata)
+
+    def invalidate(self, url):
+        super().invalidate(normalize_url(url))
+
+    def final_url(self, url):
+        """Where url redirected to when it was last probed, or url itself"""
+        with self.lock:
+            entry = self.entries.get(normalize_url(url))
+        if entry is None or entry[0] < time.monotonic():
+            return url
+        return entry[1]['final_url']
+
+
+class DnsCache(_TTLCache):
+    """In-process cache in front of socket.getaddrinfo.
+
+    Once installed it serves every resolver call in the process, so the
+    metadata probe, requests and httpx all share it. aria2c resolves names
+    in its own process and is not affected. Failed lookups are not cached.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        super().__init__(max_entries, ttl)
+        self.resolve = socket.getaddrinfo
+
+    def install(self):
+        """Route socket.getaddrinfo through the cache"""
+        socket.getaddrinfo = self.getaddrinfo
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        result = self.get(key)
+        if result is None:
+            result = self.resolve(host, port, family, type, proto, flags)
+            self.put(key, result)
+        return list(result)
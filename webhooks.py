@@ -0,0 +1,134 @@
+import hashlib
+import heapq
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger('fdl_server.webhooks')
+
+# Delivery threads, and deliveries (first attempts and pending retries) held at once
+WORKERS = 2
+MAX_QUEUE = 1000
+
+# Attempts per delivery, with exponential backoff between them
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+
+# Seconds to wait for a callback endpoint to answer
+TIMEOUT = 10
+
+# Responses worth trying again; any other non-2xx answer is final
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class WebhookDispatcher:
+    """Delivers job events as JSON POSTs to the callback URL of their job.
+
+    Events wait in a bounded queue served by WORKERS threads, so a slow or
+    dead endpoint never holds up a download. Failed deliveries are retried
+    with exponential backoff up to MAX_ATTEMPTS times; once MAX_QUEUE events
+    are waiting, new ones are dropped and counted. Events with the same key
+    (a job's id) are delivered one at a time in the order they were queued,
+    later ones held while an earlier one is retried, so a receiver never sees
+    a stale event after a newer one. With a secret, each body is signed in
+    the X-FDL-Signature header as sha256=<HMAC-SHA256 hex digest>.
+    """
+
+    def __init__(self, workers=WORKERS, max_queue=MAX_QUEUE, max_attempts=MAX_ATTEMPTS, timeout=TIMEOUT, secret=None):
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.secret = secret.encode() if secret else None
+        self.queue = []  # Heap of (due time, sequence, attempt, url, body, key)
+        self.sequence = 0  # Keeps events due at the same time in submission order
+        self.held = {}  # Key with an event in the heap or being delivered -> deque of its later (url, body)
+        self.held_count = 0
+        self.condition = threading.Condition()
+        self.stats = {'queued': 0, 'delivered': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name=f"webhook-{index}")
+            thread.daemon = True
+            thread.start()
+
+    def notify(self, url, event, key=None):
+        """Queue an event for delivery after earlier ones with the same key (default: the URL).
+
+        Returns False if the queue is full and the event was dropped.
+        """
+        body = json.dumps(event).encode()
+        key = url if key is None else key
+        with self.condition:
+            if len(self.queue) + self.held_count >= self.max_queue:
+                self.stats['dropped'] += 1
+                return False
+            if key in self.held:
+                self.held[key].append((url, body))
+                self.held_count += 1
+            else:
+                self.held[key] = deque()
+                self._push(time.monotonic(), 1, url, body, key)
+            self.stats['queued'] += 1
+            return True
+
+    def _push(self, due, attempt, url, body, key):
+        """Caller must hold self.condition."""
+        self.sequence += 1
+        heapq.heappush(self.queue, (due, self.sequence, attempt, url, body, key))
+        self.condition.notify()
+
+    def _release(self, key):
+        """Queue the next held event of a key whose delivery is over. Caller must hold self.condition."""
+        held = self.held[key]
+        if not held:
+            del self.held[key]
+            return
+        url, body = held.popleft()
+        self.held_count -= 1
+        self._push(time.monotonic(), 1, url, body, key)
+
+    def _run(self):
+        session = requests.Session()
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    self.condition.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                _, _, attempt, url, body, key = heapq.heappop(self.queue)
+
+            retry, error = self._deliver(session, url, body)
+            with self.condition:
+                if error is None:
+                    self.stats['delivered'] += 1
+                    self._release(key)
+                elif retry and attempt < self.max_attempts:
+                    self.stats['retried'] += 1
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE ** attempt)
+                    self._push(time.monotonic() + delay, attempt + 1, url, body, key)
+                else:
+                    self.stats['failed'] += 1
+                    self._release(key)
+                    logger.warning("Webhook to %s failed after %d attempts: %s", url, attempt, error, extra={'url': url, 'attempt': attempt})
+
+    def _deliver(self, session, url, body):
+        """POST one event; returns (worth retrying, error or None)"""
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'FDL-Server webhook'}
+        if self.secret:
+            headers['X-FDL-Signature'] = 'sha256=' + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+        try:
+            response = session.post(url, data=body, headers=headers, timeout=self.timeout, allow_redirects=False)
+            response.close()
+        except requests.RequestException as e:
+            return True, e
+        if 200 <= response.status_code < 300:
+            return False, None
+        return response.status_code in RETRY_STATUSES, f"HTTP {response.status_code}"
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, pending=len(self.queue) + self.held_count)
@@ -0,0 +1,128 @@
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# name=[days ]HH:MM-HH:MM[@rate], e.g. night=22:00-06:00@10M or weekend=sat,sun 00:00-24:00
+WINDOW_PATTERN = re.compile(
+    r'^(?P<name>[\w-]+)=(?:(?P<days>[a-z,]+)\s+)?(?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})(?:@(?P<rate>\d+[kmg]?))?$',
+    re.IGNORECASE
+)
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+class WindowError(ValueError):
+    """Raised for a malformed window definition or an unknown window name"""
+
+
+def parse_rate(value):
+    """Bytes per second from e.g. '512K' or '10M'"""
+    value = value.strip().lower()
+    unit = value[-1] if value[-1] in 'kmg' else ''
+    return int(value[:len(value) - len(unit)]) * RATE_UNITS[unit]
+
+
+def _parse_time(value):
+    hours, minutes = (int(part) for part in value.split(':'))
+    if hours > 24 or minutes > 59 or (hours == 24 and minutes):
+        raise WindowError(f"Invalid time of day {value}")
+    return timedelta(hours=hours, minutes=minutes)
+
+
+def parse_windows(value):
+    """DownloadWindows by name from a ';' separated list of window definitions"""
+    windows = {}
+    for item in (value or '').split(';'):
+        item = item.strip()
+        if not item:
+            continue
+        match = WINDOW_PATTERN.match(item)
+        if not match:
+            raise WindowError(f"Invalid download window {item!r}; expected name=[days ]HH:MM-HH:MM[@rate]")
+        days = None
+        if match['days']:
+            days = {day.strip().lower()[:3] for day in match['days'].split(',')}
+            if not days <= set(DAYS):
+                raise WindowError(f"Invalid days in download window {item!r}")
+        windows[match['name']] = DownloadWindow(
+            match['name'],
+            _parse_time(match['start']),
+            _parse_time(match['end']),
+            rate=parse_rate(match['rate']) if match['rate'] else 0,
+            days=days
+        )
+    return windows
+
+
+class DownloadWindow:
+    """A daily period of server local time in which a window's jobs may run.
+
+    A window whose end is before its start runs past midnight; days, when
+    given, are the days it opens on. rate caps the combined speed of the
+    window's jobs in bytes per second, 0 for no cap.
+    """
+
+    def __init__(self, name, start, end, rate=0, days=None):
+        self.name = name
+        self.start = start
+        self.length = (end - start) % timedelta(days=1) or timedelta(days=1)
+        self.rate = rate
+        self.days = days
+
+    def _openings(self, now):
+        """(opening, closing) timestamps of the periods that start from yesterday onwards"""
+        today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        for offset in range(-1, 8):
+            day = today + timedelta(days=offset)
+            if self.days is None or DAYS[day.weekday()] in self.days:
+                opening = day + self.start
+                yield opening.timestamp(), (opening + self.length).timestamp()
+
+    def current(self, now=None):
+        """(opening, closing) of the period now falls in, or None while the window is closed"""
+        now = time.time() if now is None else now
+        for opening, closing in self._openings(now):
+            if opening <= now < closing:
+                return opening, closing
+        return None
+
+    def is_open(self, now=None):
+        return self.current(now) is not None
+
+    def next_open(self, now=None):
+        """When the window is next open: now if it is open already"""
+        now = time.time() if now is None else now
+        for opening, closing in self._openings(now):
+            if now < closing:
+                return max(now, opening)
+        return None  # Opens on no day of the week
+
+    def to_dict(self, now=None):
+        now = time.time() if now is None else now
+        current = self.current(now)
+        return {
+            'open': current is not None,
+            'closes_at': current[1] if current else None,
+            'opens_at': None if current else self.next_open(now),
+            'rate': self.rate
+        }
+
+
+class Throttle:
+    """Token bucket limiting the combined read rate of the connections that share it"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate  # Up to a second's worth of burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self, nbytes):
+        """Account for nbytes just read; returns the seconds to wait before reading more"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - nbytes
+            self.last = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0